@@ -0,0 +1,174 @@
+"""
+Streaming aggregation of claim verifications into per-response results.
+
+Verifications are consumed one at a time, in the order of the input ids (as written by the
+pipeline), and each response is emitted as soon as the next id starts. Only the claims of the
+responses still in flight are in memory, instead of every claim of the dataset:
+
+    summary = DatasetSummary()
+    with open_writer(output_file) as writer:
+        writer.write_all(summary.track(aggregate_stream(ids, verifications)))
+    write_summary(output_dir, summary)
+
+Each response record has its mean claim `score` (and `support_prob`, over `n_support_probs`
+claims), claim counts and per-sentence statistics. `summary.json` has the dataset-level statistics.
+"""
+import os
+import json
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+SUMMARY_FILE = "summary.json"
+
+# Keys of a verification that identify the claim rather than describe it
+_KEY_FIELDS = {"id", "sentence_id", "claim_id"}
+
+
+def _is_unsupported(score: Optional[float]) -> bool:
+    return score is not None and score == 0
+
+
+def _mean(total: float, count: int) -> Optional[float]:
+    return total / count if count else None
+
+
+class ResponseAccumulator:
+    """Running claim list and score sums of one response."""
+    def __init__(self, item_id: Any):
+        self.id = item_id
+        self.claims: List[Dict[str, Any]] = []
+        self.score_sum, self.n_scored, self.n_unsupported = 0.0, 0, 0
+        self.support_prob_sum, self.n_support_probs = 0.0, 0
+        # sentence_id -> [claims, score sum, scored claims, unsupported claims], in first-seen order
+        self.sentences: Dict[Any, List[float]] = {}
+
+    def add(self, verification: Dict[str, Any]):
+        self.claims.append({k: v for k, v in verification.items() if k not in _KEY_FIELDS})
+        sentence = self.sentences.setdefault(verification.get("sentence_id"), [0, 0.0, 0, 0])
+        sentence[0] += 1
+        if verification.get("score") is not None:
+            score = verification["score"]
+            self.score_sum += score
+            self.n_scored += 1
+            sentence[1] += score
+            sentence[2] += 1
+            if _is_unsupported(score):
+                self.n_unsupported += 1
+                sentence[3] += 1
+        if verification.get("support_prob") is not None:
+            self.support_prob_sum += verification["support_prob"]
+            self.n_support_probs += 1
+
+    def result(self) -> Dict[str, Any]:
+        record = {"id": self.id, "claims": self.claims, "score": _mean(self.score_sum, self.n_scored)}
+        if self.n_support_probs:
+            record["support_prob"] = self.support_prob_sum / self.n_support_probs
+            record["n_support_probs"] = self.n_support_probs
+        record["n_claims"] = len(self.claims)
+        record["n_unsupported"] = self.n_unsupported
+        record["sentences"] = [
+            {"sentence_id": sentence_id, "n_claims": n_claims, "score": _mean(score_sum, n_scored),
+             "n_unsupported": n_unsupported}
+            for sentence_id, (n_claims, score_sum, n_scored, n_unsupported) in self.sentences.items()
+        ]
+        return record
+
+
+def aggregate_stream(dataset_ids: Iterable[Any], verifications: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Yields one result per unique id of `dataset_ids`, in order of first occurrence.
+
+    `verifications` must list the claims of each id contiguously and in the order of
+    `dataset_ids`. A response is complete once a later id starts. Ids that occur more than
+    once in the dataset can have claims further down the stream, so they (and the responses
+    after them) are held until the end. Verifications of unknown ids are ignored.
+    """
+    dataset_ids = list(dataset_ids)
+    order = list(dict.fromkeys(dataset_ids))
+    position = {item_id: i for i, item_id in enumerate(order)}
+    repeated = {item_id for item_id, count in Counter(dataset_ids).items() if count > 1}
+    accumulators: Dict[Any, ResponseAccumulator] = {}
+    next_pos, frontier = 0, 0
+
+    def emit(item_id):
+        accumulator = accumulators.pop(item_id, None) or ResponseAccumulator(item_id)
+        return accumulator.result()
+
+    for verification in verifications:
+        item_id = verification["id"]
+        pos = position.get(item_id)
+        if pos is None:
+            continue
+        if pos < next_pos:
+            raise ValueError(f"Verifications of id {item_id} are not contiguous or not in input order.")
+        if item_id not in accumulators:
+            accumulators[item_id] = ResponseAccumulator(item_id)
+        accumulators[item_id].add(verification)
+        # Every id before this one has all its claims, unless it is repeated in the dataset
+        frontier = max(frontier, pos)
+        while next_pos < frontier and order[next_pos] not in repeated:
+            yield emit(order[next_pos])
+            next_pos += 1
+
+    for item_id in order[next_pos:]:
+        yield emit(item_id)
+
+
+class DatasetSummary:
+    """Dataset-level statistics over response records from `aggregate_stream`."""
+    def __init__(self):
+        self.n_responses, self.n_scored_responses, self.response_score_sum = 0, 0, 0.0
+        self.n_claims, self.n_scored_claims, self.claim_score_sum, self.n_unsupported = 0, 0, 0.0, 0
+        self.n_sentences, self.n_scored_sentences, self.sentence_score_sum = 0, 0, 0.0
+        self.n_support_probs, self.support_prob_sum = 0, 0.0
+
+    def add(self, record: Dict[str, Any]):
+        self.n_responses += 1
+        if record.get("score") is not None:
+            self.n_scored_responses += 1
+            self.response_score_sum += record["score"]
+        for claim in record.get("claims", []):
+            self.n_claims += 1
+            if claim.get("score") is not None:
+                self.n_scored_claims += 1
+                self.claim_score_sum += claim["score"]
+                self.n_unsupported += _is_unsupported(claim["score"])
+            if claim.get("support_prob") is not None:
+                self.n_support_probs += 1
+                self.support_prob_sum += claim["support_prob"]
+        for sentence in record.get("sentences", []):
+            self.n_sentences += 1
+            if sentence.get("score") is not None:
+                self.n_scored_sentences += 1
+                self.sentence_score_sum += sentence["score"]
+
+    def track(self, records: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Adds each record to the summary while passing it through."""
+        for record in records:
+            self.add(record)
+            yield record
+
+    def to_dict(self) -> Dict[str, Any]:
+        summary = {
+            "responses": self.n_responses,
+            "responses_without_claims": self.n_responses - self.n_scored_responses,
+            "claims": self.n_claims,
+            "unsupported_claims": self.n_unsupported,
+            "unsupported_claim_rate": _mean(self.n_unsupported, self.n_scored_claims),
+            # Mean of the response scores, and mean over all claims (responses weighted by their claims)
+            "mean_response_score": _mean(self.response_score_sum, self.n_scored_responses),
+            "mean_claim_score": _mean(self.claim_score_sum, self.n_scored_claims),
+            "sentences_with_claims": self.n_sentences,
+            "mean_sentence_score": _mean(self.sentence_score_sum, self.n_scored_sentences),
+        }
+        if self.n_support_probs:
+            summary["mean_support_prob"] = self.support_prob_sum / self.n_support_probs
+            summary["n_support_probs"] = self.n_support_probs
+        return summary
+
+
+def write_summary(output_dir: str, summary: DatasetSummary) -> str:
+    path = os.path.join(output_dir, SUMMARY_FILE)
+    with open(path, "w") as f:
+        json.dump(summary.to_dict(), f, indent=2)
+    return path
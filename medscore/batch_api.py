@@ -0,0 +1,215 @@
+"""
+Offline submission of chat completion requests through an OpenAI-compatible batch API.
+
+With `batch_api`, a component's `complete_all` sends no live requests. Instead, it
+
+1. writes the prepared requests to `work_dir/<component>-<key>.requests.jsonl`, one
+   `{"custom_id", "method", "url", "body"}` line per request,
+2. uploads the file and creates a batch (`/v1/files`, `/v1/batches`),
+3. polls the batch every `poll_interval` seconds until it ends, and
+4. downloads its output and error files and maps every result back to its request by `custom_id`.
+
+`<key>` is a hash of the server and the requests. The batch id is saved next to the request
+file (`.batch.json`) as soon as the batch is created, so a restarted run, which prepares the
+same requests, resumes polling that batch instead of submitting (and paying for) it again.
+Requests that failed or expired are submitted again in a new batch, up to `max_resubmits`
+times. If some still fail, `complete_all` raises, as a failed live request does, and the
+last batch is not resumed after a restart, so only its requests are submitted again.
+
+`medscore batch-server` (see `medscore.batch_server`) is a local stand-in for the batch API
+that runs the requests on any OpenAI-compatible server.
+"""
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from openai import AsyncOpenAI
+from openai.types.chat.chat_completion import ChatCompletion
+from tqdm import tqdm
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Batch statuses after which the batch does not change anymore
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def read_results(content: str) -> Dict[str, Dict[str, Any]]:
+    """Result lines of a batch output or error file, by `custom_id`."""
+    results = {}
+    for line in content.splitlines():
+        if line.strip():
+            result = json.loads(line)
+            results[result["custom_id"]] = result
+    return results
+
+
+def failed_completion(custom_id: str, model: str) -> ChatCompletion:
+    """A completion without choices, for a request that has no successful result."""
+    return ChatCompletion.model_construct(id=custom_id, choices=[], created=0, model=model, object="chat.completion")
+
+
+class BatchSubmitter:
+    """Runs the requests of `LLMComponent.complete_all` as batches of the batch API of `client`."""
+    def __init__(
+            self,
+            client: AsyncOpenAI,
+            work_dir: str = "batch_requests",
+            poll_interval: float = 30.0,
+            completion_window: str = "24h",
+            max_requests_per_batch: int = 50000,
+            max_resubmits: int = 2,
+    ):
+        self.client = client
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.max_requests_per_batch = max_requests_per_batch
+        self.max_resubmits = max_resubmits
+
+    async def complete_all(self, bodies: List[Dict[str, Any]], component_name: str, desc: str = "") -> List[ChatCompletion]:
+        """Completions of the request `bodies`, in input order. Large inputs are split into several batches."""
+        chunks = [bodies[i:i + self.max_requests_per_batch] for i in range(0, len(bodies), self.max_requests_per_batch)]
+        results = await asyncio.gather(*(
+            self.run_with_resubmits(chunk, component_name, desc if len(chunks) == 1 else f"{desc} {i + 1}/{len(chunks)}")
+            for i, chunk in enumerate(chunks)
+        ))
+        return [completion for chunk in results for completion in chunk]
+
+    async def run_with_resubmits(self, bodies: List[Dict[str, Any]], component_name: str, desc: str) -> List[ChatCompletion]:
+        """Runs the requests as one batch, and the failed ones again in new batches. Raises if some still fail."""
+        completions, state_file = await self.run_batch(bodies, component_name, desc)
+        failed = [i for i, completion in enumerate(completions) if not completion.choices]
+        for attempt in range(1, self.max_resubmits + 1):
+            if not failed:
+                break
+            metrics.increment(f"{component_name}.batch_resubmits", len(failed))
+            resubmitted, state_file = await self.run_batch([bodies[i] for i in failed], component_name,
+                                                           f"{desc} (resubmit {attempt})", attempt=attempt)
+            for i, completion in zip(failed, resubmitted):
+                completions[i] = completion
+            failed = [i for i in failed if not completions[i].choices]
+        if failed:
+            # A restart (e.g. after fixing the server) submits the failed requests again instead of resuming
+            os.remove(state_file)
+            raise RuntimeError(f"{desc}: {len(failed)} of {len(bodies)} batch requests failed after "
+                               f"{self.max_resubmits} resubmissions. Run again to resubmit them.")
+        return completions
+
+    async def run_batch(
+            self,
+            bodies: List[Dict[str, Any]],
+            component_name: str,
+            desc: str,
+            attempt: int = 0,
+    ) -> Tuple[List[ChatCompletion], str]:
+        """
+        Completions of the `bodies` from one batch (without choices for failed requests), and
+        the batch's state file.
+        """
+        lines = [json.dumps({"custom_id": f"request-{i}", "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                            sort_keys=True) for i, body in enumerate(bodies)]
+        content = ("\n".join(lines) + "\n").encode("utf-8")
+        key = hashlib.sha256(str(self.client.base_url).encode("utf-8") + content).hexdigest()[:16]
+        # Resubmissions of all requests of a batch have the same content, but must not resume it
+        suffix = f"-resubmit{attempt}" if attempt else ""
+        prefix = os.path.join(self.work_dir, f"{component_name.replace('.', '_')}-{key}{suffix}")
+        state_file = f"{prefix}.batch.json"
+
+        state = self.load_state(state_file)
+        if state is None:
+            state = await self.submit(f"{prefix}.requests.jsonl", content, state_file, len(bodies))
+            logger.info(f"{desc}: submitted {len(bodies)} requests as batch {state['batch_id']} ({state_file})")
+        else:
+            logger.info(f"{desc}: resuming batch {state['batch_id']} ({state_file})")
+        batch = await self.wait(state["batch_id"], desc)
+        if batch.status == "failed":
+            # Nothing ran, so a restart should submit the batch again
+            os.remove(state_file)
+            errors = [e.message for e in (batch.errors.data or [])] if batch.errors else []
+            raise RuntimeError(f"Batch {batch.id} failed: {'; '.join(str(e) for e in errors) or 'no details'}")
+
+        results = {}
+        for file_id in (batch.error_file_id, batch.output_file_id):
+            if file_id:
+                response = await self.client.files.content(file_id)
+                results.update(read_results(response.text))
+        completions = self.to_completions(results, len(bodies), bodies[0].get("model", "") if bodies else "",
+                                          component_name, batch.id)
+        return completions, state_file
+
+    @staticmethod
+    def load_state(state_file: str) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(state_file):
+            return None
+        with open(state_file) as f:
+            return json.load(f)
+
+    async def submit(self, request_file: str, content: bytes, state_file: str, n_requests: int) -> Dict[str, Any]:
+        """Uploads the request file and creates the batch. Returns the saved batch state."""
+        os.makedirs(self.work_dir, exist_ok=True)
+        with open(request_file, "wb") as f:
+            f.write(content)
+        uploaded = await self.client.files.create(file=(os.path.basename(request_file), content), purpose="batch")
+        batch = await self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+            metadata={"source": "medscore", "request_file": os.path.basename(request_file)},
+        )
+        state = {"batch_id": batch.id, "input_file_id": uploaded.id, "server_path": str(self.client.base_url),
+                 "n_requests": n_requests}
+        tmp_file = f"{state_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_file, state_file)
+        metrics.increment("batch_api.batches")
+        return state
+
+    async def wait(self, batch_id: str, desc: str):
+        """Polls the batch until it has a final status."""
+        progress = tqdm(desc=desc, ncols=80)
+        try:
+            while True:
+                batch = await self.client.batches.retrieve(batch_id)
+                counts = batch.request_counts
+                if counts is not None:
+                    progress.total = counts.total
+                    progress.n = counts.completed + counts.failed
+                    progress.refresh()
+                if batch.status in FINAL_STATUSES:
+                    return batch
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            progress.close()
+
+    @staticmethod
+    def to_completions(
+            results: Dict[str, Dict[str, Any]],
+            n_requests: int,
+            model: str,
+            component_name: str,
+            batch_id: str,
+    ) -> List[ChatCompletion]:
+        completions, errors = [], []
+        for i in range(n_requests):
+            custom_id = f"request-{i}"
+            result = results.get(custom_id) or {}
+            response = result.get("response") or {}
+            if response.get("status_code") == 200 and response.get("body"):
+                completion = ChatCompletion.model_validate(response["body"])
+                metrics.record_completion(component_name, None, completion)
+            else:
+                completion = failed_completion(custom_id, model)
+                error = result.get("error") or (response.get("body") or {}).get("error") or {"message": "No result"}
+                errors.append(error.get("message", error) if isinstance(error, dict) else error)
+            completions.append(completion)
+        metrics.increment(f"{component_name}.batch_failures", len(errors))
+        if errors:
+            logger.warning(f"{len(errors)} of {n_requests} requests of batch {batch_id} failed, e.g.: {errors[0]}")
+        return completions
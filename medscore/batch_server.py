@@ -0,0 +1,312 @@
+"""
+Local stand-in for the OpenAI batch API.
+
+Serves the file and batch endpoints that `batch_api` uses, and runs every batch by sending its
+requests to an OpenAI-compatible `--upstream` server (e.g. vLLM, or a test server),
+`--concurrency` at a time. Use it to try a `batch_api` config locally, or to run batch jobs
+on your own server:
+
+    medscore batch-server --upstream http://localhost:8000/v1 --port 8100
+
+and set `server_path: "http://localhost:8100/v1"` and a `batch_api` section in the config.
+
+Files and batches are kept in `--work_dir`. When the server is restarted, batches that had
+not finished are run again from the start.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from .batch_api import BATCH_ENDPOINT, FINAL_STATUSES
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logger = logging.getLogger(__name__)
+
+# Seconds until an unfinished batch expires, by completion window
+_COMPLETION_WINDOWS = {"24h": 24 * 3600}
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}-{uuid.uuid4().hex[:24]}"
+
+
+class BatchStore:
+    """Files and batches in `work_dir`, and the worker threads that run the batches."""
+    def __init__(self, work_dir: str, upstream: str, api_key: Optional[str] = None, concurrency: int = 16,
+                 request_timeout: float = 600.0):
+        self.work_dir = work_dir
+        self.upstream = upstream.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.concurrency = concurrency
+        self.request_timeout = request_timeout
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        for directory in ("files", "batches"):
+            os.makedirs(os.path.join(work_dir, directory), exist_ok=True)
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        for name in os.listdir(os.path.join(work_dir, "batches")):
+            if name.endswith(".tmp"):
+                continue
+            with open(os.path.join(work_dir, "batches", name)) as f:
+                batch = json.load(f)
+            self.batches[batch["id"]] = batch
+            if batch["status"] not in FINAL_STATUSES:
+                logger.info(f"Restarting unfinished batch {batch['id']}")
+                self.start(batch["id"])
+
+    def _path(self, kind: str, object_id: str) -> str:
+        if not re.fullmatch(r"[\w-]+", object_id):
+            raise KeyError(object_id)
+        return os.path.join(self.work_dir, kind, object_id)
+
+    # --- Files ---
+    def add_file(self, filename: str, purpose: str, content: bytes) -> Dict[str, Any]:
+        record = {"id": _new_id("file"), "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                  "filename": filename, "purpose": purpose, "status": "processed"}
+        with open(self._path("files", record["id"]), "wb") as f:
+            f.write(content)
+        with open(self._path("files", record["id"]) + ".json", "w") as f:
+            json.dump(record, f)
+        return record
+
+    def get_file(self, file_id: str) -> Dict[str, Any]:
+        path = self._path("files", file_id) + ".json"
+        if not os.path.exists(path):
+            raise KeyError(file_id)
+        with open(path) as f:
+            return json.load(f)
+
+    def file_content(self, file_id: str) -> bytes:
+        self.get_file(file_id)
+        with open(self._path("files", file_id), "rb") as f:
+            return f.read()
+
+    # --- Batches ---
+    def _save(self, batch: Dict[str, Any]):
+        path = self._path("batches", batch["id"])
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(batch, f)
+        os.replace(f"{path}.tmp", path)
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str,
+                     metadata: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        self.get_file(input_file_id)
+        if endpoint != BATCH_ENDPOINT:
+            raise ValueError(f"Unsupported endpoint {endpoint!r}. Only {BATCH_ENDPOINT} is supported.")
+        now = int(time.time())
+        batch = {
+            "id": _new_id("batch"), "object": "batch", "endpoint": endpoint, "errors": None,
+            "input_file_id": input_file_id, "completion_window": completion_window, "status": "validating",
+            "output_file_id": None, "error_file_id": None, "created_at": now, "in_progress_at": None,
+            "expires_at": now + _COMPLETION_WINDOWS.get(completion_window, 24 * 3600), "finalizing_at": None,
+            "completed_at": None, "failed_at": None, "expired_at": None, "cancelling_at": None, "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": metadata,
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+            self._save(batch)
+        self.start(batch["id"])
+        return batch
+
+    def get_batch(self, batch_id: str) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.batches[batch_id])
+
+    def cancel_batch(self, batch_id: str) -> Dict[str, Any]:
+        with self._lock:
+            batch = self.batches[batch_id]
+            if batch["status"] not in FINAL_STATUSES:
+                batch["status"], batch["cancelling_at"] = "cancelling", int(time.time())
+                self._save(batch)
+            return dict(batch)
+
+    def start(self, batch_id: str):
+        threading.Thread(target=self.run, args=(batch_id,), name=f"batch-{batch_id}", daemon=True).start()
+
+    def _update(self, batch: Dict[str, Any], **fields):
+        with self._lock:
+            batch.update(fields)
+            self._save(batch)
+
+    def forward(self, request: Dict[str, Any]) -> Tuple[Optional[int], Any]:
+        """Sends one request upstream. Returns the status code (None if there was no response) and the body."""
+        if request.get("url") != BATCH_ENDPOINT:
+            return 400, {"error": {"message": f"Unsupported url {request.get('url')!r}", "type": "invalid_request_error"}}
+        try:
+            response = self._session.post(f"{self.upstream}/chat/completions", json=request.get("body"),
+                                          headers=self.headers, timeout=self.request_timeout)
+        except requests.RequestException as e:
+            return None, str(e)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, {"error": {"message": response.text}}
+
+    def run(self, batch_id: str):
+        batch = self.batches[batch_id]
+        try:
+            lines = self.file_content(batch["input_file_id"]).decode("utf-8").splitlines()
+            batch_requests = [json.loads(line) for line in lines if line.strip()]
+        except (KeyError, ValueError) as e:
+            self._update(batch, status="failed", failed_at=int(time.time()), errors={"object": "list", "data": [
+                {"code": "invalid_input_file", "message": str(e), "param": None, "line": None}]})
+            return
+        self._update(batch, status="in_progress", in_progress_at=int(time.time()),
+                     request_counts={"total": len(batch_requests), "completed": 0, "failed": 0})
+
+        outputs: List[Dict[str, Any]] = []
+        errors: List[Dict[str, Any]] = []
+
+        def process(request):
+            if batch["status"] == "cancelling":
+                return request, None, "Batch cancelled"
+            return (request, *self.forward(request))
+
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for request, status, body in pool.map(process, batch_requests):
+                result = {"id": _new_id("batch_req"), "custom_id": request.get("custom_id"), "response": None,
+                          "error": None}
+                if status is not None:
+                    result["response"] = {"status_code": status, "request_id": _new_id("req"), "body": body}
+                if status == 200:
+                    outputs.append(result)
+                else:
+                    if status is None:
+                        result["error"] = {"code": "request_failed", "message": body}
+                    errors.append(result)
+                with self._lock:
+                    batch["request_counts"] = {"total": len(batch_requests), "completed": len(outputs),
+                                               "failed": len(errors)}
+
+        self._update(batch, status="finalizing", finalizing_at=int(time.time()))
+        fields = {}
+        for key, results in (("output_file_id", outputs), ("error_file_id", errors)):
+            if results:
+                content = "".join(json.dumps(r) + "\n" for r in results).encode("utf-8")
+                fields[key] = self.add_file(f"{batch_id}_{key[:-8]}.jsonl", f"batch_{key[:-8]}", content)["id"]
+        if batch["status"] == "cancelling":
+            fields.update(status="cancelled", cancelled_at=int(time.time()))
+        else:
+            fields.update(status="completed", completed_at=int(time.time()))
+        self._update(batch, **fields)
+        logger.info(f"Batch {batch_id} {fields['status']}: {len(outputs)} completed, {len(errors)} failed")
+
+
+class BatchRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /v1/files                  Upload a file (multipart: `file`, `purpose`)
+    GET  /v1/files/{id}[/content]
+    POST /v1/batches                {"input_file_id", "endpoint", "completion_window", "metadata"}
+    GET  /v1/batches/{id}
+    POST /v1/batches/{id}/cancel
+    """
+    store: BatchStore = None
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        try:
+            if match := re.search(r"/files/([^/]+)/content$", path):
+                self._send(200, self.store.file_content(match.group(1)), "application/octet-stream")
+            elif match := re.search(r"/files/([^/]+)$", path):
+                self._send_json(200, self.store.get_file(match.group(1)))
+            elif match := re.search(r"/batches/([^/]+)$", path):
+                self._send_json(200, self.store.get_batch(match.group(1)))
+            else:
+                self._send_json(404, {"error": {"message": f"Unknown path: {path}"}})
+        except KeyError as e:
+            self._send_json(404, {"error": {"message": f"Not found: {e}"}})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if path.endswith("/files"):
+                fields = self._parse_multipart(body)
+                filename, content = fields["file"]
+                self._send_json(200, self.store.add_file(filename, fields.get("purpose", (None, b"batch"))[1].decode(), content))
+            elif path.endswith("/batches"):
+                request = json.loads(body)
+                if "input_file_id" not in request or "endpoint" not in request:
+                    raise ValueError("input_file_id and endpoint are required.")
+                self._send_json(200, self.store.create_batch(
+                    request["input_file_id"], request["endpoint"], request.get("completion_window", "24h"),
+                    request.get("metadata")))
+            elif match := re.search(r"/batches/([^/]+)/cancel$", path):
+                self._send_json(200, self.store.cancel_batch(match.group(1)))
+            else:
+                self._send_json(404, {"error": {"message": f"Unknown path: {path}"}})
+        except KeyError as e:
+            self._send_json(404, {"error": {"message": f"Not found: {e}"}})
+        except ValueError as e:
+            self._send_json(400, {"error": {"message": str(e)}})
+
+    def _parse_multipart(self, body: bytes) -> Dict[str, Tuple[Optional[str], bytes]]:
+        """Form fields of a multipart body, as (filename, content) by name."""
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        message = BytesParser(policy=policy.HTTP).parsebytes(header + body)
+        if not message.is_multipart():
+            raise ValueError("Expected a multipart/form-data upload.")
+        return {part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+                for part in message.iter_parts()}
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        self._send(status, json.dumps(payload).encode(), "application/json")
+
+    def _send(self, status: int, data: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = ArgumentParser(prog="medscore batch-server",
+                            description="Serve a local stand-in for the OpenAI batch API, backed by an OpenAI-compatible server.")
+    parser.add_argument("--upstream", type=str, required=True, help="OpenAI-compatible server that runs the requests, e.g. http://localhost:8000/v1.")
+    parser.add_argument("--api_key", type=str, default=os.environ.get("OPENAI_API_KEY"), help="API key of the upstream server (default: $OPENAI_API_KEY).")
+    parser.add_argument("--work_dir", type=str, default="batch_server", help="Directory for the files and batches.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind to.")
+    parser.add_argument("--port", type=int, default=8100, help="Port to bind to.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Upstream requests in flight per batch.")
+    parser.add_argument("--request_timeout", type=float, default=600, help="Seconds before an upstream request times out.")
+    parser.add_argument("--debug", action="store_true", help="Print debug logs.")
+    return parser.parse_args()
+
+
+def main():
+    """Entry point for `medscore batch-server`."""
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+    args = parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    BatchRequestHandler.store = BatchStore(args.work_dir, args.upstream, api_key=args.api_key,
+                                           concurrency=args.concurrency, request_timeout=args.request_timeout)
+    server = ThreadingHTTPServer((args.host, args.port), BatchRequestHandler)
+    logger.info(f"Batch API stand-in listening on http://{args.host}:{args.port}/v1 (upstream: {args.upstream})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+The `medscore` command.
+
+    medscore --config config.yaml [options]     Run MedScore (same as `python -m medscore.medscore`)
+    medscore merge --config config.yaml ...     Merge the outputs of a sharded run
+    medscore encoder-check --backend ...        Compare a query encoder backend with the PyTorch encoder
+    medscore hnsw-sweep --queries ...           Measure HNSW recall@k and latency for several settings
+    medscore retrieval-bench ...                Time the retrieval components on a synthetic corpus
+    medscore retrieve --config config.yaml      Retrieve MedRAG evidence for the decomposed claims ahead of verification
+    medscore batch-server --upstream ...        Serve a local stand-in for the OpenAI batch API
+"""
+import sys
+import importlib
+
+from .medscore import main as score_main
+
+# Sub-command -> module with a `main()` entry point
+COMMANDS = {
+    "merge": "medscore.shard",
+    "encoder-check": "medscore.query_encoder",
+    "hnsw-sweep": "medscore.hnsw_sweep",
+    "retrieval-bench": "medscore.retrieval_bench",
+    "retrieve": "medscore.retrieve",
+    "batch-server": "medscore.batch_server",
+}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        command = sys.argv.pop(1)
+        sys.argv[0] = f"medscore {command}"
+        importlib.import_module(COMMANDS[command]).main()
+    else:
+        score_main()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,49 @@
 """
 Pydantic schemas for MedScore configuration validation, using discriminated unions.
 """
-from typing import Literal, Optional, Union, Dict
+from typing import Literal, Optional, Union, Dict, List
 from pydantic import BaseModel, Field, FilePath, SecretStr
 
 
 # --- Base Models for Shared Parameters ---
 
+class HTTPPoolConfig(BaseModel):
+    """Connection pool of the HTTP client shared by all components with the same server_path."""
+    max_connections: int = Field(100, ge=1)
+    max_keepalive_connections: int = Field(32, ge=0)
+    # Seconds an idle connection is kept open
+    keepalive_expiry: float = Field(120.0, ge=0)
+    # Requires `pip install "httpx[http2]"`
+    http2: bool = False
+    timeout: float = Field(600.0, gt=0)
+    connect_timeout: float = Field(5.0, gt=0)
+
+
+class HedgingConfig(BaseModel):
+    """Send a second copy of requests that are slower than a percentile of the recent latencies."""
+    percentile: float = Field(95.0, gt=0, lt=100)
+    # Hedges per request, at most
+    max_rate: float = Field(0.05, ge=0, le=1)
+    # Latencies observed before the first hedge
+    min_samples: int = Field(20, ge=1)
+    # Server for the hedged copies (default: the component's server_path), serving the same model
+    server_path: Optional[str] = None
+    api_key: Optional[SecretStr] = None
+
+
+class BatchAPIConfig(BaseModel):
+    """Submit the requests to the server's batch API (`/v1/batches`) instead of sending them live."""
+    # Request files and the ids of submitted batches, to resume polling after a restart
+    work_dir: str = "batch_requests"
+    # Seconds between status checks
+    poll_interval: float = Field(30.0, gt=0)
+    completion_window: str = "24h"
+    # Larger inputs are split into several batches (OpenAI allows up to 50,000 requests per batch)
+    max_requests_per_batch: int = Field(50000, ge=1)
+    # Failed or expired requests are submitted again in a new batch up to this many times
+    max_resubmits: int = Field(2, ge=0)
+
+
 class DecomposerSharedConfig(BaseModel):
     """Shared configuration for all decomposer models."""
     model_name: str = "gpt-4o-mini"
@@ -14,6 +51,21 @@ class DecomposerSharedConfig(BaseModel):
     api_key: Optional[SecretStr] = None
     random_state: int = 42
     batch_size: int = 32
+    # Constrain the output to a JSON schema: "json_schema" (OpenAI structured outputs, also vLLM)
+    # or "guided_json" (vLLM guided decoding). "none" parses the free-text output.
+    structured_output: Literal["none", "json_schema", "guided_json"] = "none"
+    # Re-request unparsable completions up to this many times (only the failed items).
+    # Default: 2 with structured_output, 0 (no retries) for free-text output.
+    max_parse_retries: Optional[int] = Field(None, ge=0)
+    # Send one request per unique (prompt, context, sentence) and share its claims with all duplicates
+    deduplicate: bool = True
+    http_pool: HTTPPoolConfig = Field(default_factory=HTTPPoolConfig)
+    # Hedged requests (disabled if not set)
+    hedging: Optional[HedgingConfig] = None
+    # Send the requests with the longest expected time first ("input": in input order)
+    dispatch_order: Literal["longest_first", "input"] = "longest_first"
+    # Offline batch submission (disabled if not set: requests are sent live)
+    batch_api: Optional[BatchAPIConfig] = None
 
 
 class VerifierSharedConfig(BaseModel):
@@ -23,6 +75,17 @@ class VerifierSharedConfig(BaseModel):
     api_key: Optional[SecretStr] = None
     random_state: int = 42
     batch_size: int = 32
+    # "short_answer" limits the output to a single True/False answer instead of free-form text
+    answer_mode: Literal["free_text", "short_answer"] = "free_text"
+    # In short_answer mode, request token logprobs to compute `support_prob` (if the backend supports it)
+    logprobs: bool = True
+    # As for the decomposer. Answers that are neither True nor False are retried.
+    structured_output: Literal["none", "json_schema", "guided_json"] = "none"
+    max_parse_retries: Optional[int] = Field(None, ge=0)
+    http_pool: HTTPPoolConfig = Field(default_factory=HTTPPoolConfig)
+    hedging: Optional[HedgingConfig] = None
+    dispatch_order: Literal["longest_first", "input"] = "longest_first"
+    batch_api: Optional[BatchAPIConfig] = None
 
 
 # --- Decomposer Models ---
@@ -50,7 +113,10 @@ class InternalVerifierConfig(VerifierSharedConfig):
 
 class ProvidedEvidenceVerifierConfig(VerifierSharedConfig):
     type: Literal["provided"] = "provided"
+    # A {"{id}": "{evidence}"} JSON file, or an indexed JSONL/SQLite store (see medscore/evidence_store.py)
     provided_evidence_path: FilePath
+    # Where to write the evidence index / converted store (default: next to the evidence file)
+    evidence_index_dir: Optional[str] = None
 
 
 class MedRAGVerifierConfig(VerifierSharedConfig):
@@ -59,8 +125,43 @@ class MedRAGVerifierConfig(VerifierSharedConfig):
     corpus_name: str = "StatPearls"
     db_dir: Optional[str] = None
     HNSW: bool = False
+    # HNSW graph degree and build-time candidate list size (used when the index is built),
+    # and query-time candidate list size (None: FAISS default). See `medscore hnsw-sweep`.
+    hnsw_m: int = 32
+    hnsw_ef_construction: int = 40
+    hnsw_ef_search: Optional[int] = None
+    # Two-stage retrievers ("MedCPT-BM25", "MedCPT-IVFPQ"): candidates per claim that are rescored
+    # exactly, and the number of IVF lists searched by "MedCPT-IVFPQ"
+    n_candidates: int = 100
+    coarse_nprobe: int = 16
     cache: bool = False
     n_returned_docs: int = 5
+    # Query encoder inference backend: "torch", "torch_int8", "onnx" or "onnx_int8" (see medscore/query_encoder.py)
+    query_encoder_backend: Literal["torch", "torch_int8", "onnx", "onnx_int8"] = "torch"
+    # Claims per retrieval call, and query encoder batch size / max tokens (independent of the LLM batch_size)
+    retrieval_batch_size: int = 256
+    encoder_batch_size: int = 32
+    encoder_max_length: Optional[int] = None
+    # Evidence store written by `medscore retrieve`. If set, claims are looked up there instead of
+    # being retrieved, and the corpus, FAISS and torch are not needed (see medscore/retrieve.py).
+    pre_retrieved_path: Optional[str] = None
+
+
+class CascadeVerifierConfig(VerifierSharedConfig):
+    """The shared fields configure the expensive model, which only verifies uncertain claims."""
+    type: Literal["cascade"] = "cascade"
+    # The cheap verifier that runs on every claim. It also collects the evidence.
+    first_stage: Union[
+        InternalVerifierConfig,
+        ProvidedEvidenceVerifierConfig,
+        MedRAGVerifierConfig,
+    ] = Field(..., discriminator="type")
+    # Escalate claims whose first-stage max(support_prob, 1 - support_prob) is below this
+    confidence_threshold: float = Field(0.9, ge=0.5, le=1.0)
+    # Other cheap models (on the first-stage server); escalate claims they answer differently
+    agreement_models: List[str] = []
+    # Fraction of confident claims also verified by the expensive model, to measure agreement
+    audit_rate: float = Field(0.0, ge=0.0, le=1.0)
 
 
 # --- Create the Discriminated Unions ---
@@ -76,6 +177,7 @@ VerifierConfig = Union[
     InternalVerifierConfig,
     ProvidedEvidenceVerifierConfig,
     MedRAGVerifierConfig,
+    CascadeVerifierConfig,
 ]
 
 
@@ -87,9 +189,12 @@ class MedScoreConfig(BaseModel):
     # from the Union defined above.
     decomposer: DecomposerConfig = Field(..., discriminator="type")
     verifier: VerifierConfig = Field(..., discriminator="type")
-    input_file: str
-    output_dir: str
+    # Optional so that a config can also be used for the scoring service (medscore.server)
+    input_file: Optional[str] = None
+    output_dir: Optional[str] = None
     response_key: str = "response"
+    # File format of decompositions/verifications/output: "jsonl", "jsonl.zst" (zstd-compressed) or "parquet"
+    output_format: Literal["jsonl", "jsonl.zst", "parquet"] = "jsonl"
     # If True, MedScore will expect each input record to include a pre-senticized
     # list of sentence objects under the key "sentences" and will use those
     # instead of running its internal sentence-splitting (senticizing) step.
@@ -1,60 +1,83 @@
 """
 Decomposer
 """
-import os
 from functools import partial
-import asyncio
-from typing import List, Any, Optional, Dict
+from typing import List, Any, Optional, Dict, Tuple
 import ast
+import json
+import hashlib
 import logging
 
-import jsonlines
-from tqdm import tqdm
-import backoff
-import requests
-from openai import AsyncOpenAI
 from openai.types.chat.chat_completion import ChatCompletion
-import nest_asyncio
 from registrable import Registrable
 
-from .utils import process_claim, parse_sentences, chunker
+from .utils import process_claim
 from .prompts import MEDSCORE_PROMPT, FACTSCORE_PROMPT, DND_PROMPT
+from .metrics import metrics
+from .llm import LLMComponent, ParseError, run_sync
 
 logger = logging.getLogger(__name__)
-nest_asyncio.apply()
 
 
-class Decomposer(Registrable):
+class Decomposer(LLMComponent, Registrable):
     """Base class for all decomposers."""
+    component_name = "decomposer"
+    output_schema = {
+        "type": "object",
+        "properties": {"claims": {"type": "array", "items": {"type": "string"}}},
+        "required": ["claims"],
+        "additionalProperties": False,
+    }
+    structured_instruction = 'Respond in JSON: {"claims": ["<fact>", ...]}'
+
+    def __init__(self, *args, deduplicate: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deduplicate = deduplicate
 
-    def __init__(
-            self,
-            server_path: str,
-            model_name: str,
-            api_key: Optional[str] = None,
-            random_state: int = 42,
-            batch_size: int = 32,
-            **kwargs,  # To allow for extra params from config
-    ):
-        api_key = api_key or os.environ.get("OPENAI_API_KEY")
-        self.client = AsyncOpenAI(
-            base_url=server_path,
-            api_key=api_key,
-        )
-        self.model_name = model_name
-        self.random_state = random_state
-        self.batch_size = batch_size
+    def __call__(self, decomp_input: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return run_sync(self.adecompose(decomp_input))
 
-        self.agent = partial(
-            self.client.chat.completions.create,
-            model=self.model_name,
-            seed=self.random_state,
-            temperature=0.0,
-            top_p=1.0,
-            max_tokens=256
-        )
+    async def adecompose(self, decomp_input: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Async version of `__call__`. Safe to await from any running event loop."""
+        # One request per unique (prompt, context, sentence), shared by all its occurrences
+        unique_input, unique_index = self.deduplicate_input(decomp_input)
+        messages = [self.add_structured_instruction(m) for m in self.prepare_messages(unique_input)]
 
-    def __call__(self, decomp_input: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Async calls with at most batch_size requests in flight. Unparsable completions are retried.
+        with metrics.stage("decomposer.requests"):
+            unique_completions = await self.complete_all_validated(messages, self.validate_completion, desc="Decompose")
+
+        # Format claims
+        with metrics.stage("decomposer.parsing"):
+            all_completions = [unique_completions[i] for i in unique_index]
+            decompositions = self.format_completions(decomp_input, all_completions)
+        return decompositions
+
+    def input_key(self, d_input: Dict[str, Any]) -> str:
+        """Canonical key of a decomposer input: the prompt and the whitespace-normalized context and sentence."""
+        key = [type(self).__name__, self.get_system_prompt(), " ".join(d_input["context"].split()),
+               " ".join(d_input["sentence"].split())]
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def deduplicate_input(self, decomp_input: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[int]]:
+        """The unique inputs, and for every input the index of its unique input."""
+        if not self.deduplicate:
+            return decomp_input, list(range(len(decomp_input)))
+        unique_input, key_to_index, unique_index = [], {}, []
+        for d_input in decomp_input:
+            key = self.input_key(d_input)
+            if key not in key_to_index:
+                key_to_index[key] = len(unique_input)
+                unique_input.append(d_input)
+            unique_index.append(key_to_index[key])
+        metrics.increment("decomposer.inputs", len(decomp_input))
+        metrics.increment("decomposer.unique_inputs", len(unique_input))
+        if len(unique_input) < len(decomp_input):
+            logger.info(f"Deduplicated {len(decomp_input)} sentences to {len(unique_input)} decomposer requests "
+                        f"({1 - len(unique_input) / len(decomp_input):.1%} saved)")
+        return unique_input, unique_index
+
+    def prepare_messages(self, decomp_input: List[Dict[str, Any]]) -> List[List[Dict[str, str]]]:
         # Prepare prompt and user input
         messages = []
         for d in decomp_input:
@@ -69,24 +92,43 @@ class Decomposer(Registrable):
                 messages.append([
                     {"role": "user", "content": formatted_input}
                 ])
-
-        # Async calls for batch_size items
-        all_completions = []
-        n_iter = (len(messages) + self.batch_size - 1) // self.batch_size
-        for batch in tqdm(chunker(messages, self.batch_size), desc="Decompose", total=n_iter, ncols=80):
-            completions = asyncio.run(self.batch_response(batch))
-            all_completions.extend(completions)
-
-        # Format claims
-        decompositions = self.format_completions(decomp_input, all_completions)
-        return decompositions
+        return messages
+
+    @staticmethod
+    def completion_text(completion: ChatCompletion) -> str:
+        if not completion.choices or completion.choices[0].message.content is None:
+            raise ParseError("Empty completion")
+        return completion.choices[0].message.content
+
+    def parse_structured(self, content: str) -> Any:
+        try:
+            output = json.loads(content)
+        except json.JSONDecodeError as e:
+            raise ParseError(f"Invalid JSON: {e}")
+        claims = output.get("claims") if isinstance(output, dict) else None
+        if not isinstance(claims, list) or not all(isinstance(c, str) for c in claims):
+            raise ParseError("Output has no list of string `claims`")
+        return claims
+
+    def validate_completion(self, completion: ChatCompletion):
+        """Raises `ParseError` if the completion cannot be parsed into claims."""
+        content = self.completion_text(completion)
+        if self.structured_output != "none":
+            self.parse_structured(content)
 
     def format_completions(self, decomp_input: List[Dict[str, Any]], completions: List[ChatCompletion]) -> List[
         Dict[str, Any]]:
         decompositions = []
         for d_input, completion in zip(decomp_input, completions):
-            claim_list = completion.choices[0].message.content.split("\n")
-            claim_list = process_claim(claim_list)
+            content = completion.choices[0].message.content if completion.choices else None
+            try:
+                if self.structured_output != "none":
+                    claim_list = [c.strip() for c in self.parse_structured(content or "") if c.strip()]
+                else:
+                    claim_list = process_claim((content or "").split("\n"))
+            except ParseError as e:
+                logger.warning(f"Invalid output for {d_input['id']=}, {d_input['sentence_id']=}: {e}\nOutput: {content}")
+                claim_list = []
             for idx, claim in enumerate(claim_list):
                 decomp = {k: v for k, v in d_input.items() if k != "context"}
                 decomp["claim"] = claim
@@ -98,17 +140,6 @@ class Decomposer(Registrable):
                 decompositions.append(decomp)
         return decompositions
 
-    @backoff.on_exception(
-        backoff.expo,
-        (requests.exceptions.RequestException, asyncio.TimeoutError),
-        max_time=60
-    )
-    async def batch_response(self, batch: List[List[Dict[str, str]]]) -> List[ChatCompletion]:
-        async_responses = [
-            self.agent(messages=x) for x in batch
-        ]
-        return await asyncio.gather(*async_responses)
-
     def format_input(self, context: str, sentence: str) -> str:
         raise NotImplementedError
 
@@ -156,6 +187,28 @@ class FActScoreDecomposer(Decomposer):
 
 @Decomposer.register("dndscore")
 class DnDScoreDecomposer(Decomposer):
+    output_schema = {
+        "type": "object",
+        "properties": {
+            "explanation": {"type": "string"},
+            "subclaims": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"subclaim": {"type": "string"}, "decontextualized": {"type": "string"}},
+                    "required": ["subclaim", "decontextualized"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["explanation", "subclaims"],
+        "additionalProperties": False,
+    }
+    structured_instruction = (
+        'Respond in JSON: {"explanation": "<explanation>", '
+        '"subclaims": [{"subclaim": "<subclaim>", "decontextualized": "<decontextualized subclaim>"}, ...]}'
+    )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Override self.agent to match settings from DnDScore
@@ -174,22 +227,40 @@ class DnDScoreDecomposer(Decomposer):
     def format_input(self, context: str, sentence: str) -> str:
         return DND_PROMPT.replace("[paragraph]", context).replace("[sentence]", sentence)
 
+    def parse_output(self, model_output: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """The explanation and the list of {"subclaim", "decontextualized"} dicts. Raises `ParseError`."""
+        try:
+            if self.structured_output != "none":
+                output = json.loads(model_output)
+                explanation, subclaim_dict = output["explanation"], output["subclaims"]
+            else:
+                extra, subclaim_str = [x.strip() for x in model_output.split("##CONTEXT-SUBCLAIM PAIRS##:")]
+                subclaim_str = subclaim_str.replace('\n', '').strip()
+                subclaim_dict = ast.literal_eval(subclaim_str)
+                explanation = extra.split("##EXPLANATION##:")[-1]
+            if not isinstance(subclaim_dict, list):
+                raise ValueError("Parsed subclaims is not a list.")
+            for claim_dict in subclaim_dict:
+                if not isinstance(claim_dict, dict) or "decontextualized" not in claim_dict or "subclaim" not in claim_dict:
+                    raise ValueError("Subclaim is missing the `subclaim` or `decontextualized` key.")
+        except (ValueError, SyntaxError, KeyError, TypeError) as e:
+            # json.JSONDecodeError is a ValueError
+            raise ParseError(str(e))
+        return explanation, subclaim_dict
+
+    def validate_completion(self, completion: ChatCompletion):
+        self.parse_output(self.completion_text(completion).strip())
+
     def format_completions(self, decomp_input: List[Dict[str, Any]], completions: List[ChatCompletion]) -> List[
         Dict[str, Any]]:
         decompositions = []
         for d_input, completion in zip(decomp_input, completions):
-            model_output = completion.choices[0].message.content.strip()
+            model_output = (completion.choices[0].message.content or "").strip() if completion.choices else ""
             try:
-                extra, subclaim_str = [x.strip() for x in model_output.split("##CONTEXT-SUBCLAIM PAIRS##:")]
-                subclaim_str = subclaim_str.replace('\n', '').strip()
-                subclaim_dict = ast.literal_eval(subclaim_str)
-                explanation = extra.split("##EXPLANATION##:")[-1]
+                explanation, subclaim_dict = self.parse_output(model_output)
 
                 decomp = {k: v for k, v in d_input.items() if k != "context"}
 
-                if not isinstance(subclaim_dict, list):
-                    raise ValueError("Parsed subclaims is not a list.")
-
                 for idx, claim_dict in enumerate(subclaim_dict):
                     new_decomp = decomp.copy()
                     new_decomp["claim"] = claim_dict["decontextualized"]
@@ -204,7 +275,7 @@ class DnDScoreDecomposer(Decomposer):
                     decomp["claim"] = None
                     decompositions.append(decomp)
 
-            except (ValueError, SyntaxError) as e:
+            except ParseError as e:
                 logger.warning(
                     f"Invalid dictionary for {d_input['id']=}, {d_input['sentence_id']=}: {e}\nOutput: {model_output}")
                 decomp = {k: v for k, v in d_input.items() if k != "context"}
@@ -0,0 +1,241 @@
+"""
+Indexed evidence stores for the `provided` verifier.
+
+Evidence is looked up by response `id` only for the ids being verified, so startup time and
+memory do not grow with the size of the evidence file. Supported `provided_evidence_path` files:
+
+- `.sqlite` / `.db`: A table `evidence(id TEXT PRIMARY KEY, evidence TEXT)` with JSON-encoded evidence.
+- `.jsonl`: One `{"id": ..., "evidence": ...}` record per line. An id -> byte offset index is
+  built once next to the file (`<name>.jsonl.idx.sqlite`), and the file is memory-mapped.
+- `.json`: A `{"{id}": "{evidence}"}` dict (the original format). It is converted once to
+  `<name>.json.evidence.sqlite`, which is used from then on.
+
+Indexes and converted stores are rebuilt when the source file changes (size or mtime), and are
+written to a temporary file first, so concurrent workers never read a partial index.
+
+`RetrievedEvidenceStore` holds MedRAG retrieval results by claim, as written by
+`medscore retrieve` (see `medscore.retrieve`) and read by the `medrag` verifier with
+`pre_retrieved_path`. Each passage is stored once, and each claim has the ids and scores of
+its passages, so verification needs neither the corpus nor FAISS or torch.
+"""
+import os
+import json
+import mmap
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Ids per SQL query
+_QUERY_BATCH_SIZE = 500
+# SQLite memory-maps up to this many bytes of the database
+_MMAP_SIZE = 1 << 30
+
+
+def _source_signature(path: str) -> str:
+    stat = os.stat(path)
+    return json.dumps({"size": stat.st_size, "mtime": stat.st_mtime})
+
+
+def _index_path(path: str, suffix: str, index_dir: Optional[str]) -> str:
+    directory = index_dir or os.path.dirname(os.path.abspath(path))
+    return os.path.join(directory, os.path.basename(path) + suffix)
+
+
+def _is_current(db_path: str, source_path: str) -> bool:
+    """True if `db_path` exists and was built from the current version of `source_path`."""
+    if not os.path.exists(db_path):
+        return False
+    try:
+        with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+    except sqlite3.DatabaseError:
+        return False
+    return row is not None and row[0] == _source_signature(source_path)
+
+
+def _build_sqlite(db_path: str, source_path: str, table: str, columns: str, rows: Iterable[Tuple]):
+    """Writes `rows` into a new SQLite file and moves it to `db_path` once complete."""
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    tmp_path = f"{db_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute(f"CREATE TABLE {table} ({columns})")
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        placeholders = ", ".join("?" * len(columns.split(",")))
+        # INSERT OR REPLACE: the last record of a repeated id wins, as in a JSON dict
+        conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", rows)
+        conn.execute("INSERT INTO meta VALUES ('source', ?)", (_source_signature(source_path),))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+
+
+def _iter_jsonl_offsets(path: str) -> Iterator[Tuple[str, int, int]]:
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                yield str(json.loads(line)["id"]), offset, len(line)
+            offset += len(line)
+
+
+def _iter_json_dict(path: str) -> Iterator[Tuple[str, str]]:
+    # The original format can only be read whole. This happens once, during the conversion.
+    with open(path) as f:
+        id_to_evidence = json.load(f)
+    for item_id, evidence in id_to_evidence.items():
+        yield str(item_id), json.dumps(evidence)
+
+
+class EvidenceStore:
+    """Looks up evidence by `id` in an indexed file. Safe to use from several threads."""
+    def __init__(self, path: str, index_dir: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = None  # Memory-mapped JSONL file
+        if path.endswith((".sqlite", ".db")):
+            db_path, self._query = path, "SELECT id, evidence FROM evidence WHERE id IN ({})"
+        elif path.endswith(".jsonl"):
+            db_path = _index_path(path, ".idx.sqlite", index_dir)
+            if not _is_current(db_path, path):
+                logger.info(f"Indexing evidence file {path} into {db_path}")
+                _build_sqlite(db_path, path, "offsets", "id TEXT PRIMARY KEY, offset INTEGER, length INTEGER",
+                              _iter_jsonl_offsets(path))
+            self._query = "SELECT id, offset, length FROM offsets WHERE id IN ({})"
+            self._file = open(path, "rb")
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            db_path = _index_path(path, ".evidence.sqlite", index_dir)
+            if not _is_current(db_path, path):
+                logger.info(f"Converting evidence file {path} into an indexed store at {db_path}")
+                _build_sqlite(db_path, path, "evidence", "id TEXT PRIMARY KEY, evidence TEXT", _iter_json_dict(path))
+            self._query = "SELECT id, evidence FROM evidence WHERE id IN ({})"
+        self.db_path = db_path
+        self._conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        self._conn.execute(f"PRAGMA mmap_size = {_MMAP_SIZE}")
+
+    def _decode(self, row: Tuple) -> Any:
+        if self._data is None:
+            return json.loads(row[1])
+        offset, length = row[1], row[2]
+        return json.loads(self._data[offset:offset + length]).get("evidence")
+
+    def get_many(self, ids: Iterable[Any]) -> Dict[str, Any]:
+        """Evidence of each of `ids` that is in the store, by id (as a string)."""
+        ids = list(dict.fromkeys(str(i) for i in ids))
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), _QUERY_BATCH_SIZE):
+                batch = ids[start:start + _QUERY_BATCH_SIZE]
+                for row in self._conn.execute(self._query.format(", ".join("?" * len(batch))), batch):
+                    found[row[0]] = self._decode(row)
+        return found
+
+    def get(self, item_id: Any) -> Optional[Any]:
+        return self.get_many([item_id]).get(str(item_id))
+
+    def close(self):
+        self._conn.close()
+        if self._data is not None:
+            self._data.close()
+            self._file.close()
+
+
+# MedRAG verifier settings that change the retrieved passages, kept with a retrieved evidence store
+RETRIEVAL_SETTINGS = ("retriever_name", "corpus_name", "HNSW", "hnsw_ef_search", "n_candidates", "coarse_nprobe",
+                      "n_returned_docs", "query_encoder_backend", "encoder_max_length")
+
+
+def retrieval_settings(**config: Any) -> Dict[str, Any]:
+    """The `RETRIEVAL_SETTINGS` of a MedRAG verifier config."""
+    return {key: config.get(key) for key in RETRIEVAL_SETTINGS}
+
+
+class RetrievedEvidenceStore:
+    """
+    Claim -> retrieved passages store in SQLite. Opened read-only, unless `writable`: then it is
+    created if needed, and `add` commits every batch, so an interrupted `medscore retrieve` resumes.
+    """
+    def __init__(self, path: str, writable: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        if writable:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS passages (id TEXT PRIMARY KEY, title TEXT, text TEXT)")
+            # JSON list of [passage id, score] per claim, best first
+            self._conn.execute("CREATE TABLE IF NOT EXISTS claims (claim TEXT PRIMARY KEY, hits TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.commit()
+        else:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            self._conn.execute(f"PRAGMA mmap_size = {_MMAP_SIZE}")
+
+    @property
+    def settings(self) -> Optional[Dict[str, Any]]:
+        """The retrieval settings the store was built with."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_settings(self, settings: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('settings', ?)", (json.dumps(settings, sort_keys=True),))
+            self._conn.commit()
+
+    def _select(self, query: str, keys: List[str]) -> Iterator[Tuple]:
+        for start in range(0, len(keys), _QUERY_BATCH_SIZE):
+            batch = keys[start:start + _QUERY_BATCH_SIZE]
+            yield from self._conn.execute(query.format(", ".join("?" * len(batch))), batch)
+
+    def contains(self, claims: Iterable[str]) -> set:
+        """The `claims` that are in the store."""
+        claims = list(dict.fromkeys(claims))
+        with self._lock:
+            return {row[0] for row in self._select("SELECT claim FROM claims WHERE claim IN ({})", claims)}
+
+    def add(self, claims: List[str], retrieved: List[List[Dict[str, Any]]]):
+        """Stores the passages (`{"id", "title", "text", "score"}`) retrieved for each claim."""
+        passages = {p["id"]: (p["id"], p.get("title", ""), p.get("text", "")) for docs in retrieved for p in docs}
+        hits = [(claim, json.dumps([[p["id"], p["score"]] for p in docs])) for claim, docs in zip(claims, retrieved)]
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO passages VALUES (?, ?, ?)", passages.values())
+            self._conn.executemany("INSERT OR REPLACE INTO claims VALUES (?, ?)", hits)
+            self._conn.commit()
+
+    def get_many(self, claims: Iterable[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """Passages of each of `claims` that is in the store, in the format of `MedRAGRetriever`."""
+        claims = list(dict.fromkeys(claims))
+        with self._lock:
+            hits = {claim: json.loads(value) for claim, value in self._select(
+                "SELECT claim, hits FROM claims WHERE claim IN ({})", claims)}
+            passage_ids = list({passage_id for claim_hits in hits.values() for passage_id, _ in claim_hits})
+            passages = {row[0]: row for row in self._select(
+                "SELECT id, title, text FROM passages WHERE id IN ({})", passage_ids)}
+        return {
+            claim: [{"id": passage_id, "title": passages[passage_id][1], "text": passages[passage_id][2], "score": score}
+                    for passage_id, score in claim_hits]
+            for claim, claim_hits in hits.items()
+        }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM claims").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def open_evidence_store(path: str, index_dir: Optional[str] = None) -> EvidenceStore:
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Evidence file not found: {path}")
+    return EvidenceStore(path, index_dir=index_dir)
@@ -0,0 +1,160 @@
+"""
+Recall/latency sweep for HNSW retrieval settings.
+
+For a sample of claims, compares HNSW search at several `efSearch` values (and, optionally,
+HNSW graphs built with other `M`/`efConstruction` values) with exact search over the same
+vectors, and reports recall@k and per-query latency:
+
+    medscore hnsw-sweep --retriever_name MedCPT --corpus_name StatPearls \
+        --queries results/decompositions.jsonl --ef_search 16 32 64 128 256 --build 32:40 32:200
+
+Pick the fastest setting whose recall keeps the retrieved passages (and so the verification
+results) stable, and set `hnsw_m`, `hnsw_ef_construction` and `hnsw_ef_search` in the config.
+"""
+import os
+import json
+import time
+import logging
+from argparse import ArgumentParser
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+import faiss
+import torch
+
+from .medrag_utils import retriever_names, corpus_names, dense_retriever_name
+from .query_encoder import load_query_encoder, read_queries
+
+logger = logging.getLogger(__name__)
+
+
+def recall_at_k(exact_ids: np.ndarray, approx_ids: np.ndarray) -> Tuple[float, float]:
+    """Mean recall@k of `approx_ids` against `exact_ids`, and the fraction of queries with the exact top-k set."""
+    k = exact_ids.shape[1]
+    overlaps = [len(set(e.tolist()) & set(a.tolist())) for e, a in zip(exact_ids, approx_ids)]
+    return float(np.mean(overlaps)) / k, float(np.mean([o == k for o in overlaps]))
+
+
+def time_queries(index, query_embeds: np.ndarray, k: int, ef_search: int) -> Tuple[np.ndarray, List[float]]:
+    """Searches one query at a time (as in a latency-bound service). Returns ids and per-query seconds."""
+    params = faiss.SearchParametersHNSW(efSearch=ef_search)
+    ids, latencies = [], []
+    for query in query_embeds:
+        start = time.perf_counter()
+        _, I = index.search(query[None, :], k, params=params)
+        latencies.append(time.perf_counter() - start)
+        ids.append(I[0])
+    return np.stack(ids), latencies
+
+
+def sweep_index(index, exact_ids: np.ndarray, query_embeds: np.ndarray, k: int, ef_search_values: List[int]) -> List[Dict[str, Any]]:
+    # FAISS searches with at least k candidates, so values below k are measured (and reported) as k
+    results = []
+    for ef_search in dict.fromkeys(max(ef_search, k) for ef_search in ef_search_values):
+        approx_ids, latencies = time_queries(index, query_embeds, k, ef_search)
+        recall, exact_match = recall_at_k(exact_ids, approx_ids)
+        results.append({
+            "ef_search": ef_search,
+            f"recall@{k}": recall,
+            "exact_topk_rate": exact_match,
+            "latency_ms_mean": 1000 * float(np.mean(latencies)),
+            "latency_ms_p50": 1000 * float(np.percentile(latencies, 50)),
+            "latency_ms_p95": 1000 * float(np.percentile(latencies, 95)),
+        })
+    return results
+
+
+def run_sweep(
+        index_dir: str,
+        query_embeds: np.ndarray,
+        k: int,
+        ef_search_values: List[int],
+        build: Optional[List[Tuple[int, int]]] = None,
+) -> List[Dict[str, Any]]:
+    """Sweeps the index in `index_dir`, and HNSW graphs built from its vectors for each (M, efConstruction) in `build`."""
+    index = faiss.read_index(os.path.join(index_dir, "faiss.index"))
+    # Exact search over the same vectors: the flat index itself, or the storage of an HNSW index
+    exact = index
+    if hasattr(index, "hnsw"):
+        exact = faiss.downcast_index(index.storage)
+        if exact.metric_type != index.metric_type:
+            # Indexes built by older versions set the HNSW metric after creating an L2 storage
+            logger.warning("HNSW storage metric differs from the index metric. Copying the vectors for exact search.")
+            vectors = exact.reconstruct_n(0, exact.ntotal)
+            exact = faiss.IndexFlat(exact.d, index.metric_type)
+            exact.add(vectors)
+    _, exact_ids = exact.search(query_embeds, k)
+
+    results = []
+    if hasattr(index, "hnsw"):
+        for r in sweep_index(index, exact_ids, query_embeds, k, ef_search_values):
+            results.append({"M": index.hnsw.nb_neighbors(1), "ef_construction": index.hnsw.efConstruction, "built": False, **r})
+
+    for M, ef_construction in build or []:
+        logger.info(f"Building HNSW graph with M={M}, efConstruction={ef_construction} over {exact.ntotal} vectors")
+        hnsw = faiss.IndexHNSWFlat(exact.d, M, exact.metric_type)
+        hnsw.hnsw.efConstruction = ef_construction
+        start = time.perf_counter()
+        for offset in range(0, exact.ntotal, 262144):
+            hnsw.add(exact.reconstruct_n(offset, min(262144, exact.ntotal - offset)))
+        build_seconds = time.perf_counter() - start
+        for r in sweep_index(hnsw, exact_ids, query_embeds, k, ef_search_values):
+            results.append({"M": M, "ef_construction": ef_construction, "built": True, "build_seconds": build_seconds, **r})
+        del hnsw
+    return results
+
+
+def parse_build(values: List[str]) -> List[Tuple[int, int]]:
+    build = []
+    for value in values:
+        M, _, ef_construction = value.partition(":")
+        build.append((int(M), int(ef_construction or 40)))
+    return build
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Parse command line arguments."""
+    parser = ArgumentParser(prog="medscore hnsw-sweep", description="Measure HNSW recall@k and latency against exact search.")
+    parser.add_argument("--retriever_name", type=str, default="MedCPT", help="MedRAG retriever, e.g. MedCPT or Contriever.")
+    parser.add_argument("--corpus_name", type=str, default="StatPearls", help="MedRAG corpus.")
+    parser.add_argument("--db_dir", type=str, default=os.environ.get("MEDRAG_CORPUS", "./corpus"), help="MedRAG corpus directory.")
+    parser.add_argument("--queries", type=str, required=True, help="Text file with one claim per line, or a JSONL file with a `claim` key.")
+    parser.add_argument("--n_queries", type=int, default=500, help="Number of claims to sample (uniformly, from the whole file).")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the claim sample, so that sweeps are comparable.")
+    parser.add_argument("--k", type=int, default=5, help="Number of retrieved passages (`n_returned_docs`).")
+    parser.add_argument("--ef_search", type=int, nargs="+", default=[16, 32, 64, 128, 256], help="efSearch values to measure.")
+    parser.add_argument("--build", type=str, nargs="*", default=[], help="Also build HNSW graphs with these M:efConstruction settings.")
+    parser.add_argument("--output", type=str, help="Write the results as JSONL to this file.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point for `medscore hnsw-sweep`."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+    queries = read_queries(args.queries, limit=args.n_queries, seed=args.seed)
+    logger.info(f"Sweeping with {len(queries)} claims")
+
+    all_results = []
+    for retriever in retriever_names[args.retriever_name]:
+        retriever = dense_retriever_name(retriever)
+        if retriever is None:
+            continue
+        encoder = load_query_encoder(retriever)
+        with torch.no_grad():
+            query_embeds = np.asarray(encoder.encode(queries), dtype=np.float32)
+        for corpus in corpus_names[args.corpus_name]:
+            index_dir = os.path.join(args.db_dir, corpus, "index", retriever.replace("Query-Encoder", "Article-Encoder"))
+            for result in run_sweep(index_dir, query_embeds, args.k, args.ef_search, build=parse_build(args.build)):
+                result = {"retriever": retriever, "corpus": corpus, **result}
+                all_results.append(result)
+                print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in all_results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
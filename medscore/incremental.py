@@ -0,0 +1,195 @@
+"""
+Incremental re-scoring for MedScore.
+
+Every complete run writes `manifest.json` to its output directory with a content hash per
+input `id` (response text / sentences, and its provided evidence) and a fingerprint of the
+configuration that affects the results. With `--incremental`, a later run into the same output directory only
+decomposes and verifies the records that are new or whose hash changed, and splices them
+into the previous decompositions and verifications:
+
+    python -m medscore.medscore --config config.yaml --incremental
+
+With a pre-retrieved evidence store, the new claims need to be retrieved between the two steps:
+
+    python -m medscore.medscore --config config.yaml --incremental --decompose_only
+    medscore retrieve --config config.yaml
+    python -m medscore.medscore --config config.yaml --incremental --verify_only
+
+The first step keeps the previous manifest and records the ids it decomposed in it, so the
+last step verifies exactly those.
+
+If the configuration changed (e.g. a different model or prompt), everything is rescored.
+Execution settings (batch sizes, caching, retries, connection settings) are not part of the
+fingerprint, and a grown evidence file only rescores the ids whose evidence changed.
+"""
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from .config_schema import MedScoreConfig
+from .storage import read_records, find_output
+from .evidence_store import open_evidence_store, RetrievedEvidenceStore
+from .utils import chunker
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Component settings that change the results. All others (batch sizes, caching, retries, servers'
+# connection settings, file locations) only change how they are computed.
+_RESULT_FIELDS = {
+    "type", "model_name", "server_path", "random_state", "structured_output", "deduplicate", "prompt_path",
+    "answer_mode", "logprobs", "retriever_name", "corpus_name", "HNSW", "hnsw_m", "hnsw_ef_construction",
+    "hnsw_ef_search", "n_candidates", "coarse_nprobe", "n_returned_docs", "query_encoder_backend",
+    "encoder_max_length", "pre_retrieved_path", "first_stage", "confidence_threshold", "agreement_models",
+    "audit_rate",
+}
+# Ids per evidence lookup when hashing the provided evidence
+_EVIDENCE_BATCH_SIZE = 10000
+
+
+def _result_settings(settings: Dict[str, Any]) -> Dict[str, Any]:
+    relevant = {key: value for key, value in settings.items() if key in _RESULT_FIELDS}
+    # The "cascade" verifier nests the settings of its first stage
+    if relevant.get("first_stage"):
+        relevant["first_stage"] = _result_settings(relevant["first_stage"])
+    # A custom prompt is small, so it is hashed by content
+    if relevant.get("prompt_path") and os.path.exists(relevant["prompt_path"]):
+        with open(relevant["prompt_path"], "rb") as f:
+            relevant["prompt_path"] = hashlib.sha256(f.read()).hexdigest()
+    # A pre-retrieved store grows with every `medscore retrieve`, but the evidence of a claim only
+    # depends on the retrieval settings it records
+    if relevant.get("pre_retrieved_path") and os.path.exists(relevant["pre_retrieved_path"]):
+        store = RetrievedEvidenceStore(relevant["pre_retrieved_path"])
+        try:
+            relevant["pre_retrieved_path"] = store.settings
+        finally:
+            store.close()
+    return relevant
+
+
+def config_fingerprint(config: MedScoreConfig) -> str:
+    """Hash of the configuration fields that determine the decompositions and verifications."""
+    relevant = {"response_key": config.response_key, "presenticized": config.presenticized}
+    for component in ("decomposer", "verifier"):
+        relevant[component] = _result_settings(getattr(config, component).model_dump(mode="json"))
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def evidence_hashes(config: MedScoreConfig, ids: Iterable[Any]) -> Optional[Dict[str, str]]:
+    """
+    Hash of the provided evidence of each of `ids` (as strings) that has evidence, if the verifier
+    (or the first stage of a cascade) reads a `provided_evidence_path`. None otherwise.
+    """
+    verifier = config.verifier.model_dump(mode="json")
+    settings = verifier if verifier["type"] == "provided" else verifier.get("first_stage") or {}
+    if settings.get("type") != "provided":
+        return None
+    store = open_evidence_store(settings["provided_evidence_path"], index_dir=settings.get("evidence_index_dir"))
+    hashes = {}
+    try:
+        for batch in chunker(dict.fromkeys(str(i) for i in ids), _EVIDENCE_BATCH_SIZE):
+            for item_id, evidence in store.get_many(batch).items():
+                hashes[item_id] = hashlib.sha256(json.dumps(evidence, sort_keys=True).encode("utf-8")).hexdigest()
+    finally:
+        store.close()
+    return hashes
+
+
+def record_hashes(
+        dataset: Iterable[Dict[str, Any]],
+        response_key: str,
+        evidence: Optional[Dict[str, str]] = None,
+) -> Dict[str, str]:
+    """
+    Content hash per `id` (as a string). Records sharing an `id` are hashed together, in order.
+    With `evidence` (see `evidence_hashes`), the hash also covers the evidence of each id.
+    """
+    hashes = {}
+    for item in dataset:
+        item_id = str(item.get("id"))
+        parts = [item.get(response_key), item.get("sentences")]
+        if evidence is not None:
+            parts.append(evidence.get(item_id))
+        content = json.dumps(parts, sort_keys=True)
+        hashes[item_id] = hashlib.sha256((hashes.get(item_id, "") + content).encode("utf-8")).hexdigest()
+    return hashes
+
+
+def load_manifest(output_dir: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        logger.warning(f"Ignoring {path}: unsupported manifest version {manifest.get('version')}.")
+        return None
+    return manifest
+
+
+def write_manifest(output_dir: str, fingerprint: str, hashes: Dict[str, str], decomposed: Optional[Dict[str, str]] = None) -> str:
+    """
+    Writes the manifest of a complete run. `decomposed` has the hashes of the ids that an
+    `--incremental --decompose_only` run decomposed, but that are not verified yet.
+    """
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    manifest = {"version": MANIFEST_VERSION, "config": fingerprint, "records": hashes}
+    if decomposed is not None:
+        manifest["decomposed"] = decomposed
+    # Write to a temporary file first, so an interrupted run never leaves a partial manifest
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def remove_manifest(output_dir: str):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def find_changed_ids(hashes: Dict[str, str], manifest: Optional[Dict[str, Any]], fingerprint: str) -> Set[str]:
+    """Ids (as strings) that need to be rescored. All ids if there is no usable previous manifest."""
+    if manifest is None:
+        logger.info("No previous manifest found. Scoring all records.")
+        return set(hashes)
+    if manifest.get("config") != fingerprint:
+        logger.info("Configuration changed since the previous run. Scoring all records.")
+        return set(hashes)
+    previous = manifest.get("records", {})
+    return {item_id for item_id, digest in hashes.items() if previous.get(item_id) != digest}
+
+
+def load_previous_results(output_dir: str, name: str, keep_ids: Set[str], output_format: str) -> Dict[str, List[Dict[str, Any]]]:
+    """Previous records of output file `name` for `keep_ids`, grouped by `id` (as a string)."""
+    path = find_output(output_dir, name, output_format)
+    if path is None:
+        raise FileNotFoundError(f"Previous {name} file not found in {output_dir}")
+    previous = {}
+    for record in read_records(path):
+        item_id = str(record.get("id"))
+        if item_id in keep_ids:
+            previous.setdefault(item_id, []).append(record)
+    return previous
+
+
+def splice_results(
+        dataset: List[Dict[str, Any]],
+        new_records: List[Dict[str, Any]],
+        previous: Dict[str, List[Dict[str, Any]]],
+) -> List[Dict[str, Any]]:
+    """Combines newly scored and previous records in the order of `dataset`."""
+    grouped = dict(previous)
+    for record in new_records:
+        grouped.setdefault(str(record.get("id")), []).append(record)
+    spliced = []
+    for item in dataset:
+        # pop(): records of a repeated id are already complete at its first occurrence
+        spliced.extend(grouped.pop(str(item.get("id")), []))
+    return spliced
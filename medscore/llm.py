@@ -0,0 +1,503 @@
+"""
+Shared LLM request handling for the decomposers and verifiers.
+
+All chat completion requests run on one long-lived background event loop. Synchronous
+callers block on it, and async callers (on any event loop) await it, so every caller
+shares the same concurrency budget without patching asyncio with `nest_asyncio`.
+
+Components that send requests to the same `server_path` also share one long-lived HTTP
+client (see `http_client`), so keep-alive connections are reused across components and
+batches instead of being opened for each. `connection_stats` reports the reuse.
+
+With `hedging`, a request that is slower than a percentile of the recent latencies is sent
+a second time, and whichever copy finishes first is used (see `LLMComponent.hedged_response`).
+
+Requests of a batch are dispatched longest-expected-first (see `LLMComponent.estimate_cost`),
+so that a few long requests do not start last and stretch the batch. Results keep input order.
+
+With `batch_api`, `complete_all` submits the requests to the server's batch API instead and
+waits for the results (see `medscore.batch_api`).
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from functools import partial
+from typing import List, Dict, Any, Optional, Coroutine, TypeVar, Callable
+
+import backoff
+import httpx
+import requests
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai.types.chat.chat_completion import ChatCompletion
+from tqdm import tqdm
+
+from .metrics import metrics
+from .batch_api import BatchSubmitter
+from .config_schema import HTTPPoolConfig
+
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+# Connection pool settings of the shared HTTP clients, from the `http_pool` config section
+HTTP_POOL_DEFAULTS = HTTPPoolConfig().model_dump()
+# server_path -> (settings, client, stats)
+_http_clients: Dict[str, tuple] = {}
+_http_clients_lock = threading.Lock()
+
+# Prompt characters per token, for cost estimates without a tokenizer
+CHARS_PER_TOKEN = 4
+# Time to generate one token, in prompt tokens: decoding is sequential, the prompt is processed in parallel
+DECODE_TOKEN_COST = 20
+# Sampling temperature of parse retries: greedy decoding repeats the same output, whatever the seed
+RETRY_TEMPERATURE = 0.7
+# Parse retries with `structured_output`. Without it, retries are opt-in, so free-text requests are unchanged.
+DEFAULT_PARSE_RETRIES = 2
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Returns the background event loop used for all LLM requests, starting it if needed."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="medscore-llm-loop", daemon=True)
+            thread.start()
+    return _loop
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+async def run_on_llm_loop(coro: Coroutine[Any, Any, T]) -> T:
+    """Awaits `coro` on the background LLM loop from any event loop."""
+    loop = get_event_loop()
+    if _running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+class ConnectionStats:
+    """Requests sent and connections opened by one shared HTTP client."""
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+
+    async def on_request(self, request: httpx.Request):
+        # httpcore reports the connection setup of each request through the `trace` extension
+        opened = []
+
+        async def trace(event_name: str, info: Dict[str, Any]):
+            if event_name == "connection.connect_tcp.complete":
+                opened.append(True)
+                self.connections_opened += 1
+                metrics.increment("http.connections_opened")
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+                metrics.increment("http.tls_handshakes")
+            elif event_name in ("http11.send_request_headers.started", "http2.send_request_headers.started"):
+                self.requests += 1
+                metrics.increment("http.requests")
+                if not opened:
+                    metrics.increment("http.reused_connections")
+
+        request.extensions["trace"] = trace
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "tls_handshakes": self.tls_handshakes,
+            "reused_connections": max(self.requests - self.connections_opened, 0),
+            "reuse_rate": 1 - self.connections_opened / self.requests if self.requests else None,
+        }
+
+
+def estimate_prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(len(m.get("content") or "") for m in messages) // CHARS_PER_TOKEN
+
+
+class CompletionLengthModel:
+    """Least-squares fit of the completion tokens of a component on its prompt tokens, updated online."""
+    def __init__(self):
+        self.n = 0
+        self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = 0.0
+
+    def observe(self, prompt_tokens: int, completion_tokens: int):
+        self.n += 1
+        self.sum_x += prompt_tokens
+        self.sum_y += completion_tokens
+        self.sum_xx += prompt_tokens * prompt_tokens
+        self.sum_xy += prompt_tokens * completion_tokens
+
+    def expected(self, prompt_tokens: int, max_tokens: Optional[int]) -> float:
+        """Expected completion tokens of a prompt. Without history, `max_tokens` (the worst case)."""
+        if self.n == 0:
+            return max_tokens or 0
+        mean_x, mean_y = self.sum_x / self.n, self.sum_y / self.n
+        var_x = self.sum_xx / self.n - mean_x * mean_x
+        expected = mean_y
+        if var_x > 0:
+            expected += (self.sum_xy / self.n - mean_x * mean_y) / var_x * (prompt_tokens - mean_x)
+        return min(max(expected, 1.0), max_tokens or math.inf)
+
+
+class LatencyTracker:
+    """Recent request latencies of a component, and its budget of hedged requests."""
+    def __init__(self, percentile: float = 95.0, max_rate: float = 0.05, min_samples: int = 20, window: int = 1000):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+
+    def observe(self, seconds: float):
+        self.requests += 1
+        self.latencies.append(seconds)
+
+    def threshold(self) -> Optional[float]:
+        """Seconds after which a request is hedged, or None until enough latencies were seen."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(self.percentile / 100 * len(ordered)) - 1)]
+
+    def try_hedge(self) -> bool:
+        """Uses one hedge from the budget of `max_rate` hedges per request, if any is left."""
+        if self.hedges + 1 > self.max_rate * max(self.requests, 1):
+            return False
+        self.hedges += 1
+        return True
+
+
+def http_client(server_path: str, http_pool: Optional[Dict[str, Any]] = None) -> httpx.AsyncClient:
+    """
+    The process-wide HTTP client for `server_path`, created on first use with the `http_pool`
+    settings (see `HTTP_POOL_DEFAULTS`). Later callers with other settings get the same client.
+    """
+    settings = {**HTTP_POOL_DEFAULTS, **(http_pool or {})}
+    with _http_clients_lock:
+        if server_path in _http_clients:
+            existing, client, _ = _http_clients[server_path]
+            if existing != settings:
+                logger.warning(f"Components using {server_path} have different http_pool settings. "
+                               f"The first ones are used: {existing}")
+            return client
+        stats = ConnectionStats()
+        client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=settings["max_connections"],
+                                max_keepalive_connections=settings["max_keepalive_connections"],
+                                keepalive_expiry=settings["keepalive_expiry"]),
+            timeout=httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+            # Requires the h2 package: pip install "httpx[http2]"
+            http2=settings["http2"],
+            event_hooks={"request": [stats.on_request]},
+        )
+        _http_clients[server_path] = (settings, client, stats)
+        return client
+
+
+def connection_stats() -> Dict[str, Dict[str, Any]]:
+    """Connection reuse statistics of each shared HTTP client, by `server_path`."""
+    with _http_clients_lock:
+        return {server_path: stats.to_dict() for server_path, (_, _, stats) in _http_clients.items()}
+
+
+class ParseError(ValueError):
+    """A completion that does not have the expected output format."""
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """Runs `coro` on the background LLM loop and blocks until it finishes."""
+    loop = get_event_loop()
+    if _running_loop() is loop:
+        coro.close()
+        raise RuntimeError("Cannot block the MedScore LLM event loop. Use the async API instead.")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+class LLMComponent:
+    """Base class for components that send chat completion requests (decomposers, verifiers)."""
+    # Prefix for this component's metrics
+    component_name = "llm"
+    # JSON schema of the output for `structured_output`, and the instruction that asks for it
+    output_schema: Optional[Dict[str, Any]] = None
+    structured_instruction: str = ""
+
+    def __init__(
+            self,
+            server_path: str,
+            model_name: str,
+            api_key: Optional[str] = None,
+            random_state: int = 42,
+            batch_size: int = 32,
+            structured_output: str = "none",
+            max_parse_retries: Optional[int] = None,
+            http_pool: Optional[Dict[str, Any]] = None,
+            hedging: Optional[Dict[str, Any]] = None,
+            dispatch_order: str = "longest_first",
+            batch_api: Optional[Dict[str, Any]] = None,
+            **kwargs,  # To allow for extra params from config
+    ):
+        api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.client = AsyncOpenAI(
+            base_url=server_path,
+            api_key=api_key,
+            http_client=http_client(server_path, http_pool),
+        )
+        self.model_name = model_name
+        self.random_state = random_state
+        # Maximum number of requests in flight for this component, shared by all callers
+        self.batch_size = batch_size
+        self._limiter: Optional[asyncio.Semaphore] = None
+
+        self.agent = partial(
+            self.client.chat.completions.create,
+            model=self.model_name,
+            seed=self.random_state,
+            temperature=0.0,
+            top_p=1.0,
+            max_tokens=256
+        )
+        # Extra request arguments, kept separate from `agent` so subclasses can replace the agent
+        self.structured_output = structured_output
+        self.request_kwargs = self.structured_request_kwargs(structured_output)
+        if max_parse_retries is None:
+            max_parse_retries = DEFAULT_PARSE_RETRIES if structured_output != "none" else 0
+        self.max_parse_retries = max_parse_retries
+
+        if dispatch_order not in ("longest_first", "input"):
+            raise ValueError(f"Unknown dispatch_order {dispatch_order!r}. Options: longest_first, input")
+        self.dispatch_order = dispatch_order
+        self.completion_lengths = CompletionLengthModel()
+
+        # Hedged requests go to `hedging.server_path` if set, or to the same server
+        self.hedging = dict(hedging) if hedging else None
+        self._latency: Optional[LatencyTracker] = None
+        self.hedge_client = self.client
+        if self.hedging and self.hedging.get("server_path"):
+            hedge_server = self.hedging["server_path"]
+            hedge_key = self.hedging.get("api_key")
+            if hasattr(hedge_key, "get_secret_value"):
+                hedge_key = hedge_key.get_secret_value()
+            self.hedge_client = AsyncOpenAI(
+                base_url=hedge_server,
+                api_key=hedge_key or api_key,
+                http_client=http_client(hedge_server, http_pool),
+            )
+
+        # Offline batch submission instead of live requests (disabled if not set)
+        self.batch_api = BatchSubmitter(self.client, **batch_api) if batch_api else None
+
+    def structured_request_kwargs(self, structured_output: str) -> Dict[str, Any]:
+        """
+        Request arguments that constrain the output to `output_schema`:
+        `json_schema` (OpenAI structured outputs, also supported by vLLM) or `guided_json` (vLLM).
+        """
+        if structured_output == "none":
+            return {}
+        if self.output_schema is None:
+            raise ValueError(f"{type(self).__name__} does not support structured_output={structured_output!r}")
+        if structured_output == "json_schema":
+            return {"response_format": {"type": "json_schema", "json_schema": {
+                "name": f"{self.component_name}_output", "strict": True, "schema": self.output_schema}}}
+        if structured_output == "guided_json":
+            return {"extra_body": {"guided_json": self.output_schema}}
+        raise ValueError(f"Unknown structured_output {structured_output!r}. Options: none, json_schema, guided_json")
+
+    def add_structured_instruction(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        if self.structured_output == "none":
+            return messages
+        messages = [dict(m) for m in messages]
+        messages[-1]["content"] = f"{messages[-1]['content']}\n{self.structured_instruction}"
+        return messages
+
+    @property
+    def limiter(self) -> asyncio.Semaphore:
+        # Created lazily, so it is bound to the background LLM loop
+        if self._limiter is None:
+            self._limiter = asyncio.Semaphore(self.batch_size)
+        return self._limiter
+
+    @property
+    def latency(self) -> LatencyTracker:
+        if self._latency is None:
+            self._latency = LatencyTracker(**{k: v for k, v in self.hedging.items() if k in ("percentile", "max_rate", "min_samples")})
+        return self._latency
+
+    async def complete(self, messages: List[Dict[str, str]], **request_kwargs) -> ChatCompletion:
+        """Sends one chat completion request within the component's concurrency budget."""
+        async with self.limiter:
+            if self.hedging:
+                return await self.hedged_response(messages, **request_kwargs)
+            return await self.timed_response(messages, **request_kwargs)
+
+    async def hedged_response(self, messages: List[Dict[str, str]], **request_kwargs) -> ChatCompletion:
+        """
+        Sends the request, and if it has not finished after the `hedging.percentile` latency of
+        recent requests, sends it again (within the `hedging.max_rate` budget). The first
+        successful completion is returned and the other request is cancelled. The hedge has the
+        same arguments (and seed), so it does not change the result.
+        """
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(self.timed_response(messages, **request_kwargs))
+        tasks = {primary}
+        try:
+            delay = self.latency.threshold()
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+            if primary.done() or delay is None or not self.latency.try_hedge():
+                completion = await primary
+                self.latency.observe(time.perf_counter() - start)
+                return completion
+
+            metrics.increment(f"{self.component_name}.hedges")
+            # The hedge runs in the primary request's slot of the concurrency limit
+            hedge_agent = partial(self.hedge_client.chat.completions.create, **self.agent.keywords)
+            hedge = asyncio.ensure_future(self.timed_response(messages, agent=hedge_agent, **request_kwargs))
+            tasks.add(hedge)
+            error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    if task is hedge:
+                        metrics.increment(f"{self.component_name}.hedge_wins")
+                    # The primary's latency, or a lower bound if it is cancelled
+                    self.latency.observe(time.perf_counter() - start)
+                    return task.result()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @backoff.on_exception(
+        backoff.expo,
+        (requests.exceptions.RequestException, asyncio.TimeoutError),
+        max_time=60,
+        on_backoff=lambda details: metrics.increment(f"{details['args'][0].component_name}.retries"),
+    )
+    async def timed_response(self, messages: List[Dict[str, str]], agent: Optional[Callable] = None, **request_kwargs) -> ChatCompletion:
+        start = time.perf_counter()
+        agent = agent or self.agent
+        completion = await agent(messages=messages, **{**self.request_kwargs, **request_kwargs})
+        metrics.record_completion(self.component_name, time.perf_counter() - start, completion)
+        usage = getattr(completion, "usage", None)
+        if usage is not None and usage.completion_tokens is not None:
+            self.completion_lengths.observe(estimate_prompt_tokens(messages), usage.completion_tokens)
+        return completion
+
+    def estimate_cost(self, messages: List[Dict[str, str]], **request_kwargs) -> float:
+        """
+        Expected time of a request, in prompt tokens: the prompt length plus the expected
+        completion length (from earlier completions of this component, at most `max_tokens`).
+        """
+        prompt_tokens = estimate_prompt_tokens(messages)
+        max_tokens = {**getattr(self.agent, "keywords", {}), **self.request_kwargs, **request_kwargs}.get("max_tokens")
+        return prompt_tokens + DECODE_TOKEN_COST * self.completion_lengths.expected(prompt_tokens, max_tokens)
+
+    def request_body(self, messages: List[Dict[str, str]], **request_kwargs) -> Dict[str, Any]:
+        """The JSON body of the chat completion request that `complete` sends for `messages`."""
+        body = {**self.agent.keywords, **self.request_kwargs, **request_kwargs, "messages": messages}
+        # The client sends `extra_body` fields (e.g. vLLM's `guided_json`) at the top level
+        body.update(body.pop("extra_body", None) or {})
+        return body
+
+    async def complete_all(self, all_messages: List[List[Dict[str, str]]], desc: str = "", **request_kwargs) -> List[ChatCompletion]:
+        """Sends all requests, at most `batch_size` at a time, and returns completions in input order."""
+        if self.batch_api is not None:
+            bodies = [self.request_body(messages, **request_kwargs) for messages in all_messages]
+            return await run_on_llm_loop(self.batch_api.complete_all(bodies, self.component_name, desc))
+        return await run_on_llm_loop(self._complete_all(all_messages, desc, **request_kwargs))
+
+    async def complete_all_validated(
+            self,
+            all_messages: List[List[Dict[str, str]]],
+            validate: Callable[[ChatCompletion], Any],
+            desc: str = "",
+    ) -> List[ChatCompletion]:
+        """
+        Like `complete_all`, but completions for which `validate` raises `ParseError` are
+        re-requested (sampled, with another seed) up to `max_parse_retries` times. Only the failed items
+        are sent again. Completions that still fail are returned as they are, for the caller's
+        fallback parsing.
+        """
+        completions = await self.complete_all(all_messages, desc=desc)
+        failed = [i for i, completion in enumerate(completions) if not self._is_valid(completion, validate)]
+        n_failed = len(failed)
+        metrics.increment(f"{self.component_name}.items", len(completions))
+        metrics.increment(f"{self.component_name}.parse_failures", n_failed)
+
+        for attempt in range(1, self.max_parse_retries + 1):
+            if not failed:
+                break
+            metrics.increment(f"{self.component_name}.parse_retries", len(failed))
+            # Sample, since greedy decoding would repeat the same output with any seed
+            temperature = max(self.agent.keywords.get("temperature") or 0.0, RETRY_TEMPERATURE)
+            retried = await self.complete_all([all_messages[i] for i in failed], desc=f"{desc} (retry {attempt})",
+                                              seed=self.random_state + attempt, temperature=temperature)
+            still_failed = []
+            for i, completion in zip(failed, retried):
+                completions[i] = completion
+                if not self._is_valid(completion, validate):
+                    still_failed.append(i)
+            failed = still_failed
+
+        metrics.increment(f"{self.component_name}.unparsed", len(failed))
+        if n_failed:
+            logger.warning(f"{desc}: {n_failed} of {len(completions)} completions could not be parsed "
+                           f"({n_failed / len(completions):.1%}); {n_failed - len(failed)} fixed by retries, "
+                           f"{len(failed)} left to the fallback parser.")
+        return completions
+
+    @staticmethod
+    def _is_valid(completion: ChatCompletion, validate: Callable[[ChatCompletion], Any]) -> bool:
+        try:
+            validate(completion)
+        except ParseError:
+            return False
+        return True
+
+    async def _complete_all(self, all_messages: List[List[Dict[str, str]]], desc: str, **request_kwargs) -> List[ChatCompletion]:
+        completions: List[Optional[ChatCompletion]] = [None] * len(all_messages)
+        order = range(len(all_messages))
+        if self.dispatch_order == "longest_first" and len(all_messages) > self.batch_size:
+            # The most expensive requests first, so that none of them starts near the end
+            costs = [self.estimate_cost(messages, **request_kwargs) for messages in all_messages]
+            order = sorted(order, key=lambda i: -costs[i])
+        queue = ((idx, all_messages[idx]) for idx in order)
+        progress = tqdm(total=len(all_messages), desc=desc, ncols=80)
+
+        async def worker():
+            # Workers pull the next request as soon as one finishes, so a slow request
+            # does not hold back the rest of its batch.
+            for idx, messages in queue:
+                completions[idx] = await self.complete(messages, **request_kwargs)
+                progress.update(1)
+
+        n_workers = min(self.batch_size, len(all_messages))
+        workers = [asyncio.ensure_future(worker()) for _ in range(n_workers)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for w in workers:
+                w.cancel()
+            raise
+        finally:
+            progress.close()
+        return completions
@@ -6,6 +6,12 @@ Copied from MedRAG/src/utils.py and MedRAG/src/data/statpearls.py.
 import os
 import sys
 import json
+import time
+import shutil
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Tuple, Union
 import traceback
 import logging
@@ -19,6 +25,8 @@ import torch
 import tqdm
 import numpy as np
 
+from .metrics import metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -38,7 +46,10 @@ retriever_names = {
     "SPECTER": ["allenai/specter"],
     "MedCPT": ["ncbi/MedCPT-Query-Encoder"],
     "RRF-2": ["bm25", "ncbi/MedCPT-Query-Encoder"],
-    "RRF-4": ["bm25", "facebook/contriever", "allenai/specter", "ncbi/MedCPT-Query-Encoder"]
+    "RRF-4": ["bm25", "facebook/contriever", "allenai/specter", "ncbi/MedCPT-Query-Encoder"],
+    # Two-stage: BM25 or coarse IVF-PQ candidates, rescored exactly with MedCPT (see TwoStageRetriever)
+    "MedCPT-BM25": ["bm25>ncbi/MedCPT-Query-Encoder"],
+    "MedCPT-IVFPQ": ["ivfpq>ncbi/MedCPT-Query-Encoder"],
 }
 
 
@@ -66,97 +77,480 @@ class CustomizeSentenceTransformer(SentenceTransformer):  # change the default p
         cache_folder = kwargs.get('cache_folder', None)
         revision = kwargs.get('revision', None)
         trust_remote_code = kwargs.get('trust_remote_code', False)
+        # Non-default inference backends (e.g. "onnx", see query_encoder.py) and their model files
+        backend_args = {}
+        if getattr(self, "backend", "torch") != "torch":
+            backend_args["backend"] = self.backend
+        model_kwargs = kwargs.get('model_kwargs') or {}
         if 'token' in kwargs or 'cache_folder' in kwargs or 'revision' in kwargs or 'trust_remote_code' in kwargs:
             transformer_model = Transformer(
                 model_name_or_path,
                 cache_dir=cache_folder,
-                model_args={"token": token, "trust_remote_code": trust_remote_code, "revision": revision},
+                model_args={"token": token, "trust_remote_code": trust_remote_code, "revision": revision, **model_kwargs},
                 tokenizer_args={"token": token, "trust_remote_code": trust_remote_code, "revision": revision},
+                **backend_args,
             )
         else:
-            transformer_model = Transformer(model_name_or_path)
+            transformer_model = Transformer(model_name_or_path, model_args=model_kwargs, **backend_args)
         pooling_model = Pooling(transformer_model.get_word_embedding_dimension(), 'cls')
         return [transformer_model, pooling_model]
 
 
-def embed(chunk_dir, index_dir, model_name, **kwarg):
-    save_dir = os.path.join(index_dir, "embedding")
-
+def load_encoder(model_name, device=None):
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
     if "contriever" in model_name:
-        model = SentenceTransformer(model_name, device="cuda" if torch.cuda.is_available() else "cpu")
+        model = SentenceTransformer(model_name, device=device)
     else:
-        model = CustomizeSentenceTransformer(model_name, device="cuda" if torch.cuda.is_available() else "cpu")
-
+        model = CustomizeSentenceTransformer(model_name, device=device)
     model.eval()
+    return model
+
+
+def format_passages(items, model, model_name):
+    """Formats chunk items into the input format expected by the article encoder."""
+    if "specter" in model_name.lower():
+        return [model.tokenizer.sep_token.join([item["title"], item["content"]]) for item in items]
+    elif "contriever" in model_name.lower():
+        return [". ".join([item["title"], item["content"]]).replace('..', '.').replace("?.", "?") for item in items]
+    elif "medcpt" in model_name.lower():
+        return [[item["title"], item["content"]] for item in items]
+    else:
+        return [concat(item["title"], item["content"]) for item in items]
+
+
+def read_chunk_file(fpath):
+    """Streams the passages of a chunk file, skipping blank lines."""
+    with open(fpath) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def has_passages(fpath):
+    """True if the chunk file has a non-blank line."""
+    with open(fpath, "rb") as f:
+        return any(line.strip() for line in f)
+
+
+def count_passages(fpath):
+    """Number of passages (non-blank lines) of a chunk file."""
+    with open(fpath, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def save_npy_atomic(save_path, array):
+    """Writes `array` to a temporary file and renames it, so `save_path` is never partially written."""
+    tmp_path = save_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, save_path)
+
+
+# Encoder of the current embedding worker process
+_worker_model = None
 
-    fnames = sorted([fname for fname in os.listdir(chunk_dir) if fname.endswith(".jsonl")])
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+def _init_embed_worker(model_name, num_threads):
+    global _worker_model
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    _worker_model = load_encoder(model_name)
 
+
+def _embed_file(fpath, save_path, model_name, encode_kwargs):
+    """Encodes one chunk file into a float16 `.npy` shard. Returns (number of passages, embedding dim)."""
+    items = list(read_chunk_file(fpath))
+    if not items:
+        return 0, None
+    texts = format_passages(items, _worker_model, model_name)
+    # Encode in order of length, so every batch pads to a similar length, then restore the file order
+    lengths = [sum(map(len, t)) if isinstance(t, list) else len(t) for t in texts]
+    order = np.argsort(lengths, kind="stable")
     with torch.no_grad():
-        for fname in tqdm.tqdm(fnames, desc="Embedding"):
-            fpath = os.path.join(chunk_dir, fname)
-            save_path = os.path.join(save_dir, fname.replace(".jsonl", ".npy"))
-            if os.path.exists(save_path):
-                continue
-            if open(fpath).read().strip() == "":
-                continue
-            texts = [json.loads(item) for item in open(fpath).read().strip().split('\n')]
-            if "specter" in model_name.lower():
-                texts = [model.tokenizer.sep_token.join([item["title"], item["content"]]) for item in texts]
-            elif "contriever" in model_name.lower():
-                texts = [". ".join([item["title"], item["content"]]).replace('..', '.').replace("?.", "?") for item in
-                         texts]
-            elif "medcpt" in model_name.lower():
-                texts = [[item["title"], item["content"]] for item in texts]
-            else:
-                texts = [concat(item["title"], item["content"]) for item in texts]
-            embed_chunks = model.encode(texts, **kwarg)
-            np.save(save_path, embed_chunks)
-        embed_chunks = model.encode([""], **kwarg)
-    return embed_chunks.shape[-1]
+        sorted_embeds = _worker_model.encode([texts[i] for i in order], **encode_kwargs)
+    embed_chunks = np.empty_like(sorted_embeds, dtype=np.float16)
+    embed_chunks[order] = sorted_embeds
+    save_npy_atomic(save_path, embed_chunks)
+    return len(items), embed_chunks.shape[-1]
+
+
+def _embed_file_task(task):
+    return _embed_file(*task)
+
+
+def embed(chunk_dir, index_dir, model_name, num_workers=None, **kwarg):
+    """
+    Encodes every chunk file in `chunk_dir` into `index_dir/embedding/<chunk>.npy` (float16).
+
+    On CPU, files are encoded by `num_workers` processes (default: one per 4 cores). Shards are
+    written atomically, so an interrupted run can be restarted and continues with the missing
+    files. Returns the embedding dimension.
+    """
+    save_dir = os.path.join(index_dir, "embedding")
+    os.makedirs(save_dir, exist_ok=True)
+    # Remove partial shards of an interrupted run
+    for fname in os.listdir(save_dir):
+        if fname.endswith(".tmp"):
+            os.remove(os.path.join(save_dir, fname))
+
+    fnames = sorted([fname for fname in os.listdir(chunk_dir) if fname.endswith(".jsonl")])
+    done = [fname for fname in fnames if os.path.exists(os.path.join(save_dir, fname.replace(".jsonl", ".npy")))]
+    # Files without passages (empty or blank) get no shard, here and in `check_shard_counts`
+    todo = [
+        fname for fname in fnames
+        if fname not in set(done) and has_passages(os.path.join(chunk_dir, fname))
+    ]
+    logger.info(f"Embedding {len(todo)} chunk files ({len(done)} already embedded)")
+
+    if torch.cuda.is_available():
+        num_workers = 1  # A single process keeps the GPU busy
+    elif num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) // 4)
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers) if not torch.cuda.is_available() else None
+
+    h_dim = None
+    n_passages = 0
+    start = time.perf_counter()
+    tasks = [
+        (os.path.join(chunk_dir, fname), os.path.join(save_dir, fname.replace(".jsonl", ".npy")), model_name, kwarg)
+        for fname in todo
+    ]
+    progress = tqdm.tqdm(total=len(tasks), desc="Embedding")
+    if num_workers > 1 and len(tasks) > 1:
+        # "spawn": forked copies of an initialized torch runtime can deadlock
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(num_workers, initializer=_init_embed_worker, initargs=(model_name, num_threads)) as pool:
+            for n, dim in pool.imap_unordered(_embed_file_task, tasks):
+                n_passages += n
+                h_dim = dim or h_dim
+                progress.update(1)
+                progress.set_postfix(passages_per_s=f"{n_passages / (time.perf_counter() - start):.1f}")
+    elif tasks:
+        _init_embed_worker(model_name, None)
+        for task in tasks:
+            n, dim = _embed_file(*task)
+            n_passages += n
+            h_dim = dim or h_dim
+            progress.update(1)
+            progress.set_postfix(passages_per_s=f"{n_passages / (time.perf_counter() - start):.1f}")
+    progress.close()
+    elapsed = time.perf_counter() - start
+    if tasks:
+        logger.info(f"Embedded {n_passages} passages from {len(tasks)} files in {elapsed:.1f}s "
+                    f"({n_passages / max(elapsed, 1e-9):.1f} passages/s, {num_workers} workers)")
+
+    if h_dim is None:
+        # Everything was embedded by a previous run
+        for fname in done:
+            h_dim = np.load(os.path.join(save_dir, fname.replace(".jsonl", ".npy")), mmap_mode="r").shape[-1]
+            break
+    if h_dim is None:
+        raise ValueError(f"No passages to embed in {chunk_dir}: it has no non-empty .jsonl chunk files.")
+    return h_dim
+
+
+class IndexMetadata:
+    """
+    Maps FAISS row ids to `{"index": <line in chunk file>, "source": <chunk file name>}`.
+
+    Stored in binary as the chunk file names and their passage counts (`metadatas.npz`),
+    instead of one JSON line per passage.
+    """
+    def __init__(self, sources, counts):
+        self.sources = list(sources)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)])
+
+    def __len__(self):
+        return int(self.starts[-1])
 
+    def __getitem__(self, i):
+        i = int(i)
+        if i < 0:  # Same as a list of dicts
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Index row {i} out of range")
+        source_idx = int(np.searchsorted(self.starts, i, side="right")) - 1
+        return {"index": i - int(self.starts[source_idx]), "source": self.sources[source_idx]}
 
-def construct_index(index_dir, model_name, h_dim=768, HNSW=False, M=32):
-    with open(os.path.join(index_dir, "metadatas.jsonl"), 'w') as f:
-        f.write("")
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, sources=np.array(self.sources, dtype=str), counts=self.counts)
+        os.replace(tmp_path, path)
 
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["sources"].tolist(), data["counts"])
+
+    @classmethod
+    def concat(cls, parts):
+        return cls([s for p in parts for s in p.sources], np.concatenate([p.counts for p in parts]))
+
+
+def load_metadatas(index_dir):
+    """Loads the row metadata of an index: `metadatas.npz`, or `metadatas.jsonl` of older indexes."""
+    npz_path = os.path.join(index_dir, "metadatas.npz")
+    if os.path.exists(npz_path):
+        return IndexMetadata.load(npz_path)
+    return [json.loads(line) for line in open(os.path.join(index_dir, "metadatas.jsonl")).read().strip().split('\n')]
+
+
+def new_index(h_dim, model_name, HNSW=False, M=32, ef_construction=40):
     if HNSW:
-        M = M
-        if "specter" in model_name.lower():
-            index = faiss.IndexHNSWFlat(h_dim, M)
-        else:
-            index = faiss.IndexHNSWFlat(h_dim, M)
-            index.metric_type = faiss.METRIC_INNER_PRODUCT
+        # The metric must be passed to the constructor, so that the vector storage uses it too
+        metric = faiss.METRIC_L2 if "specter" in model_name.lower() else faiss.METRIC_INNER_PRODUCT
+        index = faiss.IndexHNSWFlat(h_dim, M, metric)
+        # Candidate list size while building the graph. Higher is slower to build but gives better recall.
+        index.hnsw.efConstruction = ef_construction
     else:
         if "specter" in model_name.lower():
             index = faiss.IndexFlatL2(h_dim)
         else:
             index = faiss.IndexFlatIP(h_dim)
+    return index
+
+
+def embedding_files(index_dir):
+    embedding_dir = os.path.join(index_dir, "embedding")
+    return [os.path.join(embedding_dir, fname) for fname in sorted(os.listdir(embedding_dir)) if fname.endswith(".npy")]
+
+
+def iter_embedding_blocks(paths, block_size=262144, num_loaders=4):
+    """
+    Yields (block, [(source, count), ...]) with float32 blocks of about `block_size` rows, in file order.
+
+    Up to `num_loaders` shard files are read ahead in threads, so at most one block and the
+    read-ahead shards are in memory. A file that fails to load raises instead of being
+    skipped, so the index never silently misses passages.
+    """
+    def load(path):
+        # Shards written by `embed` are float16; FAISS needs float32
+        return np.load(path).astype(np.float32, copy=False)
+
+    block, sources, n_rows = [], [], 0
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=num_loaders) as executor:
+        pending = deque((path, executor.submit(load, path)) for path in itertools.islice(paths, num_loaders))
+        while pending:
+            path, future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, executor.submit(load, next_path)))
+            try:
+                embeds = future.result()
+            except Exception as e:
+                raise IOError(f"Could not load embeddings from {path}: {e}") from e
+            block.append(embeds)
+            sources.append((os.path.basename(path).replace(".npy", ""), len(embeds)))
+            n_rows += len(embeds)
+            if n_rows >= block_size:
+                yield np.concatenate(block), sources
+                block, sources, n_rows = [], [], 0
+    if block:
+        yield np.concatenate(block), sources
+
+
+def _build_index(paths, index, block_size, num_loaders, desc="Loading embeddings"):
+    sources, counts = [], []
+    progress = tqdm.tqdm(total=len(paths), desc=desc)
+    for block, block_sources in iter_embedding_blocks(paths, block_size=block_size, num_loaders=num_loaders):
+        index.add(block)
+        for source, count in block_sources:
+            sources.append(source)
+            counts.append(count)
+        progress.update(len(block_sources))
+    progress.close()
+    return index, IndexMetadata(sources, counts)
+
+
+def check_shard_counts(metadata, chunk_dir):
+    """Raises if the embedding shards do not have one vector per passage of every chunk file."""
+    shard_counts = dict(zip(metadata.sources, metadata.counts.tolist()))
+    chunk_counts = {
+        fname[:-len(".jsonl")]: count_passages(os.path.join(chunk_dir, fname))
+        for fname in sorted(os.listdir(chunk_dir)) if fname.endswith(".jsonl")
+    }
+    mismatches = [
+        f"{source}: {shard_counts.get(source, 0)} vectors, {chunk_counts.get(source, 0)} passages"
+        for source in sorted(set(shard_counts) | set(chunk_counts))
+        if shard_counts.get(source, 0) != chunk_counts.get(source, 0)
+    ]
+    if mismatches:
+        raise ValueError(f"Embedding shards do not match the chunk files in {chunk_dir} ({len(mismatches)} files, e.g. "
+                         f"{'; '.join(mismatches[:5])}). Delete the stale shards from the embedding directory "
+                         f"and run again to re-embed them.")
 
-    for fname in tqdm.tqdm(sorted(os.listdir(os.path.join(index_dir, "embedding"))), desc="Loading embeddings"):
-        curr_path = os.path.join(index_dir, "embedding", fname)
-        curr_embed = np.load(curr_path)
-        try:
-            index.add(curr_embed)
-        except Exception as e:
-            logger.error(f"Error loading {curr_path}:\n{e}\n{traceback.format_exc()}")
-            continue
-        with open(os.path.join(index_dir, "metadatas.jsonl"), 'a+') as f:
-            f.write("\n".join(
-                [json.dumps({'index': i, 'source': fname.replace(".npy", "")}) for i in range(len(curr_embed))]) + '\n')
-        logger.debug(f"Wrote meta to {os.path.join(index_dir, 'metadatas.jsonl')}")
-    faiss.write_index(index, os.path.join(index_dir, "faiss.index"))
+
+def _publish_index(index_dir, index, metadata, index_name="faiss.index", metadata_name="metadatas.npz", chunk_dir=None):
+    """
+    Checks that every vector has metadata and, with `chunk_dir`, that every shard matches its chunk
+    file. Then atomically writes the metadata and the index.
+    """
+    if index.ntotal != len(metadata):
+        raise ValueError(f"Index has {index.ntotal} vectors but metadata for {len(metadata)} passages. Not writing {index_name}.")
+    if chunk_dir is not None:
+        check_shard_counts(metadata, chunk_dir)
+    metadata.save(os.path.join(index_dir, metadata_name))
+    # The index is written last: its existence marks a complete build
+    index_path = os.path.join(index_dir, index_name)
+    faiss.write_index(index, index_path + ".tmp")
+    os.replace(index_path + ".tmp", index_path)
+
+
+def _part_name(part_index, num_parts):
+    return f"part-{part_index:05d}-of-{num_parts:05d}"
+
+
+def build_index_part(index_dir, model_name, h_dim, part_index, num_parts, block_size=262144, num_loaders=4):
+    """
+    Builds part `part_index` of `num_parts` of a flat index into `index_dir/parts/`. Parts can be
+    built in parallel (or on several machines sharing `index_dir`) and combined with `merge_index_parts`.
+    """
+    paths = embedding_files(index_dir)
+    # Contiguous ranges of files, so that concatenating the parts keeps the file order
+    size = (len(paths) + num_parts - 1) // num_parts
+    paths = paths[part_index * size:(part_index + 1) * size]
+    parts_dir = os.path.join(index_dir, "parts")
+    os.makedirs(parts_dir, exist_ok=True)
+    index, metadata = _build_index(paths, new_index(h_dim, model_name), block_size, num_loaders,
+                                   desc=f"Building part {part_index}")
+    name = _part_name(part_index, num_parts)
+    _publish_index(parts_dir, index, metadata, index_name=f"{name}.index", metadata_name=f"{name}.npz")
+    return index.ntotal
+
+
+def _build_index_part_task(args):
+    return build_index_part(*args)
+
+
+def merge_index_parts(index_dir, model_name, h_dim, num_parts, HNSW=False, M=32, ef_construction=40, block_size=262144,
+                      chunk_dir=None):
+    """Combines the parts built by `build_index_part` into `faiss.index` and `metadatas.npz`."""
+    parts_dir = os.path.join(index_dir, "parts")
+    names = [_part_name(i, num_parts) for i in range(num_parts)]
+    missing = [n for n in names if not os.path.exists(os.path.join(parts_dir, f"{n}.index"))]
+    if missing:
+        raise FileNotFoundError(f"Missing index parts in {parts_dir}: {missing}")
+
+    index = new_index(h_dim, model_name, HNSW=HNSW, M=M, ef_construction=ef_construction)
+    metadata = IndexMetadata.concat([IndexMetadata.load(os.path.join(parts_dir, f"{n}.npz")) for n in names])
+    for name in tqdm.tqdm(names, desc="Merging index parts"):
+        part = faiss.read_index(os.path.join(parts_dir, f"{name}.index"))
+        if HNSW:
+            # HNSW graphs cannot be merged, so the part vectors are inserted block by block
+            for start in range(0, part.ntotal, block_size):
+                index.add(part.reconstruct_n(start, min(block_size, part.ntotal - start)))
+        else:
+            index.merge_from(part)
+        del part
+    _publish_index(index_dir, index, metadata, chunk_dir=chunk_dir)
+    shutil.rmtree(parts_dir)
+    return index
+
+
+def construct_index(index_dir, model_name, h_dim=768, HNSW=False, M=32, ef_construction=40, block_size=262144,
+                    num_loaders=4, num_parts=1, chunk_dir=None):
+    """
+    Builds `faiss.index` and `metadatas.npz` from the embedding shards in `index_dir/embedding`.
+
+    Shards are streamed in blocks of `block_size` vectors with `num_loaders` read-ahead threads.
+    With `num_parts` > 1, flat index parts are built in parallel processes and then merged.
+    The vector count is checked against the metadata before the index is written, and with
+    `chunk_dir`, the vector count of every shard against the passages of its chunk file.
+    """
+    if num_parts > 1:
+        ctx = multiprocessing.get_context("spawn")
+        tasks = [(index_dir, model_name, h_dim, i, num_parts, block_size, num_loaders) for i in range(num_parts)]
+        with ctx.Pool(num_parts) as pool:
+            pool.map(_build_index_part_task, tasks)
+        return merge_index_parts(index_dir, model_name, h_dim, num_parts, HNSW=HNSW, M=M,
+                                 ef_construction=ef_construction, block_size=block_size, chunk_dir=chunk_dir)
+
+    index, metadata = _build_index(embedding_files(index_dir),
+                                   new_index(h_dim, model_name, HNSW=HNSW, M=M, ef_construction=ef_construction),
+                                   block_size, num_loaders)
+    _publish_index(index_dir, index, metadata, chunk_dir=chunk_dir)
     return index
 
 
-class Retriever:
+class QueryEncoderMixin:
+    """
+    Query encoding and document loading shared by `Retriever` and `TwoStageRetriever`.
+    Expects `db_dir`, `chunk_dir` and `encoder_batch_size`; `load_embedding_function` sets
+    `embedding_function`.
+    """
+
+    def load_embedding_function(self, model_name, query_encoder_backend="torch", encoder_max_length=None,
+                                query_encoder=None):
+        # Imported here, query_encoder depends on this module
+        from .query_encoder import load_query_encoder
+        # A given encoder object (e.g. the random encoder of the retrieval benchmark) is used as is
+        self.embedding_function = query_encoder or load_query_encoder(
+            model_name,
+            backend=query_encoder_backend,
+            cache_dir=os.path.join(self.db_dir, "query_encoders"),
+        )
+        if encoder_max_length is not None:
+            # Longer queries are truncated
+            self.embedding_function.max_seq_length = encoder_max_length
+
+    def query_lengths(self, questions):
+        tokenizer = getattr(self.embedding_function, "tokenizer", None)
+        if tokenizer is None:
+            return [len(q.split()) for q in questions]
+        return [len(ids) for ids in tokenizer(questions, add_special_tokens=False)["input_ids"]]
+
+    def encode_queries(self, questions, **kwarg):
+        """
+        Encodes `questions` in batches of `encoder_batch_size` queries of similar token length, so
+        that little compute is spent on padding, and returns the embeddings in input order.
+        """
+        lengths = self.query_lengths(questions)
+        max_length = getattr(self.embedding_function, "max_seq_length", None)
+        if max_length:
+            lengths = [min(n, max_length) for n in lengths]
+        order = np.argsort(lengths, kind="stable")
+        embeds = None
+        for start in range(0, len(order), self.encoder_batch_size):
+            batch = order[start:start + self.encoder_batch_size]
+            batch_embeds = self.embedding_function.encode(
+                [questions[i] for i in batch], batch_size=len(batch), **kwarg)
+            if embeds is None:
+                embeds = np.empty((len(questions), batch_embeds.shape[-1]), dtype=batch_embeds.dtype)
+            embeds[batch] = batch_embeds
+            batch_lengths = [lengths[i] for i in batch]
+            metrics.increment("retriever.query_tokens", sum(batch_lengths))
+            metrics.increment("retriever.padded_query_tokens", max(batch_lengths) * len(batch))
+        return embeds
+
+    def idx2txt(self, indices):  # return List of Dict of str
+        """
+        Input: List of Dict( {"source": str, "index": int} )
+        Output: List of str
+        """
+        loaded_docs = []
+        for i in tqdm.tqdm(indices, total=len(indices), desc="Loading documents", disable=not logger.level==logging.DEBUG):
+            text_path = os.path.join(self.chunk_dir, i["source"] + ".jsonl")
+            with open(text_path, "r") as f:
+                whole_file = f.read().strip().split('\n')
+                doc = json.loads(whole_file[i["index"]])
+                loaded_docs.append(doc)
+        return loaded_docs
+
+
+
+class Retriever(QueryEncoderMixin):
 
     def __init__(self, retriever_name="ncbi/MedCPT-Query-Encoder", corpus_name="textbooks", db_dir="./corpus",
-                 HNSW=False, **kwarg):
+                 HNSW=False, query_encoder_backend="torch", encoder_batch_size=32, encoder_max_length=None,
+                 hnsw_m=32, hnsw_ef_construction=40, hnsw_ef_search=None, query_encoder=None, **kwarg):
         self.retriever_name = retriever_name
         self.corpus_name = corpus_name
+        self.encoder_batch_size = encoder_batch_size
+        # Default HNSW candidate list size at query time (None: keep the index setting)
+        self.hnsw_ef_search = hnsw_ef_search
 
         self.db_dir = db_dir
         if not os.path.exists(self.db_dir):
@@ -193,8 +587,7 @@ class Retriever:
         else:
             if os.path.exists(os.path.join(self.index_dir, "faiss.index")):
                 self.index = faiss.read_index(os.path.join(self.index_dir, "faiss.index"))
-                self.metadatas = [json.loads(line) for line in
-                                  open(os.path.join(self.index_dir, "metadatas.jsonl")).read().strip().split('\n')]
+                self.metadatas = load_metadatas(self.index_dir)
             else:
                 print("[In progress] Embedding the {:s} corpus with the {:s} retriever...".format(self.corpus_name,
                                                                                                   self.retriever_name.replace(
@@ -256,40 +649,43 @@ class Retriever:
                 print("[In progress] Embedding finished! The dimension of the embeddings is {:d}.".format(h_dim))
                 self.index = construct_index(index_dir=self.index_dir,
                                              model_name=self.retriever_name.replace("Query-Encoder", "Article-Encoder"),
-                                             h_dim=h_dim, HNSW=HNSW)
+                                             h_dim=h_dim, HNSW=HNSW, M=hnsw_m, ef_construction=hnsw_ef_construction,
+                                             chunk_dir=self.chunk_dir)
                 print("[Finished] Corpus indexing finished!")
-                self.metadatas = [json.loads(line) for line in
-                                  open(os.path.join(self.index_dir, "metadatas.jsonl")).read().strip().split('\n')]
-            if "contriever" in self.retriever_name.lower():
-                self.embedding_function = SentenceTransformer(
-                    self.retriever_name,
-                    device="cuda" if torch.cuda.is_available() else "cpu"
-                )
-            else:
-                self.embedding_function = CustomizeSentenceTransformer(
-                    self.retriever_name,
-                    device="cuda" if torch.cuda.is_available() else "cpu"
-                )
-            self.embedding_function.eval()
+                self.metadatas = load_metadatas(self.index_dir)
+            self.load_embedding_function(self.retriever_name, query_encoder_backend, encoder_max_length, query_encoder)
 
-    def get_relevant_documents(self, questions, k=32, id_only=False, **kwarg):
+    @property
+    def is_hnsw(self):
+        return hasattr(self.index, "hnsw")
+
+    def search(self, query_embeds, k, ef_search=None):
+        """FAISS search. `ef_search` (or the configured `hnsw_ef_search`) sets the HNSW search depth of this call."""
+        ef_search = ef_search or self.hnsw_ef_search
+        if ef_search and self.is_hnsw:
+            return self.index.search(query_embeds, k, params=faiss.SearchParametersHNSW(efSearch=ef_search))
+        return self.index.search(query_embeds, k)
+
+    def get_relevant_documents(self, questions, k=32, id_only=False, ef_search=None, **kwarg):
         assert isinstance(questions, list), "Questions should be a list of strings"
         # BM25 not updated for batched
         if "bm25" in self.retriever_name.lower():
             res_ = [[] for _ in range(len(questions))]
             for idx, question in enumerate(questions):
-                hits = self.index.search(question, k=k)
+                with metrics.stage("retriever.bm25_search"):
+                    hits = self.index.search(question, k=k)
                 res_[idx].append(np.array([h.score for h in hits]))
                 ids = [h.docid for h in hits]
                 indices = [{"source": '_'.join(h.docid.split('_')[:-1]), "index": eval(h.docid.split('_')[-1])} for h in
                            hits]
         else:
             logger.debug("Embedding")
-            with torch.no_grad():
-                query_embeds = self.embedding_function.encode(questions, **kwarg)
+            with metrics.stage("retriever.query_encoding"), torch.no_grad():
+                query_embeds = self.encode_queries(questions, **kwarg)
             # ( scores: [# questions x # docs], index IDs: [# questions x # docs] )
             logger.debug("Searching index")
-            res_ = self.index.search(query_embeds, k=k)
+            with metrics.stage("retriever.faiss_search"):
+                res_ = self.search(query_embeds, k, ef_search=ef_search)
             logger.debug(f"Gathering IDs")
             ids = [
                 ['_'.join([self.metadatas[i]["source"], str(self.metadatas[i]["index"])]) for i in res_[1][idx]] for idx in range(len(questions))
@@ -304,26 +700,145 @@ class Retriever:
         else:
             logger.debug("Loading documents")
             # Loading documents at this stage is slow
-            return [self.idx2txt(idx_list) for idx_list in indices], scores
+            with metrics.stage("retriever.document_loading"):
+                docs = [self.idx2txt(idx_list) for idx_list in indices]
+            return docs, scores
 
-    def idx2txt(self, indices):  # return List of Dict of str
-        """
-        Input: List of Dict( {"source": str, "index": int} )
-        Output: List of str
-        """
-        loaded_docs = []
-        for i in tqdm.tqdm(indices, total=len(indices), desc="Loading documents", disable=not logger.level==logging.DEBUG):
-            text_path = os.path.join(self.chunk_dir, i["source"] + ".jsonl")
-            with open(text_path, "r") as f:
-                whole_file = f.read().strip().split('\n')
-                doc = json.loads(whole_file[i["index"]])
-                loaded_docs.append(doc)
-        return loaded_docs
+
+def dense_retriever_name(retriever_name):
+    """The dense encoder of a retriever name (e.g. "bm25>ncbi/MedCPT-Query-Encoder"), or None for BM25."""
+    if ">" in retriever_name:
+        return retriever_name.split(">", 1)[1]
+    return None if "bm25" in retriever_name.lower() else retriever_name
+
+
+def build_coarse_index(index_dir, model_name, nlist=None, pq_m=64, train_size=200000, block_size=262144, seed=42):
+    """
+    Builds an IVF-PQ index (`coarse.index`) from the embedding shards in `index_dir/embedding`.
+    It only proposes candidates, which are then rescored exactly, so a small, fast index is enough.
+    """
+    paths = embedding_files(index_dir)
+    shards = [np.load(path, mmap_mode="r") for path in paths]
+    metadata = IndexMetadata([os.path.basename(p).replace(".npy", "") for p in paths], [len(s) for s in shards])
+    n_total, h_dim = len(metadata), shards[0].shape[-1]
+    # ~4 * sqrt(n) lists, with at least 39 training points per list
+    nlist = nlist or max(1, min(int(4 * np.sqrt(n_total)), n_total // 39))
+    # 8-bit codes need 256 * 39 training vectors; small corpora get fewer centroids per sub-quantizer
+    pq_bits = min(8, max(1, int(np.log2(max(min(train_size, n_total) // 39, 2)))))
+    metric = faiss.METRIC_L2 if "specter" in model_name.lower() else faiss.METRIC_INNER_PRODUCT
+    index = faiss.index_factory(h_dim, f"IVF{nlist},PQ{pq_m}x{pq_bits}", metric)
+
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(n_total, size=min(train_size, n_total), replace=False))
+    shard_ids = np.searchsorted(metadata.starts, sample_rows, side="right") - 1
+    sample = np.stack([shards[s][r - metadata.starts[s]] for s, r in zip(shard_ids, sample_rows)]).astype(np.float32)
+    logger.info(f"Training coarse index IVF{nlist},PQ{pq_m}x{pq_bits} on {len(sample)} of {n_total} vectors")
+    index.train(sample)
+    index, _ = _build_index(paths, index, block_size, num_loaders=4, desc="Building coarse index")
+    _publish_index(index_dir, index, metadata, index_name="coarse.index", metadata_name="coarse_metadatas.npz")
+    return index
+
+
+class TwoStageRetriever(QueryEncoderMixin):
+    """
+    Dense retrieval without exhaustive search: a cheap first stage proposes `n_candidates`
+    passages per query (BM25, or a coarse IVF-PQ index), and only those are scored exactly
+    with the query embedding, using their vectors from the embedding shards.
+
+    `retriever_name` is "<first stage>><dense encoder>", e.g. "bm25>ncbi/MedCPT-Query-Encoder"
+    or "ivfpq>ncbi/MedCPT-Query-Encoder".
+    """
+
+    def __init__(self, retriever_name="bm25>ncbi/MedCPT-Query-Encoder", corpus_name="textbooks", db_dir="./corpus",
+                 n_candidates=100, coarse_nprobe=16, query_encoder_backend="torch", encoder_batch_size=32,
+                 encoder_max_length=None, query_encoder=None, **kwarg):
+        self.retriever_name = retriever_name
+        self.corpus_name = corpus_name
+        self.db_dir = db_dir
+        self.candidate_source, self.dense_name = retriever_name.split(">", 1)
+        self.n_candidates = n_candidates
+        self.coarse_nprobe = coarse_nprobe
+        self.encoder_batch_size = encoder_batch_size
+        self.chunk_dir = os.path.join(self.db_dir, self.corpus_name, "chunk")
+        self.index_dir = os.path.join(self.db_dir, self.corpus_name, "index",
+                                      self.dense_name.replace("Query-Encoder", "Article-Encoder"))
+        if not os.path.isdir(os.path.join(self.index_dir, "embedding")):
+            raise FileNotFoundError(f"Two-stage retrieval needs the passage embeddings in {self.index_dir}/embedding. "
+                                    f"Load the '{self.dense_name}' retriever once to download or compute them.")
+
+        if self.candidate_source == "bm25":
+            self.first_stage = Retriever("bm25", corpus_name, db_dir)
+        elif self.candidate_source == "ivfpq":
+            coarse_path = os.path.join(self.index_dir, "coarse.index")
+            if not os.path.exists(coarse_path):
+                build_coarse_index(self.index_dir, self.dense_name)
+            self.coarse_index = faiss.read_index(coarse_path)
+            self.coarse_index.nprobe = coarse_nprobe
+            self.metadatas = IndexMetadata.load(os.path.join(self.index_dir, "coarse_metadatas.npz"))
+        else:
+            raise ValueError(f"Unknown candidate source '{self.candidate_source}'. Options: bm25, ivfpq")
+
+        # Memory-mapped embedding shards, opened on first use
+        self._shards = {}
+        self.l2 = "specter" in self.dense_name.lower()
+        self.load_embedding_function(self.dense_name, query_encoder_backend, encoder_max_length, query_encoder)
+
+    def shard(self, source):
+        if source not in self._shards:
+            self._shards[source] = np.load(os.path.join(self.index_dir, "embedding", f"{source}.npy"), mmap_mode="r")
+        return self._shards[source]
+
+    def candidates(self, questions, query_embeds):
+        """First stage: a list of {"source", "index"} candidates per question."""
+        if self.candidate_source == "bm25":
+            hits = self.first_stage.index.batch_search(
+                questions, [str(i) for i in range(len(questions))], k=self.n_candidates, threads=8)
+            return [
+                [{"source": "_".join(h.docid.split("_")[:-1]), "index": int(h.docid.split("_")[-1])} for h in hits[str(i)]]
+                for i in range(len(questions))
+            ]
+        _, rows = self.coarse_index.search(query_embeds, self.n_candidates)
+        return [[self.metadatas[r] for r in row if r >= 0] for row in rows]
+
+    def get_relevant_documents(self, questions, k=32, id_only=False, **kwarg):
+        assert isinstance(questions, list), "Questions should be a list of strings"
+        with metrics.stage("retriever.query_encoding"), torch.no_grad():
+            query_embeds = np.asarray(self.encode_queries(questions, **kwarg), dtype=np.float32)
+        with metrics.stage("retriever.candidate_search"):
+            candidates = self.candidates(questions, query_embeds)
+
+        indices, scores = [], []
+        with metrics.stage("retriever.rescoring"):
+            for query, cands in zip(query_embeds, candidates):
+                if not cands:
+                    indices.append([])
+                    scores.append([])
+                    continue
+                vectors = np.stack([self.shard(c["source"])[c["index"]] for c in cands]).astype(np.float32)
+                if self.l2:
+                    cand_scores = np.sum((vectors - query) ** 2, axis=1)
+                    top = np.argsort(cand_scores, kind="stable")[:k]
+                else:
+                    cand_scores = vectors @ query
+                    top = np.argsort(-cand_scores, kind="stable")[:k]
+                indices.append([cands[i] for i in top])
+                scores.append(cand_scores[top].tolist())
+        metrics.increment("retriever.rescored_candidates", sum(len(c) for c in candidates))
+
+        ids = [["_".join([i["source"], str(i["index"])]) for i in idx_list] for idx_list in indices]
+        if id_only:
+            return [[{"id": i} for i in id_list] for id_list in ids], scores
+        with metrics.stage("retriever.document_loading"):
+            docs = [self.idx2txt(idx_list) for idx_list in indices]
+        return docs, scores
 
 
 class RetrievalSystem:
 
-    def __init__(self, retriever_name="MedCPT", corpus_name="Textbooks", db_dir="./corpus", HNSW=False, cache=False):
+    def __init__(self, retriever_name="MedCPT", corpus_name="Textbooks", db_dir="./corpus", HNSW=False, cache=False,
+                 query_encoder_backend="torch", encoder_batch_size=32, encoder_max_length=None,
+                 hnsw_m=32, hnsw_ef_construction=40, hnsw_ef_search=None, n_candidates=100, coarse_nprobe=16,
+                 query_encoder=None):
         self.retriever_name = retriever_name
         self.corpus_name = corpus_name
         assert self.corpus_name in corpus_names
@@ -335,7 +850,17 @@ class RetrievalSystem:
             for corpus in corpus_names[self.corpus_name]:
                 logger.debug(f"Loading {corpus} for {retriever}")
                 try:
-                    r = Retriever(retriever, corpus, db_dir, HNSW=HNSW)
+                    with metrics.stage("retriever.load"):
+                        if ">" in retriever:
+                            r = TwoStageRetriever(retriever, corpus, db_dir, n_candidates=n_candidates,
+                                                  coarse_nprobe=coarse_nprobe, query_encoder_backend=query_encoder_backend,
+                                                  encoder_batch_size=encoder_batch_size,
+                                                  encoder_max_length=encoder_max_length, query_encoder=query_encoder)
+                        else:
+                            r = Retriever(retriever, corpus, db_dir, HNSW=HNSW, query_encoder_backend=query_encoder_backend,
+                                          encoder_batch_size=encoder_batch_size, encoder_max_length=encoder_max_length,
+                                          hnsw_m=hnsw_m, hnsw_ef_construction=hnsw_ef_construction,
+                                          hnsw_ef_search=hnsw_ef_search, query_encoder=query_encoder)
                 except Exception as e:
                     logger.error(f"Error loading {retriever}:\n{e}\n{traceback.format_exc()}")
                     exit(1)
@@ -380,7 +905,8 @@ class RetrievalSystem:
         output = []
         for q_idx, ret_dict in retrieval_per_question.items():
             logger.debug("In merge")
-            t, s = self.merge(ret_dict["text"], ret_dict["scores"], k=k, rrf_k=rrf_k)
+            with metrics.stage("retriever.merge"):
+                t, s = self.merge(ret_dict["text"], ret_dict["scores"], k=k, rrf_k=rrf_k)
             logger.debug("Out of merge")
             # The use_cache here is not compatible with MedRAGRetriever
             if not id_only:
@@ -438,6 +964,10 @@ class RetrievalSystem:
 class DocExtracter:
 
     def __init__(self, db_dir="./corpus", cache=False, corpus_name="MedCorp"):
+        with metrics.stage("doc_extracter.init"):
+            self._init(db_dir=db_dir, cache=cache, corpus_name=corpus_name)
+
+    def _init(self, db_dir, cache, corpus_name):
         self.db_dir = db_dir
         self.cache = cache
         print("Initializing the document extracter...")
@@ -459,6 +989,7 @@ class DocExtracter:
                     os.system("python src/data/statpearls.py")
         if self.cache:
             if os.path.exists(os.path.join(self.db_dir, "_".join([corpus_name, "id2text.json"]))):
+                metrics.increment("doc_extracter.index_cache_hits")
                 self.dict = json.load(open(os.path.join(self.db_dir, "_".join([corpus_name, "id2text.json"]))))
             else:
                 self.dict = {}
@@ -476,6 +1007,7 @@ class DocExtracter:
                     json.dump(self.dict, f)
         else:
             if os.path.exists(os.path.join(self.db_dir, "_".join([corpus_name, "id2path.json"]))):
+                metrics.increment("doc_extracter.index_cache_hits")
                 self.dict = json.load(open(os.path.join(self.db_dir, "_".join([corpus_name, "id2path.json"]))))
             else:
                 self.dict = {}
@@ -496,6 +1028,12 @@ class DocExtracter:
         logger.debug(f"DocExtracter.extract() {ids=}")
         if isinstance(ids, dict):
             ids = [ids]
+        with metrics.stage("doc_extracter.extract"):
+            output = self._extract(ids)
+        metrics.increment("doc_extracter.lookups", len(ids))
+        return output
+
+    def _extract(self, ids: List[Union[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
         if self.cache:
             output = []
             for i in ids:
@@ -6,14 +6,23 @@ import sys
 import logging
 import json
 import re
-from typing import List, Any, Dict
+import asyncio
+from typing import List, Any, Dict, Iterable, Iterator, AsyncIterator
 from argparse import ArgumentParser
 
-import jsonlines
-
-from .utils import parse_sentences, load_config
+from .utils import parse_sentences_batch, load_config, chunker
 from .config_schema import MedScoreConfig
 from .registry import build_component
+from .metrics import metrics
+from .llm import connection_stats
+from .shard import shard_of, shard_dir
+from .aggregate import aggregate_stream, DatasetSummary, write_summary
+from .profiling import start_profiler, PROFILE_MODES
+from .storage import read_records, open_writer, output_path, find_output, OUTPUT_FORMATS
+from .incremental import (
+    config_fingerprint, evidence_hashes, record_hashes, load_manifest, remove_manifest, write_manifest, find_changed_ids,
+    load_previous_results, splice_results,
+)
 
 
 # --- Setup Logging ---
@@ -22,28 +31,45 @@ logging.basicConfig(level=logging.INFO, format=FORMAT)
 logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
+# Claims per verifier call in the command-line pipeline: only one chunk's evidence is in memory
+VERIFY_CHUNK_SIZE = 10000
+
 ###################
 # Helpers
 ###################
 class MedScore:
     """The main MedScore pipeline class."""
-    def __init__(self, config: MedScoreConfig):
+    def __init__(self, config: MedScoreConfig, build_verifier: bool = True):
         """
         Initializes the MedScore pipeline from a validated Pydantic config object.
+        Without `build_verifier`, it can only decompose (e.g. before `medscore retrieve`
+        creates the verifier's evidence store).
         """
         # Build the decomposer and verifier from the config using the registry
         logger.info(f"Building decomposer of type: {config.decomposer.type}")
         self.decomposer = build_component(config.decomposer, "decomposer")
 
-        logger.info(f"Building verifier of type: {config.verifier.type}")
-        self.verifier = build_component(config.verifier, "verifier")
+        self.verifier = None
+        if build_verifier:
+            logger.info(f"Building verifier of type: {config.verifier.type}")
+            self.verifier = build_component(config.verifier, "verifier")
         self.response_key = config.response_key
         # If True, inputs are expected to include a pre-senticized "sentences" field.
         self.presenticized = getattr(config, "presenticized", False)
 
     def decompose(self, dataset: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Decomposes responses from a dataset into individual claims."""
-        decomposer_input = []
+        decomposer_input = self.prepare_decomposer_input(dataset)
+        if not decomposer_input:
+            logger.error("No valid inputs found for the decomposer.")
+            return []
+
+        decompositions = self.decomposer(decomposer_input)
+        return decompositions
+
+    def prepare_decomposer_input(self, dataset: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Splits responses into sentences and pairs every sentence with its context."""
+        valid_items = []
         for item in dataset:
             # Accept items with 'sentences' when presenticized; otherwise require response_key.
             if self.presenticized:
@@ -54,13 +80,17 @@ class MedScore:
                 if self.response_key not in item:
                     logger.warning(f"ID '{item.get('id')}' missing response_key '{self.response_key}'. Skipping.")
                     continue
+            valid_items.append(item)
 
-            # Obtain sentences either from provided field or by parsing the response text
-            if self.presenticized:
-                sentences = item["sentences"]
-            else:
-                sentences = parse_sentences(item[self.response_key])
+        # Obtain sentences either from provided field or by parsing the response texts in one pass
+        if self.presenticized:
+            all_sentences = [item["sentences"] for item in valid_items]
+        else:
+            with metrics.stage("medscore.sentence_splitting"):
+                all_sentences = parse_sentences_batch([item[self.response_key] for item in valid_items])
 
+        decomposer_input = []
+        for item, sentences in zip(valid_items, all_sentences):
             for idx, sentence in enumerate(sentences):
                 # Support sentence as dict (with 'text' and optional 'sentence_id') or as plain string
                 if isinstance(sentence, dict):
@@ -84,13 +114,7 @@ class MedScore:
                     "context": context,
                     "sentence": sentence_text,
                 })
-
-        if not decomposer_input:
-            logger.error("No valid inputs found for the decomposer.")
-            return []
-
-        decompositions = self.decomposer(decomposer_input)
-        return decompositions
+        return decomposer_input
 
     def verify(self, decompositions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Verifies a list of decomposed claims."""
@@ -102,6 +126,95 @@ class MedScore:
         verifier_output = self.verifier(non_empty_decompositions)
         return verifier_output
 
+    def iter_verify(self, decompositions: List[Dict[str, Any]], chunk_size: int = VERIFY_CHUNK_SIZE) -> Iterator[List[Dict[str, Any]]]:
+        """Like `verify`, but verifies `chunk_size` claims at a time and yields the verifications of each chunk."""
+        non_empty_decompositions = [d for d in decompositions if d.get("claim") is not None]
+        if not non_empty_decompositions:
+            logger.warning("No valid claims to verify.")
+            return
+        for chunk in chunker(non_empty_decompositions, chunk_size):
+            # Copies, since some verifiers add the evidence to their input records
+            with metrics.stage("medscore.verify"):
+                verifications = self.verifier([dict(d) for d in chunk])
+            yield verifications
+
+    # --- Async API ---
+    # Safe to use from a running event loop (e.g. a web service). All LLM requests share
+    # one connection pool and the decomposer/verifier `batch_size` concurrency budgets.
+
+    async def adecompose(self, dataset: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Async version of `decompose`."""
+        # Sentence splitting is blocking, so run it in a thread instead of on the caller's event loop
+        decomposer_input = await asyncio.to_thread(self.prepare_decomposer_input, dataset)
+        if not decomposer_input:
+            logger.error("No valid inputs found for the decomposer.")
+            return []
+        return await self.decomposer.adecompose(decomposer_input)
+
+    async def averify(self, decompositions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Async version of `verify`."""
+        non_empty_decompositions = [d for d in decompositions if d.get("claim") is not None]
+        if not non_empty_decompositions:
+            logger.warning("No valid claims to verify.")
+            return []
+        return await self.verifier.averify(non_empty_decompositions)
+
+    async def ascore(self, dataset: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Decomposes, verifies and aggregates a dataset. Returns one scored record per `id`."""
+        decompositions = await self.adecompose(dataset)
+        verifications = await self.averify(decompositions)
+        return aggregate_results(dataset, verifications)
+
+    async def astream(
+            self,
+            dataset: Iterable[Dict[str, Any]],
+            chunk_size: int = 8,
+            max_chunks_in_flight: int = 4,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Scores a dataset in chunks of `chunk_size` responses and yields scored records as soon
+        as their chunk finishes, i.e. in completion order rather than input order.
+        """
+        pending = set()
+        try:
+            for chunk in chunker(dataset, chunk_size):
+                pending.add(asyncio.ensure_future(self.ascore(list(chunk))))
+                if len(pending) >= max_chunks_in_flight:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        for record in task.result():
+                            yield record
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for record in task.result():
+                        yield record
+        finally:
+            # The consumer stopped early or a chunk failed
+            for task in pending:
+                task.cancel()
+
+
+def aggregate_results(dataset: List[Dict[str, Any]], verifications: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Combines claim verifications by `id` and scores each response by its mean claim score
+    (and mean `support_prob`, if the verifier produced one). See `medscore.aggregate`.
+    """
+    ids = [item["id"] for item in dataset]
+    # Group verifications in any order like the pipeline output, handing each group over once
+    groups = {item_id: [] for item_id in ids}
+    for verification in verifications:
+        if verification["id"] in groups:
+            groups[verification["id"]].append(verification)
+    ordered = (verification for item_id in list(groups) for verification in groups.pop(item_id))
+    return list(aggregate_stream(ids, ordered))
+
+
+def stop_profiler(profiler):
+    if profiler is not None:
+        summary_file = profiler.stop()
+        logger.info(f"Profile saved to {os.path.dirname(summary_file)} (summary: {summary_file})")
+
 
 def parse_args():
     """Parse command line arguments."""
@@ -109,8 +222,14 @@ def parse_args():
     parser.add_argument("--config", type=str, required=True, help="Path to the YAML configuration file.")
     parser.add_argument("--input_file", type=str, help="Override the input data file specified in the config.")
     parser.add_argument("--output_dir", type=str, help="Override the output directory specified in the config.")
+    parser.add_argument("--output_format", type=str, choices=OUTPUT_FORMATS, help="Override the output file format specified in the config.")
     parser.add_argument("--decompose_only", action="store_true", help="Only run the decomposition step.")
     parser.add_argument("--verify_only", action="store_true", help="Only run the verification step (requires existing decomposition file).")
+    parser.add_argument("--incremental", action="store_true", help="Only score records that are new or changed since the previous run into `output_dir` (see `manifest.json`).")
+    parser.add_argument("--num_shards", type=int, default=1, help="Split the input into this many shards by `id` hash (see `medscore merge`).")
+    parser.add_argument("--shard_index", type=int, default=0, help="Index of the shard to run when --num_shards > 1.")
+    parser.add_argument("--prometheus", action="store_true", help="Also write run metrics in Prometheus text format to `output_dir/metrics.prom`.")
+    parser.add_argument("--profile", type=str, choices=PROFILE_MODES, help="Profile CPU time or memory of each pipeline stage. Writes `output_dir/profile/`.")
     parser.add_argument("--debug", action="store_true", help="Print debug logs.")
     args = parser.parse_args()
     return args
@@ -119,91 +238,179 @@ def parse_args():
 #################
 # Main
 #################
-def main():
-    """Main entry point for the command-line script."""
-    args = parse_args()
-
-    if args.debug:
-        logger.setLevel(logging.DEBUG)
-
-    # Load configuration from YAML file
-    # This also applies any command-line overrides for input/output paths.
-    medscore_config = load_config(args.config, argument_overrides=vars(args))
-
-    # Validate required fields
-    if not medscore_config.input_file:
-        logger.error("Input file must be specified either in the config or via --input_file.")
-        sys.exit(1)
-
-    if not medscore_config.output_dir:
-        medscore_config.output_dir = "."
-        logger.warning("Output directory not specified. Defaulting to current directory.")
-
-    output_dir = medscore_config.output_dir
-    input_file = medscore_config.input_file
-
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-
+def run_pipeline(args, medscore_config: MedScoreConfig, output_dir: str, input_file: str):
+    """Runs decomposition, verification and aggregation for the parsed command line arguments."""
     # Initialize MedScore with the validated config
-    scorer = MedScore(medscore_config)
+    with metrics.stage("medscore.setup"):
+        scorer = MedScore(medscore_config, build_verifier=not args.decompose_only)
 
     # Load data
     try:
-        with jsonlines.open(input_file) as reader:
-            dataset = [item for item in reader.iter()]
+        with metrics.stage("medscore.load_input"):
+            dataset = [
+                item for item in read_records(input_file)
+                if args.num_shards == 1 or shard_of(item.get("id"), args.num_shards) == args.shard_index
+            ]
     except (FileNotFoundError, IOError) as e:
         logger.error(f"Could not read input file at {input_file}: {e}")
         sys.exit(1)
 
-    decomp_output_file = os.path.join(output_dir, "decompositions.jsonl")
-    verif_output_file = os.path.join(output_dir, "verifications.jsonl")
-    final_output_file = os.path.join(output_dir, "output.jsonl")
+    output_format = medscore_config.output_format
+    decomp_output_file = output_path(output_dir, "decompositions", output_format)
+    verif_output_file = output_path(output_dir, "verifications", output_format)
+    final_output_file = output_path(output_dir, "output", output_format)
+
+    # Incremental mode: reuse the previous results of records that did not change
+    fingerprint = config_fingerprint(medscore_config)
+    hashes = record_hashes(dataset, medscore_config.response_key,
+                           evidence_hashes(medscore_config, (item.get("id") for item in dataset)))
+    manifest = load_manifest(output_dir)
+    to_score = dataset
+    previous_decompositions, previous_verifications = {}, {}
+    if args.incremental:
+        changed_ids = find_changed_ids(hashes, manifest, fingerprint)
+        unchanged_ids = set(hashes) - changed_ids
+        if args.verify_only:
+            # The new decompositions come from a previous `--incremental --decompose_only` run
+            decomposed = (manifest or {}).get("decomposed", {})
+            missing = [item_id for item_id in changed_ids if decomposed.get(item_id) != hashes[item_id]]
+            if missing:
+                logger.error(f"{len(missing)} new or changed ids are not decomposed yet, e.g. '{missing[0]}'. "
+                             f"Run with --incremental --decompose_only first.")
+                sys.exit(1)
+        if unchanged_ids:
+            try:
+                with metrics.stage("medscore.load_input"):
+                    if not args.verify_only:
+                        previous_decompositions = load_previous_results(output_dir, "decompositions", unchanged_ids, output_format)
+                    if not args.decompose_only:
+                        previous_verifications = load_previous_results(output_dir, "verifications", unchanged_ids, output_format)
+            except FileNotFoundError as e:
+                logger.warning(f"{e}. Scoring all records.")
+                changed_ids, unchanged_ids = set(hashes), set()
+                previous_decompositions, previous_verifications = {}, {}
+        to_score = [item for item in dataset if str(item.get("id")) in changed_ids]
+        metrics.increment("medscore.rescored_ids", len(changed_ids))
+        metrics.increment("medscore.reused_ids", len(unchanged_ids))
+        logger.info(f"Incremental run: rescoring {len(changed_ids)} ids, reusing {len(unchanged_ids)} ids.")
+    # The output files are about to be overwritten, so the old manifest no longer describes them.
+    # An incremental decomposition leaves the verifications and output, so it keeps the manifest.
+    if not (args.incremental and args.decompose_only):
+        remove_manifest(output_dir)
 
     # --- Main Pipeline Execution ---
     decompositions = []
+    new_decompositions = []
     if not args.verify_only:
         logger.info(f"Starting decomposition for {input_file}...")
-        decompositions = scorer.decompose(dataset)
-        with jsonlines.open(decomp_output_file, 'w') as writer:
+        with metrics.stage("medscore.decompose"):
+            decompositions = new_decompositions = scorer.decompose(to_score) if to_score else []
+        if args.incremental:
+            decompositions = splice_results(dataset, new_decompositions, previous_decompositions)
+        with metrics.stage("medscore.write_output"), open_writer(decomp_output_file) as writer:
             writer.write_all(decompositions)
         logger.info(f"Decompositions saved to {decomp_output_file}")
         if args.decompose_only:
+            if args.incremental:
+                # For `--incremental --verify_only`, which verifies the ids decomposed here
+                write_manifest(output_dir, (manifest or {}).get("config", fingerprint), (manifest or {}).get("records", {}),
+                               decomposed={item_id: hashes[item_id] for item_id in changed_ids})
+            metrics.dump(output_dir, prometheus=args.prometheus)
             logger.info("Decomposition finished.")
-            sys.exit(0)
+            return
 
     if args.verify_only:
-        try:
-            with jsonlines.open(decomp_output_file, 'r') as reader:
-                decompositions = [item for item in reader.iter()]
-            logger.info(f"Loaded existing decompositions from {decomp_output_file}")
-        except FileNotFoundError:
+        # Decompositions may have been written in a different format than the current output_format
+        existing_decomp_file = find_output(output_dir, "decompositions", output_format)
+        if existing_decomp_file is None:
             logger.error(f"Verify-only mode requires an existing decomposition file at {decomp_output_file}")
             sys.exit(1)
+        with metrics.stage("medscore.load_input"):
+            decompositions = list(read_records(existing_decomp_file))
+        new_decompositions = decompositions
+        if args.incremental:
+            new_decompositions = [d for d in decompositions if str(d.get("id")) in changed_ids]
+        logger.info(f"Loaded existing decompositions from {existing_decomp_file}")
 
     logger.info("Starting verification...")
-    verifications = scorer.verify(decompositions)
-    with jsonlines.open(verif_output_file, 'w') as writer:
-        writer.write_all(verifications)
+    if args.incremental:
+        with metrics.stage("medscore.verify"):
+            new_verifications = scorer.verify(new_decompositions) if to_score else []
+        verification_chunks = [splice_results(dataset, new_verifications, previous_verifications)]
+        del new_verifications, previous_verifications
+    else:
+        # Verified and written chunk by chunk, so the evidence of all claims is never in memory at once
+        verification_chunks = scorer.iter_verify(new_decompositions) if to_score else []
+    with open_writer(verif_output_file) as writer:
+        for chunk in verification_chunks:
+            with metrics.stage("medscore.write_output"):
+                writer.write_all(chunk)
+    del verification_chunks
     logger.info(f"Verifications saved to {verif_output_file}")
 
-    # Combine and aggregate scores
+    # Combine and aggregate scores, streaming the verifications back from their file. They are
+    # in input order, so each response is written as soon as its claims are complete.
     logger.info("Aggregating results...")
-    combined_output = {item["id"]: {"id": item["id"], "claims": []} for item in dataset}
-    for verif in verifications:
-        claim_info = {k: v for k, v in verif.items() if k not in {"id", "sentence_id", "claim_id"}}
-        if verif['id'] in combined_output:
-            combined_output[verif['id']]['claims'].append(claim_info)
+    summary = DatasetSummary()
+    with metrics.stage("medscore.aggregate"), open_writer(final_output_file) as writer:
+        writer.write_all(summary.track(aggregate_stream([item["id"] for item in dataset], read_records(verif_output_file))))
+    summary_file = write_summary(output_dir, summary)
+    logger.info(f"Dataset summary saved to {summary_file}: {json.dumps(summary.to_dict())}")
+    write_manifest(output_dir, fingerprint, hashes)
+
+    metrics_file = metrics.dump(output_dir, prometheus=args.prometheus)
+    logger.info(f"Run metrics saved to {metrics_file}")
+    for server_path, stats in connection_stats().items():
+        logger.info(f"HTTP connections to {server_path}: {stats['requests']} requests over "
+                    f"{stats['connections_opened']} connections")
+    logger.info(f"Processing complete. Final results are in {final_output_file}")
 
-    for idx in combined_output:
-        claim_scores = [c['score'] for c in combined_output[idx]['claims'] if 'score' in c]
-        combined_output[idx]["score"] = sum(claim_scores) / len(claim_scores) if claim_scores else None
 
-    with jsonlines.open(final_output_file, 'w') as writer:
-        writer.write_all(list(combined_output.values()))
 
-    logger.info(f"Processing complete. Final results are in {final_output_file}")
+def main():
+    """Main entry point for the command-line script."""
+    args = parse_args()
+
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
 
+    # Load configuration from YAML file
+    # This also applies any command-line overrides for input/output paths.
+    medscore_config = load_config(args.config, argument_overrides=vars(args))
+
+    # Validate required fields
+    if not medscore_config.input_file:
+        logger.error("Input file must be specified either in the config or via --input_file.")
+        sys.exit(1)
+
+    if not medscore_config.output_dir:
+        medscore_config.output_dir = "."
+        logger.warning("Output directory not specified. Defaulting to current directory.")
+
+    if args.decompose_only and args.verify_only:
+        logger.error("--decompose_only cannot be combined with --verify_only.")
+        sys.exit(1)
+
+    if not 0 <= args.shard_index < args.num_shards:
+        logger.error(f"--shard_index must be in [0, {args.num_shards}), got {args.shard_index}.")
+        sys.exit(1)
+
+    output_dir = medscore_config.output_dir
+    input_file = medscore_config.input_file
+    if args.num_shards > 1:
+        output_dir = shard_dir(output_dir, args.shard_index, args.num_shards)
+        logger.info(f"Running shard {args.shard_index} of {args.num_shards}. Writing to {output_dir}")
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    profiler = start_profiler(args.profile, output_dir)
+
+    # Stopped on every exit path, so a run that fails still leaves the profile of its finished stages
+    try:
+        run_pipeline(args, medscore_config, output_dir, input_file)
+    finally:
+        stop_profiler(profiler)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,201 @@
+"""
+Run instrumentation for MedScore.
+
+A single process-wide `metrics` object collects per-stage wall time, request latency
+histograms, token usage and event counters (retries, cache hits, ...). Metric names are
+dotted `<component>.<name>` strings, e.g. `retriever.faiss_search` or `verifier.retries`.
+"""
+import os
+import json
+import time
+import math
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Sequence, Iterator
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram, compatible with the Prometheus histogram type."""
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "buckets": {str(b): c for b, c in zip(list(self.buckets) + ["+Inf"], self.counts)},
+        }
+
+
+class Metrics:
+    """Thread-safe collector for stage timers, histograms and counters."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Objects with stage_started(name) / stage_finished(name), e.g. the profilers in medscore.profiling
+        self._stage_hooks: List[Any] = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages: Dict[str, Dict[str, float]] = {}
+            self.histograms: Dict[str, Histogram] = {}
+            self.counters: Dict[str, float] = {}
+            self.started_at = time.time()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a block of code and add its wall time to stage `name`."""
+        hooks = list(self._stage_hooks)
+        for hook in hooks:
+            hook.stage_started(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+            for hook in hooks:
+                hook.stage_finished(name)
+
+    def add_stage_hook(self, hook: Any):
+        with self._lock:
+            self._stage_hooks = self._stage_hooks + [hook]
+
+    def remove_stage_hook(self, hook: Any):
+        with self._lock:
+            self._stage_hooks = [h for h in self._stage_hooks if h is not hook]
+
+    def add_stage_time(self, name: str, seconds: float):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            stage["seconds"] += seconds
+            stage["calls"] += 1
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_completion(self, component: str, seconds: Optional[float], completion: Any):
+        """Record latency (if known, i.e. not for batch API results) and token usage of a single chat completion request."""
+        if seconds is not None:
+            self.observe(f"{component}.request_latency", seconds)
+        self.increment(f"{component}.requests")
+        usage = getattr(completion, "usage", None)
+        if usage is not None:
+            self.increment(f"{component}.prompt_tokens", usage.prompt_tokens or 0)
+            self.increment(f"{component}.completion_tokens", usage.completion_tokens or 0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "wall_time": time.time() - self.started_at,
+                "stages": {k: dict(v) for k, v in self.stages.items()},
+                "histograms": {k: v.to_dict() for k, v in self.histograms.items()},
+                "counters": dict(self.counters),
+            }
+
+    def to_prometheus(self, prefix: str = "medscore") -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        def group(items):
+            # {"verifier.retries": x} -> {"retries": [("verifier", x)]}
+            grouped = {}
+            for name, value in sorted(items):
+                component, _, metric = name.rpartition(".")
+                grouped.setdefault(metric, []).append((component, value))
+            return grouped
+
+        lines = []
+        with self._lock:
+            lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+            for name, stage in sorted(self.stages.items()):
+                lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {stage["seconds"]}')
+            lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+            for name, stage in sorted(self.stages.items()):
+                lines.append(f'{prefix}_stage_calls_total{{stage="{name}"}} {stage["calls"]}')
+
+            for metric, values in group(self.counters.items()).items():
+                lines.append(f"# TYPE {prefix}_{metric}_total counter")
+                for component, value in values:
+                    lines.append(f'{prefix}_{metric}_total{{component="{component}"}} {value}')
+
+            for metric, values in group(self.histograms.items()).items():
+                metric_name = f"{prefix}_{metric}_seconds"
+                lines.append(f"# TYPE {metric_name} histogram")
+                for component, hist in values:
+                    cumulative = 0
+                    for bound, count in zip(list(hist.buckets) + ["+Inf"], hist.counts):
+                        cumulative += count
+                        lines.append(f'{metric_name}_bucket{{component="{component}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric_name}_sum{{component="{component}"}} {hist.sum}')
+                    lines.append(f'{metric_name}_count{{component="{component}"}} {hist.count}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, output_dir: str, prometheus: bool = False) -> str:
+        """Write `metrics.json` (and optionally `metrics.prom`) to `output_dir`."""
+        output_file = os.path.join(output_dir, "metrics.json")
+        with open(output_file, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        if prometheus:
+            with open(os.path.join(output_dir, "metrics.prom"), "w") as f:
+                f.write(self.to_prometheus())
+        return output_file
+
+
+metrics = Metrics()
+
+
+
+def merge_metrics(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combines `metrics.json` contents of several runs (e.g. shards) into one."""
+    merged = {"wall_time": 0.0, "stages": {}, "histograms": {}, "counters": {}, "runs": len(runs)}
+    for run in runs:
+        # Runs execute in parallel, so the combined wall time is that of the slowest one
+        merged["wall_time"] = max(merged["wall_time"], run.get("wall_time", 0.0))
+        for name, stage in run.get("stages", {}).items():
+            total = merged["stages"].setdefault(name, {"seconds": 0.0, "calls": 0})
+            total["seconds"] += stage["seconds"]
+            total["calls"] += stage["calls"]
+        for name, value in run.get("counters", {}).items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + value
+        for name, hist in run.get("histograms", {}).items():
+            total = merged["histograms"].get(name)
+            if total is None:
+                merged["histograms"][name] = json.loads(json.dumps(hist))
+                continue
+            total["count"] += hist["count"]
+            total["sum"] += hist["sum"]
+            total["mean"] = total["sum"] / total["count"] if total["count"] else None
+            for key, pick in (("min", min), ("max", max)):
+                values = [v for v in (total[key], hist[key]) if v is not None]
+                total[key] = pick(values) if values else None
+            for bound, count in hist["buckets"].items():
+                total["buckets"][bound] = total["buckets"].get(bound, 0) + count
+    return merged
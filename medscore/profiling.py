@@ -0,0 +1,296 @@
+"""
+Built-in CPU and memory profiling of the MedScore pipeline stages (`medscore --profile cpu|memory`).
+
+The profiler hooks into the `metrics.stage` timers, so every stage (`medscore.decompose`,
+`verifier.evidence`, `retriever.faiss_search`, `doc_extracter.init`, ...) is profiled
+separately, including stages that run in worker threads. Artifacts go to `output_dir/profile/`:
+
+- `cpu`: A sampling profiler records the Python stacks of all threads every few milliseconds.
+  Per stage, `<stage>.folded` holds the collapsed stacks (input for flamegraph.pl or speedscope),
+  and the summary ranks functions by own and cumulative samples. Threads that are idle
+  (waiting on a lock, queue or socket) are not counted.
+- `memory`: `tracemalloc` and the process RSS are recorded at the start and end of every stage.
+  For the `medscore.*` pipeline stages, the summary ranks the allocation sites that grew the
+  most, and `<stage>.memory.txt` lists them in full. The artifacts are written again whenever
+  a pipeline stage finishes, so a run that is killed (e.g. out of memory) keeps the stages
+  it finished.
+
+`profile.json` has the per-stage results and `profile_summary.txt` a readable ranking.
+"""
+import os
+import sys
+import json
+import resource
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from .metrics import metrics
+
+PROFILE_MODES = ("cpu", "memory")
+PROFILE_DIR = "profile"
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+# Frames kept per allocation traceback, and entries per ranking
+TRACEMALLOC_FRAMES = 5
+TOP_N = 25
+# Leaf frames in these stdlib modules mean the thread is waiting, not working
+_IDLE_MODULES = ("threading.py", "selectors.py", "queue.py", "asyncio/base_events.py", "concurrent/futures/_base.py",
+                 "concurrent/futures/thread.py")
+# Stages whose allocation sites are compared with tracemalloc snapshots (snapshots are slow)
+_SNAPSHOT_PREFIX = "medscore."
+
+
+def _rss_bytes() -> Optional[int]:
+    """Current resident set size, from /proc on Linux."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # KiB on Linux
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname if hasattr(code, 'co_qualname') else code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+def _file_name(stage: str, suffix: str) -> str:
+    return stage.replace("/", "_") + suffix
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads and attributes them to the stages open at the time."""
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._open_stages: Counter = Counter()
+        self.stacks: Dict[str, Counter] = {}
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="medscore-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def stage_started(self, name: str):
+        with self._lock:
+            self._open_stages[name] += 1
+            self.stacks.setdefault(name, Counter())
+
+    def stage_finished(self, name: str):
+        with self._lock:
+            self._open_stages[name] -= 1
+            if self._open_stages[name] <= 0:
+                del self._open_stages[name]
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                stages = list(self._open_stages)
+            if not stages:
+                continue
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or frame.f_code.co_filename.endswith(_IDLE_MODULES):
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(names)))
+            with self._lock:
+                for stage in stages:
+                    self.samples[stage] += 1
+                    self.stacks[stage].update(stacks)
+
+    def stage_results(self, stage: str) -> Dict[str, Any]:
+        own, cumulative = Counter(), Counter()
+        for stack, count in self.stacks.get(stage, {}).items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                cumulative[name] += count
+        return {
+            "samples": self.samples.get(stage, 0),
+            "top_own": [{"function": f, "samples": c} for f, c in own.most_common(TOP_N)],
+            "top_cumulative": [{"function": f, "samples": c} for f, c in cumulative.most_common(TOP_N)],
+        }
+
+    def write(self, profile_dir: str, results: Dict[str, Dict[str, Any]]):
+        for stage, stacks in self.stacks.items():
+            with open(os.path.join(profile_dir, _file_name(stage, ".folded")), "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            results.setdefault(stage, {})["cpu"] = self.stage_results(stage)
+
+
+class MemoryProfiler:
+    """Records tracemalloc and RSS per stage, and the top growing allocation sites of pipeline stages."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open: Dict[tuple, Dict[str, Any]] = {}
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.top_sites: Dict[str, Counter] = {}
+        self.top_tracebacks: Dict[str, List[Any]] = {}
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def stage_started(self, name: str):
+        current, peak = tracemalloc.get_traced_memory()
+        state = {"traced": current, "rss": _rss_bytes()}
+        if name.startswith(_SNAPSHOT_PREFIX):
+            # Pipeline stages can be nested (e.g. `medscore.sentence_splitting` in `medscore.decompose`),
+            # so the peak so far is kept for the open stages before it is reset for this one
+            with self._lock:
+                for open_state in self._open.values():
+                    if "peak" in open_state:
+                        open_state["peak"] = max(open_state["peak"], peak)
+            tracemalloc.reset_peak()
+            state["peak"] = 0
+            state["snapshot"] = self._snapshot()
+        with self._lock:
+            self._open[(name, threading.get_ident())] = state
+
+    def stage_finished(self, name: str):
+        current, peak = tracemalloc.get_traced_memory()
+        rss = _rss_bytes()
+        with self._lock:
+            state = self._open.pop((name, threading.get_ident()), None)
+        if state is None:
+            return
+        with self._lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "traced_delta_bytes": 0, "rss_delta_bytes": 0,
+                                                  "traced_peak_bytes": None, "rss_after_bytes": None})
+            stage["calls"] += 1
+            stage["traced_delta_bytes"] += current - state["traced"]
+            if rss is not None and state["rss"] is not None:
+                stage["rss_delta_bytes"] += rss - state["rss"]
+            stage["rss_after_bytes"] = rss
+        if "snapshot" in state:
+            stats = self._snapshot().compare_to(state["snapshot"], "traceback")
+            with self._lock:
+                stage["traced_peak_bytes"] = max(stage["traced_peak_bytes"] or 0, state["peak"], peak)
+                self.top_tracebacks.setdefault(name, []).extend(s for s in stats[:TOP_N] if s.size_diff > 0)
+                # Also by allocating line, summed over the tracebacks that end there
+                sites = self.top_sites.setdefault(name, Counter())
+                for s in stats:
+                    if s.size_diff > 0:
+                        sites[f"{s.traceback[0].filename}:{s.traceback[0].lineno}"] += s.size_diff
+
+    @staticmethod
+    def _snapshot():
+        # Without the allocations of tracemalloc itself
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def write(self, profile_dir: str, results: Dict[str, Dict[str, Any]]):
+        # Copies, since stages in other threads can finish while the artifacts are written
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+            all_sites = {name: sites.most_common(TOP_N) for name, sites in self.top_sites.items()}
+            all_tracebacks = {name: list(tracebacks) for name, tracebacks in self.top_tracebacks.items()}
+        for name, memory in stages.items():
+            sites = all_sites.get(name, [])
+            if sites:
+                memory["top_allocations"] = [{"site": site, "size_diff_bytes": size} for site, size in sites]
+                tracebacks = sorted(all_tracebacks.get(name, []), key=lambda s: s.size_diff, reverse=True)[:TOP_N]
+                with open(os.path.join(profile_dir, _file_name(name, ".memory.txt")), "w") as f:
+                    for s in tracebacks:
+                        f.write(f"{s.size_diff / 2**20:.1f} MiB in {s.count_diff} blocks\n")
+                        f.write("\n".join(f"    {line}" for line in s.traceback.format()) + "\n")
+            results.setdefault(name, {})["memory"] = memory
+        results.setdefault("process", {})["memory"] = {"peak_rss_bytes": _peak_rss_bytes()}
+
+
+class Profiler:
+    """Profiles every `metrics.stage` while active. Use `start_profiler` to create one."""
+    def __init__(self, mode: str, output_dir: str):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode!r}. Options: {PROFILE_MODES}")
+        self.mode = mode
+        self.profile_dir = os.path.join(output_dir, PROFILE_DIR)
+        self.backend = SamplingProfiler() if mode == "cpu" else MemoryProfiler()
+        self._write_lock = threading.Lock()
+
+    def start(self):
+        self.backend.start()
+        metrics.add_stage_hook(self)
+        return self
+
+    def stage_started(self, name: str):
+        self.backend.stage_started(name)
+
+    def stage_finished(self, name: str):
+        self.backend.stage_finished(name)
+        if self.mode == "memory" and name.startswith(_SNAPSHOT_PREFIX):
+            self.write()
+
+    def stop(self) -> str:
+        """Stops profiling and writes the artifacts. Returns the summary file."""
+        metrics.remove_stage_hook(self)
+        self.backend.stop()
+        return self.write()
+
+    def write(self) -> str:
+        """Writes the artifacts of the stages profiled so far. Returns the summary file."""
+        with self._write_lock:
+            return self._write()
+
+    def _write(self) -> str:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        results: Dict[str, Dict[str, Any]] = {}
+        self.backend.write(self.profile_dir, results)
+        stages = metrics.to_dict()["stages"]
+        for name, stage in results.items():
+            if name in stages:
+                stage["seconds"] = stages[name]["seconds"]
+        with open(os.path.join(self.profile_dir, "profile.json"), "w") as f:
+            json.dump({"mode": self.mode, "stages": results}, f, indent=2)
+        summary_file = os.path.join(self.profile_dir, "profile_summary.txt")
+        with open(summary_file, "w") as f:
+            f.write(self.summary(results))
+        return summary_file
+
+    def summary(self, results: Dict[str, Dict[str, Any]]) -> str:
+        lines = []
+        if self.mode == "cpu":
+            ranked = sorted(results.items(), key=lambda kv: kv[1]["cpu"]["samples"], reverse=True)
+            for name, stage in ranked:
+                lines.append(f"== {name}: {stage.get('seconds', 0):.2f}s, {stage['cpu']['samples']} samples")
+                for entry in stage["cpu"]["top_own"][:10]:
+                    lines.append(f"  {entry['samples']:>8}  {entry['function']}")
+        else:
+            ranked = sorted(((n, s) for n, s in results.items() if n != "process"),
+                            key=lambda kv: kv[1]["memory"]["rss_delta_bytes"], reverse=True)
+            lines.append(f"Peak RSS: {results['process']['memory']['peak_rss_bytes'] / 2**20:.1f} MiB")
+            for name, stage in ranked:
+                memory = stage["memory"]
+                peak = memory["traced_peak_bytes"]
+                lines.append(f"== {name}: RSS {memory['rss_delta_bytes'] / 2**20:+.1f} MiB, "
+                             f"traced {memory['traced_delta_bytes'] / 2**20:+.1f} MiB"
+                             + (f", traced peak {peak / 2**20:.1f} MiB" if peak is not None else ""))
+                for entry in memory.get("top_allocations", [])[:10]:
+                    lines.append(f"  {entry['size_diff_bytes'] / 2**20:>8.1f} MiB  {entry['site']}")
+        return "\n".join(lines) + "\n"
+
+
+def start_profiler(mode: Optional[str], output_dir: str) -> Optional[Profiler]:
+    """Starts a profiler for `mode` ("cpu" or "memory"), or returns None if `mode` is None."""
+    if mode is None:
+        return None
+    return Profiler(mode, output_dir).start()
@@ -0,0 +1,209 @@
+"""
+Query encoder backends for MedRAG retrieval on CPU.
+
+- `torch`: Full-precision PyTorch model (default).
+- `torch_int8`: PyTorch model with int8 dynamically quantized linear layers. No extra dependencies.
+- `onnx`: ONNX Runtime export of the model. Requires `pip install "sentence-transformers[onnx]"`.
+- `onnx_int8`: int8 dynamically quantized ONNX model. Exported once to `cache_dir`.
+
+Quantized encoders are not bit-identical to the PyTorch encoder. Check that retrieval agrees
+and measure the speedup on your hardware before switching:
+
+    medscore encoder-check --retriever_name MedCPT --corpus_name StatPearls --backend onnx_int8
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+from argparse import ArgumentParser
+from itertools import islice
+from typing import Iterator, List, Optional
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+from .medrag_utils import CustomizeSentenceTransformer, retriever_names, corpus_names, dense_retriever_name
+
+logger = logging.getLogger(__name__)
+
+QUERY_ENCODER_BACKENDS = ("torch", "torch_int8", "onnx", "onnx_int8")
+# Quantization config of `onnx_int8`. "avx512_vnni" also runs (more slowly) on CPUs without VNNI.
+ONNX_QUANTIZATION = "avx512_vnni"
+
+
+def _model_class(model_name: str):
+    return SentenceTransformer if "contriever" in model_name.lower() else CustomizeSentenceTransformer
+
+
+def load_query_encoder(model_name: str, backend: str = "torch", cache_dir: Optional[str] = None):
+    """Loads the query encoder `model_name` with the given inference backend."""
+    if backend not in QUERY_ENCODER_BACKENDS:
+        raise ValueError(f"Unknown query encoder backend '{backend}'. Options: {QUERY_ENCODER_BACKENDS}")
+    model_class = _model_class(model_name)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if backend in ("torch", "torch_int8"):
+        model = model_class(model_name, device=device if backend == "torch" else "cpu")
+        if backend == "torch_int8":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == "onnx":
+        model = model_class(model_name, device="cpu", backend="onnx")
+    else:
+        model = _load_onnx_int8(model_name, model_class, cache_dir)
+    model.eval()
+    return model
+
+
+def _load_onnx_int8(model_name: str, model_class, cache_dir: Optional[str]):
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    cache_dir = cache_dir or os.path.join(os.environ.get("MEDRAG_CORPUS", "./corpus"), "query_encoders")
+    save_dir = os.path.join(cache_dir, model_name.replace("/", "__") + "-onnx")
+    file_name = f"model_qint8_{ONNX_QUANTIZATION}.onnx"
+    if not os.path.exists(os.path.join(save_dir, "onnx", file_name)):
+        logger.info(f"Exporting an int8 ONNX model of {model_name} to {save_dir}")
+        model = model_class(model_name, device="cpu", backend="onnx")
+        model.save(save_dir)
+        export_dynamic_quantized_onnx_model(model, ONNX_QUANTIZATION, save_dir)
+    # The saved model includes its pooling config, so the base class loads CLS pooling models correctly
+    return SentenceTransformer(save_dir, device="cpu", backend="onnx", model_kwargs={"file_name": f"onnx/{file_name}"})
+
+
+def benchmark_qps(model, queries: List[str], batch_size: int = 32, repeats: int = 3) -> float:
+    """Best-of-`repeats` queries per second of `model.encode`."""
+    model.encode(queries[:batch_size], batch_size=batch_size)  # Warm-up
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with torch.no_grad():
+            model.encode(queries, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(queries) / best
+
+
+def topk_agreement(reference_ids: np.ndarray, candidate_ids: np.ndarray) -> float:
+    """Mean fraction of the reference top-k that is also in the candidate top-k."""
+    k = reference_ids.shape[1]
+    overlaps = [len(set(r.tolist()) & set(c.tolist())) / k for r, c in zip(reference_ids, candidate_ids)]
+    return float(np.mean(overlaps))
+
+
+def check_query_encoder(
+        retriever_name: str,
+        index_dir: str,
+        queries: List[str],
+        backend: str,
+        k: int = 10,
+        batch_size: int = 32,
+        cache_dir: Optional[str] = None,
+):
+    """Compares `backend` with the PyTorch encoder: top-k agreement on the FAISS index and queries/s."""
+    import faiss
+
+    index = faiss.read_index(os.path.join(index_dir, "faiss.index"))
+    reference = load_query_encoder(retriever_name, "torch")
+    candidate = load_query_encoder(retriever_name, backend, cache_dir=cache_dir)
+
+    with torch.no_grad():
+        reference_embeds = reference.encode(queries, batch_size=batch_size)
+        candidate_embeds = candidate.encode(queries, batch_size=batch_size)
+    _, reference_ids = index.search(np.asarray(reference_embeds, dtype=np.float32), k)
+    _, candidate_ids = index.search(np.asarray(candidate_embeds, dtype=np.float32), k)
+
+    cosine = np.sum(reference_embeds * candidate_embeds, axis=1) / (
+        np.linalg.norm(reference_embeds, axis=1) * np.linalg.norm(candidate_embeds, axis=1))
+    return {
+        "backend": backend,
+        "queries": len(queries),
+        "k": k,
+        "topk_agreement": topk_agreement(reference_ids, candidate_ids),
+        "top1_agreement": float(np.mean(reference_ids[:, 0] == candidate_ids[:, 0])),
+        "mean_cosine": float(np.mean(cosine)),
+        "torch_qps": benchmark_qps(reference, queries, batch_size=batch_size),
+        f"{backend}_qps": benchmark_qps(candidate, queries, batch_size=batch_size),
+    }
+
+
+def iter_queries(path: str, key: str = "claim") -> Iterator[str]:
+    """Yields queries from a text file (one per line) or from `key` of a JSONL file (e.g. decompositions.jsonl)."""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                line = json.loads(line).get(key)
+                if not line:
+                    continue
+            yield line
+
+
+def read_queries(path: str, key: str = "claim", limit: Optional[int] = None, seed: Optional[int] = None) -> List[str]:
+    """
+    Reads the queries of `path` (see `iter_queries`). With `limit`, keeps the first `limit`
+    queries, or, with a `seed`, a uniform random sample of `limit` queries of the whole file
+    (reservoir sampling, so only the sample is held in memory).
+    """
+    if not limit:
+        return list(iter_queries(path, key))
+    if seed is None:
+        return list(islice(iter_queries(path, key), limit))
+    queries = []
+    rng = random.Random(seed)
+    for i, query in enumerate(iter_queries(path, key)):
+        if i < limit:
+            queries.append(query)
+        else:
+            j = rng.randint(0, i)
+            if j < limit:
+                queries[j] = query
+    return queries
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Parse command line arguments."""
+    parser = ArgumentParser(prog="medscore encoder-check", description="Check a query encoder backend against the PyTorch encoder.")
+    parser.add_argument("--retriever_name", type=str, default="MedCPT", help="MedRAG retriever, e.g. MedCPT or Contriever.")
+    parser.add_argument("--corpus_name", type=str, default="StatPearls", help="MedRAG corpus whose index is searched.")
+    parser.add_argument("--db_dir", type=str, default=os.environ.get("MEDRAG_CORPUS", "./corpus"), help="MedRAG corpus directory.")
+    parser.add_argument("--backend", type=str, required=True, choices=QUERY_ENCODER_BACKENDS[1:], help="Backend to check.")
+    parser.add_argument("--queries", type=str, required=True, help="Text file with one query per line, or a JSONL file with a `claim` key.")
+    parser.add_argument("--n_queries", type=int, default=1000, help="Maximum number of queries to use.")
+    parser.add_argument("--k", type=int, default=10, help="Number of retrieved passages to compare.")
+    parser.add_argument("--batch_size", type=int, default=32, help="Encoder batch size.")
+    parser.add_argument("--threshold", type=float, default=0.9, help="Minimum top-k agreement for the check to pass.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point for `medscore encoder-check`."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+    queries = read_queries(args.queries, limit=args.n_queries)
+    results = []
+    for retriever in retriever_names[args.retriever_name]:
+        retriever = dense_retriever_name(retriever)
+        if retriever is None:
+            continue
+        for corpus in corpus_names[args.corpus_name]:
+            index_dir = os.path.join(args.db_dir, corpus, "index", retriever.replace("Query-Encoder", "Article-Encoder"))
+            result = check_query_encoder(retriever, index_dir, queries, args.backend, k=args.k, batch_size=args.batch_size,
+                                         cache_dir=os.path.join(args.db_dir, "query_encoders"))
+            result.update({"retriever": retriever, "corpus": corpus})
+            results.append(result)
+            print(json.dumps(result))
+
+    failed = [r for r in results if r["topk_agreement"] < args.threshold]
+    for r in failed:
+        logger.error(f"{r['retriever']} on {r['corpus']}: top-{args.k} agreement {r['topk_agreement']:.3f} is below {args.threshold}")
+    if failed:
+        sys.exit(1)
+    logger.info(f"{args.backend} agrees with the PyTorch encoder (top-{args.k} agreement >= {args.threshold}).")
+
+
+if __name__ == '__main__':
+    main()
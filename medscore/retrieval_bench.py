@@ -0,0 +1,300 @@
+"""
+Micro-benchmarks of the MedRAG retrieval path on a synthetic corpus.
+
+Builds corpora in the MedRAG layout (`<corpus>/chunk/*.jsonl`, and `embedding/*.npy`,
+`faiss.index` and `metadatas.npz` under `<corpus>/index/<encoder>/`) from random text and
+random embeddings, so no model or corpus download is needed, and times each retrieval
+component on CPU for every corpus size and batch size:
+
+    medscore retrieval-bench --corpus_sizes 10000 100000 --batch_sizes 1 8 32 128 --output bench.jsonl
+
+Queries are embedded by a deterministic random encoder, so the results measure search,
+merging, document loading and formatting, not the query encoder (see `medscore encoder-check`).
+Each result is one JSON line per (component, corpus size, batch size). Pass an earlier output
+as `--baseline` to flag components whose median time grew by more than `--tolerance`.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import statistics
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import faiss
+
+from .medrag_utils import corpus_names, retriever_names, dense_retriever_name, construct_index, save_npy_atomic, DocExtracter
+from .retriever import MedRAGRetriever
+
+logger = logging.getLogger(__name__)
+
+# Chunk file names per corpus, such that `MedRAGRetriever._load_doc_from_id` finds the corpus of an id
+_SOURCE_NAMES = {
+    "pubmed": "pubmed23n{:04d}",
+    "statpearls": "article-{:05d}",
+    "wikipedia": "wiki_{:05d}",
+    "textbooks": "Synthetic_Textbook{:04d}",
+}
+_CORPUS_FILE = "synthetic.json"
+_VOCABULARY_SIZE = 5000
+# Components timed for each corpus and batch size
+COMPONENTS = (
+    "retriever.get_relevant_documents",
+    "retriever.get_relevant_documents_with_text",
+    "retrieval_system.merge",
+    "doc_extracter.extract",
+    "doc_extracter.extract_cached",
+    "medrag_retriever.load_doc_from_id",
+    "medrag_retriever.call",
+    "medrag_retriever.call_cached",
+)
+
+
+class RandomQueryEncoder:
+    """Stands in for the query encoder: a fixed random unit vector per query text."""
+    def __init__(self, dim: int = 768, max_seq_length: int = 512):
+        self.dim = dim
+        self.max_seq_length = max_seq_length
+
+    def encode(self, sentences: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        embeds = np.empty((len(sentences), self.dim), dtype=np.float32)
+        for i, sentence in enumerate(sentences):
+            seed = int.from_bytes(hashlib.sha256(sentence.encode()).digest()[:8], "little")
+            embeds[i] = np.random.default_rng(seed).standard_normal(self.dim)
+        return embeds / np.linalg.norm(embeds, axis=1, keepdims=True)
+
+
+def _random_texts(rng: np.random.Generator, n: int, n_words: int) -> List[str]:
+    words = rng.integers(0, _VOCABULARY_SIZE, size=(n, n_words))
+    return [" ".join(f"w{w}" for w in row) for row in words]
+
+
+def make_synthetic_corpus(
+        db_dir: str,
+        n_passages: int,
+        corpus_name: str = "Textbooks",
+        retriever_name: str = "ncbi/MedCPT-Query-Encoder",
+        passages_per_file: int = 1000,
+        dim: int = 768,
+        passage_words: int = 100,
+        HNSW: bool = False,
+        seed: int = 0,
+) -> str:
+    """
+    Writes a synthetic corpus of `n_passages` passages (split over the corpora of `corpus_name`)
+    to `db_dir`, and builds its index. A corpus built earlier with the same settings is reused.
+    """
+    settings = {"n_passages": n_passages, "corpus_name": corpus_name, "retriever_name": retriever_name,
+                "passages_per_file": passages_per_file, "dim": dim, "passage_words": passage_words,
+                "HNSW": HNSW, "seed": seed}
+    settings_path = os.path.join(db_dir, _CORPUS_FILE)
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) == settings:
+                return db_dir
+        raise FileExistsError(f"{db_dir} has a synthetic corpus with other settings. Use another directory.")
+
+    rng = np.random.default_rng(seed)
+    corpora = corpus_names[corpus_name]
+    model_name = retriever_name.replace("Query-Encoder", "Article-Encoder")
+    for c, corpus in enumerate(corpora):
+        # The first corpora get the remainder
+        n_corpus = n_passages // len(corpora) + (c < n_passages % len(corpora))
+        chunk_dir = os.path.join(db_dir, corpus, "chunk")
+        index_dir = os.path.join(db_dir, corpus, "index", model_name)
+        embedding_dir = os.path.join(index_dir, "embedding")
+        os.makedirs(chunk_dir, exist_ok=True)
+        os.makedirs(embedding_dir, exist_ok=True)
+        logger.info(f"Writing {n_corpus} synthetic passages to {os.path.join(db_dir, corpus)}")
+        for file_index, start in enumerate(range(0, n_corpus, passages_per_file)):
+            n_file = min(passages_per_file, n_corpus - start)
+            source = _SOURCE_NAMES.get(corpus, corpus + "{:05d}").format(file_index)
+            titles = _random_texts(rng, n_file, 4)
+            contents = _random_texts(rng, n_file, passage_words)
+            with open(os.path.join(chunk_dir, f"{source}.jsonl"), "w") as f:
+                for i, (title, content) in enumerate(zip(titles, contents)):
+                    f.write(json.dumps({"id": f"{source}_{i}", "title": title, "content": content,
+                                        "contents": f"{title}. {content}"}) + "\n")
+            embeds = rng.standard_normal((n_file, dim), dtype=np.float32)
+            embeds /= np.linalg.norm(embeds, axis=1, keepdims=True)
+            # Shards are float16, as written by `embed`
+            save_npy_atomic(os.path.join(embedding_dir, f"{source}.npy"), embeds.astype(np.float16))
+        construct_index(index_dir, model_name, h_dim=dim, HNSW=HNSW, chunk_dir=chunk_dir)
+
+    with open(settings_path, "w") as f:
+        json.dump(settings, f)
+    return db_dir
+
+
+def time_call(fn: Callable[[], Any], repeats: int) -> List[float]:
+    """Seconds of each of `repeats` calls of `fn`, after one warm-up call."""
+    fn()
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def _result(component: str, seconds: List[float], batch_size: int) -> Dict[str, Any]:
+    median = statistics.median(seconds)
+    return {
+        "component": component,
+        "batch_size": batch_size,
+        "repeats": len(seconds),
+        "seconds_median": median,
+        "seconds_min": min(seconds),
+        "seconds_mean": statistics.fmean(seconds),
+        "ms_per_query": 1000 * median / batch_size,
+    }
+
+
+def benchmark_corpus(
+        db_dir: str,
+        batch_sizes: List[int],
+        retriever_name: str = "MedCPT",
+        corpus_name: str = "Textbooks",
+        k: int = 5,
+        repeats: int = 5,
+        dim: int = 768,
+        components=COMPONENTS,
+        seed: int = 0,
+) -> List[Dict[str, Any]]:
+    """Times each of `components` on the corpus in `db_dir`, for batches of each of `batch_sizes` queries."""
+    encoder = RandomQueryEncoder(dim)
+    medrag = MedRAGRetriever(retriever_name=retriever_name, corpus_name=corpus_name, db_dir=db_dir,
+                             n_returned_docs=k, query_encoder=encoder)
+    system = medrag.retriever
+    retriever = system.retrievers[0][0]
+    medrag_cached, extracter, extracter_cached = None, None, None
+    if "medrag_retriever.call_cached" in components:
+        medrag_cached = MedRAGRetriever(retriever_name=retriever_name, corpus_name=corpus_name, db_dir=db_dir,
+                                        cache=True, n_returned_docs=k, query_encoder=encoder)
+    if "doc_extracter.extract" in components:
+        extracter = DocExtracter(db_dir=db_dir, corpus_name=corpus_name)
+    if "doc_extracter.extract_cached" in components:
+        extracter_cached = medrag_cached.retriever.docExt if medrag_cached else \
+            DocExtracter(db_dir=db_dir, cache=True, corpus_name=corpus_name)
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for batch_size in batch_sizes:
+        queries = _random_texts(rng, batch_size, 12)
+        # Inputs of the components after the search, from one retrieval of the batch per retriever and corpus
+        searched = [[r.get_relevant_documents(queries, k=k, id_only=True) for r in row] for row in system.retrievers]
+        ids, scores = searched[0][0]
+        # `DocExtracter.extract` takes the id dicts of all queries at once
+        id_dicts = [doc for docs in ids for doc in docs]
+        doc_ids = [doc["id"] for doc in id_dicts]
+
+        def merge_batch():
+            for q in range(batch_size):
+                # `merge` replaces the lists it is given, so they are built for each call
+                system.merge([[t[q] for t, _ in row] for row in searched],
+                             [[s[q] for _, s in row] for row in searched], k=k, rrf_k=k * 5)
+
+        timed = {
+            "retriever.get_relevant_documents": lambda: retriever.get_relevant_documents(queries, k=k, id_only=True),
+            "retriever.get_relevant_documents_with_text": lambda: retriever.get_relevant_documents(queries, k=k),
+            "retrieval_system.merge": merge_batch,
+            "doc_extracter.extract": lambda: extracter.extract(id_dicts),
+            "doc_extracter.extract_cached": lambda: extracter_cached.extract(id_dicts),
+            "medrag_retriever.load_doc_from_id": lambda: [medrag._load_doc_from_id(i) for i in doc_ids],
+            "medrag_retriever.call": lambda: medrag(queries),
+            "medrag_retriever.call_cached": lambda: medrag_cached(queries),
+        }
+        for component in components:
+            result = _result(component, time_call(timed[component], repeats), batch_size)
+            logger.info(f"{component} (batch {batch_size}): {result['ms_per_query']:.3f} ms/query")
+            results.append(result)
+    return results
+
+
+def compare_results(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Regressions of `results` against `baseline`: median time more than `tolerance` (a fraction) higher."""
+    def key(r):
+        return r["component"], r["corpus_size"], r["batch_size"], r["k"], r.get("index")
+
+    baseline = {key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = baseline.get(key(result))
+        if before is None:
+            continue
+        ratio = result["seconds_median"] / before["seconds_median"]
+        result["baseline_ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(f"{result['component']} (corpus {result['corpus_size']}, batch {result['batch_size']}): "
+                               f"{ratio:.2f}x the baseline median")
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Parse command line arguments."""
+    parser = ArgumentParser(prog="medscore retrieval-bench", description="Time the MedRAG retrieval components on a synthetic corpus.")
+    parser.add_argument("--work_dir", type=str, default="./retrieval_bench", help="Directory of the synthetic corpora (reused between runs).")
+    parser.add_argument("--corpus_sizes", type=int, nargs="+", default=[10000, 100000], help="Numbers of passages.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32, 128], help="Numbers of queries per call.")
+    parser.add_argument("--retriever_name", type=str, default="MedCPT",
+                        choices=[n for n, r in retriever_names.items() if not any("bm25" in x for x in r)],
+                        help="MedRAG retriever. BM25 needs a Lucene index and is not supported.")
+    parser.add_argument("--corpus_name", type=str, default="Textbooks", choices=list(corpus_names), help="The passages are split over its corpora.")
+    parser.add_argument("--hnsw", action="store_true", help="Build HNSW indexes instead of flat indexes.")
+    parser.add_argument("--k", type=int, default=5, help="Passages per query (`n_returned_docs`).")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed calls per component, after one warm-up call.")
+    parser.add_argument("--dim", type=int, default=768, help="Embedding dimension.")
+    parser.add_argument("--passages_per_file", type=int, default=1000, help="Passages per chunk file.")
+    parser.add_argument("--components", type=str, nargs="+", default=list(COMPONENTS), choices=COMPONENTS, help="Components to time.")
+    parser.add_argument("--threads", type=int, help="FAISS (OpenMP) threads. Default: all cores.")
+    parser.add_argument("--output", type=str, help="Write the results as JSONL to this file.")
+    parser.add_argument("--baseline", type=str, help="Results of an earlier run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed increase of the median time over the baseline.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point for `medscore retrieval-bench`."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+    dense_name = dense_retriever_name(retriever_names[args.retriever_name][0])
+
+    all_results = []
+    for corpus_size in args.corpus_sizes:
+        db_dir = os.path.join(args.work_dir, "-".join([args.corpus_name, dense_name.split("/")[-1], str(corpus_size),
+                                                        "hnsw" if args.hnsw else "flat"]))
+        make_synthetic_corpus(db_dir, corpus_size, corpus_name=args.corpus_name, retriever_name=dense_name,
+                              passages_per_file=args.passages_per_file, dim=args.dim, HNSW=args.hnsw)
+        for result in benchmark_corpus(db_dir, args.batch_sizes, retriever_name=args.retriever_name,
+                                       corpus_name=args.corpus_name, k=args.k, repeats=args.repeats, dim=args.dim,
+                                       components=args.components):
+            result = {**result, "corpus_size": corpus_size, "k": args.k, "index": "hnsw" if args.hnsw else "flat",
+                      "retriever": args.retriever_name, "corpus": args.corpus_name, "threads": faiss.omp_get_max_threads()}
+            all_results.append(result)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        regressions = compare_results(all_results, baseline, args.tolerance)
+
+    for result in all_results:
+        print(json.dumps(result))
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in all_results:
+                f.write(json.dumps(result) + "\n")
+
+    for regression in regressions:
+        logger.error(f"Regression: {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
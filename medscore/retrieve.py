@@ -0,0 +1,130 @@
+"""
+Offline MedRAG retrieval for the `medrag` verifier.
+
+Retrieves the passages of every unique claim of one or more decomposition files in large
+batches, and writes them to a claim -> passages store (see `RetrievedEvidenceStore`):
+
+    medscore retrieve --config config.yaml
+    python -m medscore.medscore --config config.yaml    # with verifier.pre_retrieved_path set
+
+The retrieval settings come from the `medrag` verifier of the config (or the first stage of a
+`cascade` verifier), and the store is written to its `pre_retrieved_path`. Verification then
+looks claims up in the store, so it needs neither the corpus nor FAISS or torch, and retrieval
+can run once on a GPU machine for several verification runs. Claims already in the store are
+skipped, so an interrupted run resumes where it stopped.
+"""
+import os
+import sys
+import logging
+from argparse import ArgumentParser
+from typing import Any, Dict, Iterable, List, Optional
+
+from tqdm import tqdm
+
+from .utils import load_config, chunker
+from .metrics import metrics
+from .storage import read_records, find_output
+from .retriever import MedRAGRetriever
+from .evidence_store import retrieval_settings, RetrievedEvidenceStore
+
+logger = logging.getLogger(__name__)
+
+# Claims per retrieval call. Larger than the verifier default, since nothing waits for the LLM.
+DEFAULT_BATCH_SIZE = 4096
+
+
+def medrag_config(verifier_config: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The `medrag` verifier settings of a verifier config, which may be a cascade's first stage."""
+    if verifier_config.get("type") == "medrag":
+        return verifier_config
+    first_stage = verifier_config.get("first_stage") or {}
+    return first_stage if first_stage.get("type") == "medrag" else None
+
+
+def unique_claims(paths: Iterable[str]) -> List[str]:
+    """The claims of the decomposition files, in order of first occurrence."""
+    claims = {}
+    for path in paths:
+        for record in read_records(path):
+            if record.get("claim") is not None:
+                claims[record["claim"]] = None
+    return list(claims)
+
+
+def retrieve_claims(retriever, store: RetrievedEvidenceStore, claims: List[str], batch_size: int) -> int:
+    """Retrieves the passages of the `claims` that are not in `store` yet. Returns the number retrieved."""
+    done = store.contains(claims)
+    todo = [claim for claim in claims if claim not in done]
+    logger.info(f"{len(claims)} unique claims, {len(done)} already in {store.path}, retrieving {len(todo)}")
+    n_iter = (len(todo) + batch_size - 1) // batch_size
+    for batch in tqdm(chunker(todo, batch_size), desc="Retrieving MedRAG", total=n_iter, ncols=80):
+        batch = list(batch)
+        with metrics.stage("retrieve.batch"):
+            retrieved = retriever(query=batch)
+        store.add(batch, retrieved)
+        metrics.increment("retrieve.claims", len(batch))
+    return len(todo)
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Parse command line arguments."""
+    parser = ArgumentParser(prog="medscore retrieve",
+                            description="Retrieve MedRAG evidence for decomposed claims ahead of verification.")
+    parser.add_argument("--config", type=str, required=True, help="Path to the YAML configuration file with a medrag verifier.")
+    parser.add_argument("--input", type=str, nargs="+",
+                        help="Decomposition files (default: the decompositions in the config's output_dir).")
+    parser.add_argument("--output", type=str, help="Evidence store to write (default: the verifier's pre_retrieved_path).")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help="Claims per retrieval call.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point for `medscore retrieve`."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+    medscore_config = load_config(args.config)
+    config = medrag_config(medscore_config.verifier.model_dump())
+    if config is None:
+        logger.error("The config must have a medrag verifier (or a cascade verifier with a medrag first stage).")
+        sys.exit(1)
+    output = args.output or config.get("pre_retrieved_path")
+    if not output:
+        logger.error("Set verifier.pre_retrieved_path in the config or pass --output.")
+        sys.exit(1)
+    inputs = args.input or [find_output(medscore_config.output_dir or ".", "decompositions")]
+    if not all(inputs) or not all(os.path.exists(path) for path in inputs):
+        logger.error(f"Decomposition file not found: {inputs}. Run the decomposer first or pass --input.")
+        sys.exit(1)
+
+    settings = retrieval_settings(**config)
+    store = RetrievedEvidenceStore(output, writable=True)
+    if len(store) and store.settings != settings:
+        logger.error(f"{output} was retrieved with other settings ({store.settings}). Use another --output.")
+        sys.exit(1)
+    store.set_settings(settings)
+
+    db_dir = config.get("db_dir") or os.environ.get("MEDRAG_CORPUS", "./corpus")
+    with metrics.stage("retrieve.init"):
+        retriever = MedRAGRetriever(
+            retriever_name=config["retriever_name"],
+            corpus_name=config["corpus_name"],
+            db_dir=db_dir,
+            HNSW=config["HNSW"],
+            cache=config["cache"],
+            n_returned_docs=config["n_returned_docs"],
+            query_encoder_backend=config["query_encoder_backend"],
+            encoder_batch_size=config["encoder_batch_size"],
+            encoder_max_length=config["encoder_max_length"],
+            hnsw_m=config["hnsw_m"],
+            hnsw_ef_construction=config["hnsw_ef_construction"],
+            hnsw_ef_search=config["hnsw_ef_search"],
+            n_candidates=config["n_candidates"],
+            coarse_nprobe=config["coarse_nprobe"]
+        )
+    n_retrieved = retrieve_claims(retriever, store, unique_claims(inputs), args.batch_size)
+    logger.info(f"Retrieved {n_retrieved} claims. {len(store)} claims in {output}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,14 @@ Use MedRAG corpus for retrieving relevant passages in the medical domain.
 import os
 import sys
 import json
-from typing import List, Dict, Any, Tuple, Union
+from typing import List, Dict, Any, Tuple, Union, Optional
 import logging
 import subprocess
 
 import tqdm
 
 from .medrag_utils import RetrievalSystem
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -24,14 +25,32 @@ class MedRAGRetriever(object):
         db_dir: str = os.environ.get("MEDRAG_CORPUS", "./corpus"),
         HNSW: bool = False,
         cache: bool = False,
-        n_returned_docs: int = 5
+        n_returned_docs: int = 5,
+        query_encoder_backend: str = "torch",
+        encoder_batch_size: int = 32,
+        encoder_max_length: Optional[int] = None,
+        hnsw_m: int = 32,
+        hnsw_ef_construction: int = 40,
+        hnsw_ef_search: Optional[int] = None,
+        n_candidates: int = 100,
+        coarse_nprobe: int = 16,
+        query_encoder: Optional[Any] = None
     ):
         self.retriever = RetrievalSystem(
             retriever_name=retriever_name,
             corpus_name=corpus_name,
             db_dir=db_dir,
             HNSW=HNSW,
-            cache=cache
+            cache=cache,
+            query_encoder_backend=query_encoder_backend,
+            encoder_batch_size=encoder_batch_size,
+            encoder_max_length=encoder_max_length,
+            hnsw_m=hnsw_m,
+            hnsw_ef_construction=hnsw_ef_construction,
+            hnsw_ef_search=hnsw_ef_search,
+            n_candidates=n_candidates,
+            coarse_nprobe=coarse_nprobe,
+            query_encoder=query_encoder
         )
         self.use_cache = cache
         self.n_returned_docs = n_returned_docs
@@ -59,7 +78,8 @@ class MedRAGRetriever(object):
             rrf_k=self.n_returned_docs * 5,  # # docs to return from each source
             id_only=True
         )
-        retrieved = self._format_retrieved(batched_results)
+        with metrics.stage("retriever.document_loading"):
+            retrieved = self._format_retrieved(batched_results)
         return retrieved
 
     def _format_retrieved(self, merge_results: List[Tuple[List[Dict[str, Any]], List[float]]]) -> List[List[Dict[str, Any]]]:
@@ -70,6 +90,8 @@ class MedRAGRetriever(object):
             for t, s in zip(t_batch, s_batch):
                 if not t.get("title"):
                     t.update(self._load_doc_from_id(t["id"]))
+                else:
+                    metrics.increment("retriever.preloaded_documents")
                 r = {
                     "id": t["id"],
                     "title": t["title"],
@@ -82,8 +104,10 @@ class MedRAGRetriever(object):
 
     def _load_doc_from_id(self, id: str) -> Dict[str, Any]:
         if self.use_cache:
+            metrics.increment("retriever.cache_hits")
             doc = self.retriever.docExt.extract([id])[0]
         else:
+            metrics.increment("retriever.disk_reads")
             # Hacky way to load the document
             # Format example: pubmed23n0973_8682
             # TODO: use DocExtractor system self.dict which has id2path?
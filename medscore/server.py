@@ -0,0 +1,221 @@
+"""
+Long-running MedScore scoring service.
+
+Builds the MedScore pipeline (spaCy, decomposer, verifier and, for MedRAG, the encoder and
+FAISS indexes) once and serves scoring requests over HTTP. Concurrent requests are
+micro-batched, so sentence splitting, query encoding, retrieval and LLM calls are shared
+across requests.
+
+    python -m medscore.server --config config.yaml --port 8000
+
+    curl -X POST localhost:8000/score -d '{"items": [{"id": "1", "response": "..."}]}'
+"""
+import json
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Dict, Any, Tuple
+
+from .medscore import MedScore, aggregate_results
+from .utils import load_config
+from .metrics import metrics
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class MicroBatcher:
+    """Collects concurrent scoring requests and scores them as one MedScore batch."""
+    def __init__(self, scorer: MedScore, max_batch_items: int = 256, max_wait: float = 0.05):
+        self.scorer = scorer
+        self.max_batch_items = max_batch_items
+        self.max_wait = max_wait
+        self.queue: "queue.Queue[Tuple[List[Dict[str, Any]], Future]]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="medscore-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, items: List[Dict[str, Any]]) -> Future:
+        """Queue a list of input records. The future resolves to one scored record per item."""
+        future = Future()
+        self.queue.put((items, future))
+        return future
+
+    def _collect(self) -> List[Tuple[List[Dict[str, Any]], Future]]:
+        # Block for the first request, then keep collecting until the batch is full or max_wait passed
+        batch = [self.queue.get()]
+        n_items = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while n_items < self.max_batch_items:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_items += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                results = self.score_batch([items for items, _ in batch])
+            except Exception as e:
+                logger.exception("Scoring batch failed")
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # Score the requests one by one, so that only the failing request gets the error
+                metrics.increment("server.batch_failures")
+                for items, future in batch:
+                    try:
+                        future.set_result(self.score_batch([items])[0])
+                    except Exception as request_error:
+                        future.set_exception(request_error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def score_batch(self, requests: List[List[Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
+        # Give every item a batch-unique id so that equal `id`s from different requests don't collide
+        dataset = []
+        for req_idx, items in enumerate(requests):
+            for item_idx, item in enumerate(items):
+                dataset.append({**item, "id": f"{req_idx}:{item_idx}"})
+        logger.info(f"Scoring {len(dataset)} responses from {len(requests)} requests")
+
+        with metrics.stage("server.batch"):
+            decompositions = self.scorer.decompose(dataset)
+            verifications = self.scorer.verify(decompositions)
+            combined_output = aggregate_results(dataset, verifications)
+        metrics.increment("server.requests", len(requests))
+        metrics.increment("server.responses", len(dataset))
+
+        results = [[None] * len(items) for items in requests]
+        for record in combined_output:
+            req_idx, item_idx = map(int, record["id"].split(":"))
+            record["id"] = requests[req_idx][item_idx].get("id")
+            results[req_idx][item_idx] = record
+        return results
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /score    {"items": [{"id": ..., "response": ...}, ...]} or a single {"id": ..., "response": ...}
+    GET  /health
+    GET  /metrics  Prometheus text format
+    """
+    batcher: MicroBatcher = None
+    request_timeout: float = 600.0
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self._send(200, metrics.to_prometheus().encode(), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def validate_items(self, items: Any):
+        """Raises `ValueError` for input that would fail the whole micro-batch it is scored in."""
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError("'items' must be a list of objects.")
+        scorer = self.batcher.scorer
+        for item in items:
+            # Items without the field are skipped by the pipeline (and get no claims)
+            response = item.get(scorer.response_key)
+            if scorer.response_key in item and not isinstance(response, str) and not (scorer.presenticized and response is None):
+                raise ValueError(f"'{scorer.response_key}' of item {item.get('id')!r} must be a string.")
+            if scorer.presenticized and "sentences" in item:
+                sentences = item["sentences"]
+                if not isinstance(sentences, list) or not all(isinstance(s, (str, dict)) for s in sentences):
+                    raise ValueError(f"'sentences' of item {item.get('id')!r} must be a list of strings or objects.")
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            items = body["items"] if isinstance(body, dict) and "items" in body else [body]
+            self.validate_items(items)
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        start = time.perf_counter()
+        future = self.batcher.submit(items)
+        try:
+            results = future.result(timeout=self.request_timeout)
+        except FutureTimeoutError:
+            self._send_json(504, {"error": "Scoring timed out."})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        metrics.observe("server.request_latency", time.perf_counter() - start)
+        self._send_json(200, {"results": results})
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        self._send(status, json.dumps(payload).encode(), "application/json")
+
+    def _send(self, status: int, data: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = ArgumentParser(description="Serve MedScore factuality evaluation over HTTP.")
+    parser.add_argument("--config", type=str, required=True, help="Path to the YAML configuration file.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind to.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind to.")
+    parser.add_argument("--max_batch_items", type=int, default=256, help="Maximum number of responses scored in one micro-batch.")
+    parser.add_argument("--max_wait_ms", type=float, default=50, help="How long to wait for more requests before scoring a micro-batch.")
+    parser.add_argument("--request_timeout", type=float, default=600, help="Seconds before a scoring request times out.")
+    parser.add_argument("--debug", action="store_true", help="Print debug logs.")
+    return parser.parse_args()
+
+
+def main():
+    """Entry point for the scoring service."""
+    args = parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    medscore_config = load_config(args.config)
+    logger.info("Loading MedScore pipeline...")
+    scorer = MedScore(medscore_config)
+
+    ScoringRequestHandler.batcher = MicroBatcher(
+        scorer,
+        max_batch_items=args.max_batch_items,
+        max_wait=args.max_wait_ms / 1000,
+    )
+    ScoringRequestHandler.request_timeout = args.request_timeout
+    server = ThreadingHTTPServer((args.host, args.port), ScoringRequestHandler)
+    logger.info(f"MedScore service listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Sharded execution for MedScore.
+
+Input records are assigned to shards by a stable hash of their `id`, so every node can select
+its own part of the input file independently:
+
+    python -m medscore.medscore --config config.yaml --num_shards 8 --shard_index 3
+
+Each shard writes to `output_dir/shard-00003-of-00008/`. Once all shards finished, merge them:
+
+    medscore merge --config config.yaml --num_shards 8
+
+The merge streams through the input file once and interleaves the shard files in input order,
+so it only keeps one record per shard (and the set of seen ids) in memory. Because each shard
+is an order-preserving subsequence of the input, the merged files are identical to the files
+of a single-node run, as long as the input ids are unique. The records of an id that is
+repeated in the input cannot be told apart by occurrence, so when they are consecutive in a
+shard file, all of them are merged at its first occurrence (as in `--incremental` runs).
+"""
+import os
+import sys
+import json
+import hashlib
+import logging
+from argparse import ArgumentParser
+from typing import Any, Dict, Iterator, List, Optional
+
+from .utils import load_config
+from .metrics import merge_metrics
+from .storage import read_records, open_writer, find_output
+from .aggregate import DatasetSummary, write_summary, SUMMARY_FILE
+from .incremental import load_manifest, write_manifest
+
+logger = logging.getLogger(__name__)
+
+# Output files that are merged, in pipeline order
+SHARDED_FILES = ["decompositions", "verifications", "output"]
+
+
+def shard_of(item_id: Any, num_shards: int) -> int:
+    """Stable shard assignment for an input `id` (independent of PYTHONHASHSEED)."""
+    digest = hashlib.md5(str(item_id).encode("utf-8")).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def shard_dir(output_dir: str, shard_index: int, num_shards: int) -> str:
+    return os.path.join(output_dir, f"shard-{shard_index:05d}-of-{num_shards:05d}")
+
+
+class _ShardReader:
+    """Sequential reader over one shard file that hands out the consecutive records of an id."""
+    def __init__(self, path: str):
+        self.path = path
+        self._iter = read_records(path)
+        self._next = next(self._iter, None)
+
+    def take(self, item_id: Any) -> Iterator[Dict[str, Any]]:
+        """All the consecutive records of `item_id`, i.e. those of every input occurrence of a repeated id."""
+        while self._next is not None and self._next.get("id") == item_id:
+            yield self._next
+            self._next = next(self._iter, None)
+
+    def take_one(self, item_id: Any) -> Dict[str, Any]:
+        if self._next is None or self._next.get("id") != item_id:
+            raise ValueError(f"{self.path} is out of sync with the input file at id '{item_id}'.")
+        record = self._next
+        self._next = next(self._iter, None)
+        return record
+
+    @property
+    def exhausted(self) -> bool:
+        return self._next is None
+
+    def close(self):
+        self._iter.close()
+
+
+def merge_shards(input_file: str, output_dir: str, num_shards: int) -> List[str]:
+    """Merges the shard outputs in `output_dir` into single-run files. Returns the merged file names."""
+    shard_dirs = [shard_dir(output_dir, i, num_shards) for i in range(num_shards)]
+    missing_dirs = [d for d in shard_dirs if not os.path.isdir(d)]
+    if missing_dirs:
+        raise FileNotFoundError(f"Missing shard directories: {missing_dirs}")
+
+    # Only merge the files that every shard produced (e.g. --decompose_only runs have no verifications)
+    shard_files = {}
+    for name in SHARDED_FILES:
+        paths = [find_output(d, name) for d in shard_dirs]
+        if all(paths):
+            shard_files[name] = paths
+        elif any(paths):
+            missing = [d for d, p in zip(shard_dirs, paths) if not p]
+            raise FileNotFoundError(f"{name} output is missing from shards: {missing}")
+    if not shard_files:
+        raise FileNotFoundError(f"No shard outputs found in {output_dir}")
+
+    # The merged files use the same format (file extension) as the shard files
+    fnames = [os.path.basename(paths[0]) for paths in shard_files.values()]
+    readers = {fname: [_ShardReader(p) for p in paths] for fname, paths in zip(fnames, shard_files.values())}
+    writers = {fname: open_writer(os.path.join(output_dir, fname)) for fname in fnames}
+    seen_ids, repeated_ids = set(), set()
+    summary = DatasetSummary()
+    try:
+        for item in read_records(input_file):
+            item_id = item.get("id")
+            shard = shard_of(item_id, num_shards)
+            for fname in fnames:
+                if fname.startswith("output."):
+                    # One aggregated record per unique id, at the position of its first occurrence
+                    if item_id not in seen_ids:
+                        record = readers[fname][shard].take_one(item_id)
+                        summary.add(record)
+                        writers[fname].write(record)
+                else:
+                    writers[fname].write_all(readers[fname][shard].take(item_id))
+            if item_id in seen_ids:
+                repeated_ids.add(item_id)
+            seen_ids.add(item_id)
+
+        for fname in fnames:
+            leftover = [r.path for r in readers[fname] if not r.exhausted]
+            if leftover:
+                raise ValueError(f"Shard files contain records that are not in {input_file}: {leftover}")
+    finally:
+        for fname in fnames:
+            writers[fname].close()
+            for r in readers[fname]:
+                r.close()
+    if repeated_ids:
+        logger.warning(f"{len(repeated_ids)} ids are repeated in {input_file}, e.g. '{next(iter(repeated_ids))}'. "
+                       f"Their records can end up at their first occurrence instead of in single-node run order.")
+
+    # Dataset-level statistics of the merged output
+    if any(fname.startswith("output.") for fname in fnames):
+        write_summary(output_dir, summary)
+        fnames.append(SUMMARY_FILE)
+
+    # Combine the run metrics of all shards
+    metrics_files = [os.path.join(d, "metrics.json") for d in shard_dirs]
+    shard_metrics = []
+    for path in metrics_files:
+        if os.path.exists(path):
+            with open(path) as f:
+                shard_metrics.append(json.load(f))
+    if shard_metrics:
+        with open(os.path.join(output_dir, "metrics.json"), "w") as f:
+            json.dump(merge_metrics(shard_metrics), f, indent=2)
+        fnames.append("metrics.json")
+
+    # Combine the manifests for later --incremental runs on the merged output
+    manifests = [load_manifest(d) for d in shard_dirs]
+    if all(manifests) and len({m["config"] for m in manifests}) == 1:
+        hashes = {}
+        for manifest in manifests:
+            hashes.update(manifest["records"])
+        write_manifest(output_dir, manifests[0]["config"], hashes)
+        fnames.append("manifest.json")
+    return fnames
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """Parse command line arguments."""
+    parser = ArgumentParser(prog="medscore merge", description="Merge the outputs of a sharded MedScore run.")
+    parser.add_argument("--config", type=str, required=True, help="Path to the YAML configuration file used for the shards.")
+    parser.add_argument("--input_file", type=str, help="Override the input data file specified in the config.")
+    parser.add_argument("--output_dir", type=str, help="Override the output directory specified in the config.")
+    parser.add_argument("--num_shards", type=int, required=True, help="Number of shards the run was split into.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point for `medscore merge`."""
+    args = parse_args(argv)
+    medscore_config = load_config(args.config, argument_overrides=vars(args))
+    if not medscore_config.input_file:
+        logger.error("Input file must be specified either in the config or via --input_file.")
+        sys.exit(1)
+    output_dir = medscore_config.output_dir or "."
+
+    try:
+        merged = merge_shards(medscore_config.input_file, output_dir, args.num_shards)
+    except (FileNotFoundError, ValueError) as e:
+        logger.error(f"Could not merge shards: {e}")
+        sys.exit(1)
+    logger.info(f"Merged {args.num_shards} shards into {', '.join(merged)} in {output_dir}")
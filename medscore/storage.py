@@ -0,0 +1,290 @@
+"""
+Reading and writing MedScore record files.
+
+Supported formats, chosen by file extension:
+- `.jsonl`: JSON Lines (default).
+- `.jsonl.zst`: zstd-compressed JSON Lines. Requires `zstandard`.
+- `.parquet`: Columnar Parquet, written in row groups as records come in. Requires `pyarrow`.
+  Evidence passages are stored once in a `<name>.evidence.parquet` side table and referenced
+  by id from each claim, instead of being repeated for every claim that retrieved them.
+"""
+import io
+import os
+import json
+import hashlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import jsonlines
+
+OUTPUT_FORMATS = ("jsonl", "jsonl.zst", "parquet")
+
+
+def output_path(output_dir: str, name: str, output_format: str = "jsonl") -> str:
+    """Path of output file `name` (e.g. "verifications") in the given format."""
+    return os.path.join(output_dir, f"{name}.{output_format}")
+
+
+def find_output(output_dir: str, name: str, preferred_format: str = "jsonl") -> Optional[str]:
+    """Path of an existing output file `name` in any supported format, preferring `preferred_format`."""
+    formats = [preferred_format] + [f for f in OUTPUT_FORMATS if f != preferred_format]
+    for output_format in formats:
+        path = output_path(output_dir, name, output_format)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading or writing .zst files requires `zstandard`. Install it with `pip install zstandard`.")
+    return zstandard
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Reading or writing .parquet files requires `pyarrow`. Install it with `pip install pyarrow`.")
+    return pyarrow
+
+
+# --- Reading ---
+
+def read_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Streams records from a `.jsonl`, `.jsonl.zst` or `.parquet` file."""
+    if path.endswith(".parquet"):
+        yield from _read_parquet(path)
+    elif path.endswith(".zst"):
+        zstandard = _import_zstandard()
+        with open(path, "rb") as f:
+            stream = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f), encoding="utf-8")
+            yield from jsonlines.Reader(stream).iter()
+    else:
+        with jsonlines.open(path) as reader:
+            yield from reader.iter()
+
+
+# --- Writing ---
+
+class JsonlRecordWriter:
+    """Writes records as (optionally zstd-compressed) JSON Lines."""
+    def __init__(self, path: str, compression_level: int = 3):
+        self.path = path
+        if path.endswith(".zst"):
+            zstandard = _import_zstandard()
+            self._raw = open(path, "wb")
+            self._compressor = zstandard.ZstdCompressor(level=compression_level).stream_writer(self._raw)
+            self._fp = io.TextIOWrapper(self._compressor, encoding="utf-8")
+        else:
+            self._raw = None
+            self._fp = open(path, "w", encoding="utf-8")
+        self._writer = jsonlines.Writer(self._fp)
+
+    def write(self, record: Dict[str, Any]):
+        self._writer.write(record)
+
+    def write_all(self, records: Iterable[Dict[str, Any]]):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        self._writer.close()
+        self._fp.close()  # Also flushes and closes the zstd frame and file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Scalar columns of the Parquet files and their Python types. Values of any other type,
+# and all other keys, go into the JSON `extra` column.
+_PARQUET_COLUMNS = {
+    "id": str,
+    "sentence_id": int,
+    "sentence": str,
+    "claim_id": int,
+    "claim": str,
+    "raw": str,
+    "score": float,
+    "support_prob": float,
+}
+
+
+def _evidence_id(passage: Dict[str, Any]) -> str:
+    if passage.get("id") is not None:
+        return str(passage["id"])
+    digest = hashlib.sha1(json.dumps(passage, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"sha1:{digest}"
+
+
+def _pack_evidence(evidence: Any) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Splits claim evidence into per-claim references and the passages to store once."""
+    if evidence is None:
+        return {"evidence_type": "none"}, []
+    if isinstance(evidence, str):
+        passage = {"text": evidence}
+        return {"evidence_type": "text", "evidence_ids": [_evidence_id(passage)], "evidence_scores": [None]}, [passage]
+    if isinstance(evidence, list) and all(isinstance(p, dict) for p in evidence):
+        passages = [{k: v for k, v in p.items() if k != "score"} for p in evidence]
+        return {
+            "evidence_type": "passages",
+            "evidence_ids": [_evidence_id(p) for p in passages],
+            "evidence_scores": [p.get("score") for p in evidence],
+        }, passages
+    return {"evidence_type": "json", "evidence_json": json.dumps(evidence)}, []
+
+
+def _unpack_evidence(refs: Dict[str, Any], passages: Dict[str, Dict[str, Any]]) -> Any:
+    evidence_type = refs.get("evidence_type")
+    if evidence_type == "none":
+        return None
+    if evidence_type == "text":
+        return passages[refs["evidence_ids"][0]]["text"]
+    if evidence_type == "passages":
+        evidence = []
+        for evidence_id, score in zip(refs["evidence_ids"], refs["evidence_scores"]):
+            passage = dict(passages[evidence_id])
+            if score is not None:
+                passage["score"] = score
+            evidence.append(passage)
+        return evidence
+    return json.loads(refs["evidence_json"])
+
+
+class ParquetRecordWriter:
+    """
+    Writes records to Parquet in row groups of `row_group_size` records.
+
+    `evidence` of verification records (and of the `claims` of final output records) is
+    replaced by passage ids; each passage is written once to `<name>.evidence.parquet`.
+    """
+    def __init__(self, path: str, row_group_size: int = 10000):
+        self.pa = _import_pyarrow()
+        self.path = path
+        self.evidence_path = evidence_table_path(path)
+        self.row_group_size = row_group_size
+        self.schema = self.pa.schema(
+            [("id", self.pa.string()), ("sentence_id", self.pa.int64()), ("sentence", self.pa.string()),
+             ("claim_id", self.pa.int64()), ("claim", self.pa.string()), ("raw", self.pa.string()),
+             ("score", self.pa.float64()), ("support_prob", self.pa.float64()), ("evidence_type", self.pa.string()),
+             ("evidence_ids", self.pa.list_(self.pa.string())), ("evidence_scores", self.pa.list_(self.pa.float64())),
+             ("extra", self.pa.string())]
+        )
+        self.evidence_schema = self.pa.schema([("evidence_id", self.pa.string()), ("passage", self.pa.string())])
+        self._rows: List[Dict[str, Any]] = []
+        self._passages: List[Dict[str, Any]] = []
+        self._seen_passages = set()
+        self._writer = self.pa.parquet.ParquetWriter(path, self.schema, compression="zstd")
+        self._evidence_writer = None
+
+    def _add_passages(self, refs: Dict[str, Any], passages: List[Dict[str, Any]]):
+        for evidence_id, passage in zip(refs.get("evidence_ids", []), passages):
+            if evidence_id not in self._seen_passages:
+                self._seen_passages.add(evidence_id)
+                self._passages.append({"evidence_id": evidence_id, "passage": json.dumps(passage)})
+
+    def write(self, record: Dict[str, Any]):
+        row = {"extra": {}}
+        for key, value in record.items():
+            column_type = _PARQUET_COLUMNS.get(key)
+            if column_type is not None and value is not None and isinstance(value, column_type) \
+                    and not isinstance(value, bool):
+                row[key] = value
+            elif column_type is float and isinstance(value, int) and not isinstance(value, bool):
+                row[key] = float(value)
+                row["extra"][key] = value  # Keep the integer type on read
+            elif key == "evidence":
+                refs, passages = _pack_evidence(value)
+                self._add_passages(refs, passages)
+                row.update({k: v for k, v in refs.items() if k != "evidence_json"})
+                if "evidence_json" in refs:
+                    row["extra"]["evidence"] = value
+            elif key == "claims" and isinstance(value, list):
+                # Final output records: store the claims in `extra` with packed evidence
+                claims = []
+                for claim in value:
+                    claim = dict(claim)
+                    if "evidence" in claim:
+                        refs, passages = _pack_evidence(claim.pop("evidence"))
+                        self._add_passages(refs, passages)
+                        claim["_evidence"] = refs
+                    claims.append(claim)
+                row["extra"]["claims"] = claims
+            else:
+                row["extra"][key] = value
+        row["extra"] = json.dumps(row["extra"]) if row["extra"] else None
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def write_all(self, records: Iterable[Dict[str, Any]]):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self._rows:
+            self._writer.write_table(self.pa.Table.from_pylist(self._rows, schema=self.schema))
+            self._rows = []
+        if self._passages:
+            if self._evidence_writer is None:
+                self._evidence_writer = self.pa.parquet.ParquetWriter(
+                    self.evidence_path, self.evidence_schema, compression="zstd")
+            self._evidence_writer.write_table(self.pa.Table.from_pylist(self._passages, schema=self.evidence_schema))
+            self._passages = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        if self._evidence_writer is not None:
+            self._evidence_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def evidence_table_path(path: str) -> str:
+    return path[:-len(".parquet")] + ".evidence.parquet"
+
+
+def _read_parquet(path: str) -> Iterator[Dict[str, Any]]:
+    pa = _import_pyarrow()
+    passages = {}
+    evidence_path = evidence_table_path(path)
+    if os.path.exists(evidence_path):
+        for batch in pa.parquet.ParquetFile(evidence_path).iter_batches():
+            for row in batch.to_pylist():
+                passages[row["evidence_id"]] = json.loads(row["passage"])
+
+    evidence_columns = ("evidence_type", "evidence_ids", "evidence_scores")
+    for batch in pa.parquet.ParquetFile(path).iter_batches():
+        for row in batch.to_pylist():
+            # Generic Parquet inputs (e.g. an input file) have no MedScore-specific columns
+            if "extra" not in row:
+                yield row
+                continue
+            record = {k: v for k, v in row.items() if k in _PARQUET_COLUMNS and v is not None}
+            # "json" evidence (e.g. a list of strings) is kept as it is in `extra`
+            if row.get("evidence_type") not in (None, "json"):
+                record["evidence"] = _unpack_evidence({k: row[k] for k in evidence_columns}, passages)
+            if row["extra"]:
+                extra = json.loads(row["extra"])
+                for claim in extra.get("claims", []):
+                    if "_evidence" in claim:
+                        claim["evidence"] = _unpack_evidence(claim.pop("_evidence"), passages)
+                record.update(extra)
+            yield record
+
+
+def open_writer(path: str, **kwargs):
+    """Opens a record writer for `path`, choosing the format by file extension."""
+    if path.endswith(".parquet"):
+        return ParquetRecordWriter(path, **kwargs)
+    return JsonlRecordWriter(path, **kwargs)
@@ -58,7 +58,7 @@ def load_config(
 
     # Apply command-line argument overrides
     if argument_overrides:
-        for arg_field in ["input_file", "output_dir"]:
+        for arg_field in ["input_file", "output_dir", "output_format"]:
             if arg_field in argument_overrides and argument_overrides[arg_field] is not None:
                 config_data[arg_field] = argument_overrides[arg_field]
         logger.debug(f"Applied argument overrides: {argument_overrides}")
@@ -89,7 +89,18 @@ def process_claim(claims: List[str]) -> List[str]:
 def parse_sentences(
     passage: str,
 ) -> List[Dict[str, Any]]:
-    doc = nlp(passage)
+    return _doc_to_sentences(nlp(passage))
+
+
+def parse_sentences_batch(
+    passages: List[str],
+    batch_size: int = 64,
+) -> List[List[Dict[str, Any]]]:
+    """Sentence-split many passages in one spaCy `nlp.pipe` pass."""
+    return [_doc_to_sentences(doc) for doc in nlp.pipe(passages, batch_size=batch_size)]
+
+
+def _doc_to_sentences(doc) -> List[Dict[str, Any]]:
     sentences = []
     # sent is a spacy span object https://spacy.io/api/span#init
     # span start/end is based on token index (sent.start, sent.end)
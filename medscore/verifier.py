@@ -1,96 +1,173 @@
 """Verifier"""
 
 import os
-from functools import partial
+import copy
+import random
 import asyncio
 from typing import List, Dict, Any, Optional
 import string
-import logging
 import json
+import logging
+import math
+from functools import partial
 
-import jsonlines
-from tqdm import tqdm
-import backoff
-import requests
-from openai import AsyncOpenAI
 from openai.types.chat.chat_completion import ChatCompletion
-import nest_asyncio
+from tqdm import tqdm
 from registrable import Registrable
 
 from .utils import chunker
 from .prompts import INTERNAL_KNOWLEDGE_PROMPT
-from .retriever import MedRAGRetriever
+from .evidence_store import open_evidence_store, retrieval_settings, RetrievedEvidenceStore
+from .metrics import metrics
+from .llm import LLMComponent, ParseError, CompletionLengthModel, run_sync
 
-nest_asyncio.apply()
 logger = logging.getLogger(__name__)
 
+# Settings of the "short_answer" mode
+SHORT_ANSWER_MAX_TOKENS = 2
+# No "\n": models often start with a newline after the appended instruction
+SHORT_ANSWER_STOP = [".", ",", ":"]
+SHORT_ANSWER_INSTRUCTION = "Answer with a single word: True or False."
+TOP_LOGPROBS = 5
 
-class Verifier(Registrable):
+
+class Verifier(LLMComponent, Registrable):
     """Base class for all verifiers."""
+    component_name = "verifier"
+    output_schema = {
+        "type": "object",
+        "properties": {"answer": {"type": "boolean"}},
+        "required": ["answer"],
+        "additionalProperties": False,
+    }
+    structured_instruction = 'Respond in JSON: {"answer": true} or {"answer": false}'
+
     def __init__(
             self,
-            server_path: str,
-            model_name: str,
-            api_key: Optional[str] = None,
-            random_state: int = 42,
-            batch_size: int = 32,
-            **kwargs, # To allow for extra params from config
+            *args,
+            answer_mode: str = "free_text",
+            logprobs: bool = True,
+            **kwargs
     ):
-        api_key = api_key or os.environ.get("OPENAI_API_KEY")
-        self.client = AsyncOpenAI(
-            base_url=server_path,
-            api_key=api_key,
-        )
-        self.model_name = model_name
-        self.random_state = random_state
-        self.batch_size = batch_size
-
-        self.agent = partial(
-            self.client.chat.completions.create,
-            model=self.model_name,
-            seed=self.random_state,
-            temperature=0.0,
-            top_p=1.0,
-            max_tokens=256
-        )
+        super().__init__(*args, **kwargs)
+        if answer_mode == "short_answer" and self.structured_output != "none":
+            raise ValueError("answer_mode 'short_answer' cannot be combined with structured_output: "
+                             "a JSON answer does not fit in its output tokens.")
+        self.answer_mode = answer_mode
+        self.logprobs = logprobs and answer_mode == "short_answer"
+        if answer_mode == "short_answer":
+            # Only the first answer token matters, so stop decoding right after it
+            self.agent = partial(self.agent, max_tokens=SHORT_ANSWER_MAX_TOKENS, stop=SHORT_ANSWER_STOP)
+            if self.logprobs:
+                self.agent = partial(self.agent, logprobs=True, top_logprobs=TOP_LOGPROBS)
 
     def __call__(self, decompositions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        # Prepare user input
-        verifier_input = self.prepare_verification_input(decompositions)
+        return run_sync(self.averify(decompositions))
+
+    async def averify(self, decompositions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Async version of `__call__`. Safe to await from any running event loop."""
+        # Prepare user input. Evidence collection (e.g. retrieval) is blocking, so run it in a thread.
+        with metrics.stage("verifier.evidence"):
+            verifier_input = await asyncio.to_thread(self.prepare_verification_input, decompositions)
         messages = self.prepare_messages(verifier_input)
 
-        # Async calls for batch_size items
-        all_completions = []
-        n_iter = (len(messages) + self.batch_size - 1) // self.batch_size
-        for batch in tqdm(chunker(messages, self.batch_size), desc="Verify", total=n_iter, ncols=80):
-            completions = asyncio.run(self.batch_response(batch))
-            all_completions.extend(completions)
+        # Async calls with at most batch_size requests in flight
+        with metrics.stage("verifier.requests"):
+            all_completions = await self.request_verifications(messages, desc="Verify")
 
+        return self.format_verifications(verifier_input, all_completions)
+
+    def format_verifications(
+            self,
+            verifier_input: List[Dict[str, Any]],
+            completions: List[ChatCompletion]
+    ) -> List[Dict[str, Any]]:
         # Format model output
         verification_output = []
-        for v_input, completion in zip(verifier_input, all_completions):
-            raw_output = completion.choices[0].message.content.strip() if completion.choices else ""
-            is_supported = self.parse_verification_output(raw_output)
+        for v_input, completion in zip(verifier_input, completions):
+            raw_output = (completion.choices[0].message.content or "").strip() if completion.choices else ""
             output = {k: v for k, v in v_input.items()}
             output["raw"] = raw_output
-            output["score"] = is_supported
+            # A request without a completion has no answer, which must not count as supported
+            output["score"] = self.parse_verification_output(raw_output) if completion.choices else None
+            if self.logprobs:
+                output["support_prob"] = self.parse_support_prob(completion)
             verification_output.append(output)
         return verification_output
 
-    @backoff.on_exception(
-        backoff.expo,
-        (requests.exceptions.RequestException, asyncio.TimeoutError),
-        max_time=60
-    )
-    async def batch_response(self, batch: List[List[Dict[str, str]]]) -> List[ChatCompletion]:
-        async_responses = [
-            self.agent(messages=x) for x in batch
-        ]
-        return await asyncio.gather(*async_responses)
-
-    def parse_verification_output(self, completion_message: str) -> float:
+    async def request_verifications(self, messages: List[List[Dict[str, str]]], desc: str) -> List[ChatCompletion]:
+        """Sends the verification requests, and re-requests answers that are neither True nor False."""
+        return await self.complete_all_validated(self.add_answer_instructions(messages), self.validate_answer, desc=desc)
+
+    def add_answer_instructions(self, messages: List[List[Dict[str, str]]]) -> List[List[Dict[str, str]]]:
+        if self.answer_mode == "short_answer":
+            return [self.add_short_answer_instruction(m) for m in messages]
+        return [self.add_structured_instruction(m) for m in messages]
+
+    def validate_answer(self, completion: ChatCompletion):
+        """Raises `ParseError` if the answer is neither True nor False."""
+        raw_output = completion.choices[0].message.content if completion.choices else None
+        if not raw_output:
+            raise ParseError("Empty completion")
+        if self.structured_output != "none":
+            self.parse_structured_answer(raw_output)
+        elif "true" not in raw_output.lower() and "false" not in raw_output.lower():
+            raise ParseError("Answer is neither True nor False")
+
+    @staticmethod
+    def parse_structured_answer(raw_output: str) -> float:
+        try:
+            answer = json.loads(raw_output)["answer"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise ParseError(f"Invalid JSON answer: {e}")
+        if not isinstance(answer, bool):
+            raise ParseError("`answer` is not a boolean")
+        return float(answer)
+
+    @staticmethod
+    def add_short_answer_instruction(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        # Appended to the last user message, so that it also overrides "explain"-style system prompts
+        messages = [dict(m) for m in messages]
+        messages[-1]["content"] = f"{messages[-1]['content']}\n{SHORT_ANSWER_INSTRUCTION}"
+        return messages
+
+    @staticmethod
+    def parse_support_prob(completion: ChatCompletion) -> Optional[float]:
+        """
+        P(True) / (P(True) + P(False)) from the top logprobs of the first answer token.
+        None if the backend returned no logprobs or neither answer is among the top tokens.
+        """
+        choice = completion.choices[0] if completion.choices else None
+        if choice is None or choice.logprobs is None or not choice.logprobs.content:
+            return None
+        # Skip leading whitespace tokens (e.g. "\n" before the answer)
+        first_token = next((t for t in choice.logprobs.content if t.token.strip()), choice.logprobs.content[0])
+        candidates = first_token.top_logprobs or [first_token]
+        p_true, p_false = 0.0, 0.0
+        for candidate in candidates:
+            token = candidate.token.strip().lower()
+            if not token:
+                continue
+            # Prefixes cover tokenizers that split the answer, e.g. "Tr" + "ue"
+            if "true".startswith(token) or token.startswith("true"):
+                p_true += math.exp(candidate.logprob)
+            elif "false".startswith(token) or token.startswith("false"):
+                p_false += math.exp(candidate.logprob)
+        if p_true + p_false == 0:
+            return None
+        return p_true / (p_true + p_false)
+
+    def parse_verification_output(self, completion_message: str) -> Optional[float]:
+        if self.structured_output != "none":
+            try:
+                return self.parse_structured_answer(completion_message)
+            except ParseError:
+                pass  # Fall back to parsing the text
         generated_answer = completion_message.strip().lower()
         is_supported = 0.0
+        if self.answer_mode == "short_answer" and "true" not in generated_answer and "false" not in generated_answer:
+            # A short answer has no explanation to fall back on
+            return None
 
         if "true" in generated_answer or "false" in generated_answer:
             if "true" in generated_answer and "false" not in generated_answer:
@@ -143,21 +220,24 @@ class InternalVerifier(Verifier):
 
 @Verifier.register("provided")
 class ProvidedEvidenceVerifier(Verifier):
-    """Verify claims against a pre-provided `evidence` key"""
+    """Verify claims against pre-provided evidence per `id` (see `medscore.evidence_store`)"""
     def __init__(
             self,
             provided_evidence_path: str,
+            evidence_index_dir: Optional[str] = None,
             *args,
             **kwargs
     ):
         super().__init__(*args, **kwargs)
-        self.provided_evidence_path = provided_evidence_path
-        with open(provided_evidence_path) as f:
-            self.id_to_evidence = json.load(f)
+        self.provided_evidence_path = str(provided_evidence_path)
+        # Only the index is opened here. Evidence is read for the ids being verified.
+        self.evidence_store = open_evidence_store(self.provided_evidence_path, index_dir=evidence_index_dir)
 
     def prepare_verification_input(self, decompositions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with metrics.stage("verifier.evidence_lookup"):
+            id_to_evidence = self.evidence_store.get_many(d['id'] for d in decompositions)
         for d in decompositions:
-            d["evidence"] = self.id_to_evidence.get(d['id'])
+            d["evidence"] = id_to_evidence.get(str(d['id']))
             if d["evidence"] is None:
                 logger.warning(f"No evidence found for id: {d['id']}")
         return decompositions
@@ -185,10 +265,42 @@ class MedRAGVerifier(Verifier):
         HNSW: bool = False,
         cache: bool = False,
         n_returned_docs: int = 5,
+        query_encoder_backend: str = "torch",
+        retrieval_batch_size: int = 256,
+        encoder_batch_size: int = 32,
+        encoder_max_length: Optional[int] = None,
+        hnsw_m: int = 32,
+        hnsw_ef_construction: int = 40,
+        hnsw_ef_search: Optional[int] = None,
+        n_candidates: int = 100,
+        coarse_nprobe: int = 16,
+        pre_retrieved_path: Optional[str] = None,
         *args,
         **kwargs
     ):
         super().__init__(*args, **kwargs)
+        # Claims per retrieval call, independent of the LLM concurrency (`batch_size`)
+        self.retrieval_batch_size = retrieval_batch_size
+        self.retriever, self.evidence_store = None, None
+        if pre_retrieved_path is not None:
+            # Evidence from `medscore retrieve`: no corpus, index or query encoder is loaded
+            self.evidence_store = RetrievedEvidenceStore(pre_retrieved_path)
+            expected = retrieval_settings(retriever_name=retriever_name, corpus_name=corpus_name, HNSW=HNSW,
+                                          n_returned_docs=n_returned_docs, hnsw_ef_search=hnsw_ef_search,
+                                          n_candidates=n_candidates, coarse_nprobe=coarse_nprobe,
+                                          query_encoder_backend=query_encoder_backend,
+                                          encoder_max_length=encoder_max_length)
+            stored = self.evidence_store.settings
+            if stored is None:
+                raise ValueError(f"{pre_retrieved_path} has no retrieval settings. Write it with `medscore retrieve`.")
+            different = sorted(k for k in expected if stored.get(k) != expected[k])
+            if different:
+                raise ValueError(f"The evidence in {pre_retrieved_path} was retrieved with other settings than the "
+                                 f"verifier config: " + ", ".join(f"{k}={stored.get(k)!r}" for k in different)
+                                 + ". Run `medscore retrieve` with this config and another output path.")
+            return
+        # Imported here, so that verifying from a pre-retrieved store does not need FAISS or torch
+        from .retriever import MedRAGRetriever
         if db_dir is None:
             db_dir = os.environ.get("MEDRAG_CORPUS", "./corpus")
         self.retriever = MedRAGRetriever(
@@ -197,13 +309,23 @@ class MedRAGVerifier(Verifier):
             db_dir=db_dir,
             HNSW=HNSW,
             cache=cache,
-            n_returned_docs=n_returned_docs
+            n_returned_docs=n_returned_docs,
+            query_encoder_backend=query_encoder_backend,
+            encoder_batch_size=encoder_batch_size,
+            encoder_max_length=encoder_max_length,
+            hnsw_m=hnsw_m,
+            hnsw_ef_construction=hnsw_ef_construction,
+            hnsw_ef_search=hnsw_ef_search,
+            n_candidates=n_candidates,
+            coarse_nprobe=coarse_nprobe
         )
 
     def prepare_verification_input(self, decompositions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        if self.evidence_store is not None:
+            return self.lookup_verification_input(decompositions)
         verification_input = []
-        n_iter = (len(decompositions) + self.batch_size - 1) // self.batch_size
-        for batch in tqdm(chunker(decompositions, self.batch_size), desc="Retrieving MedRAG", total=n_iter, ncols=80):
+        n_iter = (len(decompositions) + self.retrieval_batch_size - 1) // self.retrieval_batch_size
+        for batch in tqdm(chunker(decompositions, self.retrieval_batch_size), desc="Retrieving MedRAG", total=n_iter, ncols=80):
             claims = [d['claim'] for d in batch]
             retrieved_all = self.retriever(query=claims)
             for decomp, retrieved in zip(batch, retrieved_all):
@@ -212,6 +334,16 @@ class MedRAGVerifier(Verifier):
                 verification_input.append(v_input)
         return verification_input
 
+    def lookup_verification_input(self, decompositions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with metrics.stage("verifier.evidence_lookup"):
+            evidence = self.evidence_store.get_many(d['claim'] for d in decompositions)
+        missing = {d['claim'] for d in decompositions} - evidence.keys()
+        if missing:
+            raise ValueError(f"{len(missing)} claims are not in the pre-retrieved evidence store "
+                             f"{self.evidence_store.path}, e.g. {next(iter(missing))!r}. "
+                             f"Run `medscore retrieve` on these decompositions first.")
+        return [{**decomp, "evidence": evidence[decomp['claim']]} for decomp in decompositions]
+
     def format_input(self, evidence: str, claim: str) -> str:
         return f"""Answer the question based on the given context.\n\n{evidence}\n\nInput: {claim} True or False?\nOutput:"""
 
@@ -226,3 +358,114 @@ class MedRAGVerifier(Verifier):
                 {"role": "user", "content": formatted_input}
             ])
         return messages
+
+
+@Verifier.register("cascade")
+class CascadeVerifier(Verifier):
+    """
+    Verifies every claim with a cheap `first_stage` verifier and sends only the claims it is
+    uncertain about to this verifier's (expensive) model, with the same evidence and prompt.
+
+    A first-stage answer is uncertain if its `support_prob` is further from 0/1 than
+    `confidence_threshold` allows, or if one of the `agreement_models` gives a different answer.
+    A random `audit_rate` fraction of the confident claims is also sent to the expensive model,
+    to measure how often the cascade agrees with it.
+    """
+    def __init__(
+            self,
+            first_stage: Dict[str, Any],
+            confidence_threshold: float = 0.9,
+            agreement_models: Optional[List[str]] = None,
+            audit_rate: float = 0.0,
+            *args,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        first_stage = dict(first_stage)
+        if hasattr(first_stage.get("api_key"), "get_secret_value"):
+            first_stage["api_key"] = first_stage["api_key"].get_secret_value()
+        self.first_stage = Verifier.by_name(first_stage["type"])(**first_stage)
+        self.first_stage.component_name = "verifier.first_stage"
+        if not self.first_stage.logprobs and not agreement_models:
+            raise ValueError("A cascade without first-stage logprobs (answer_mode 'short_answer' and logprobs) "
+                             "or agreement_models cannot tell confident claims apart and would escalate every claim.")
+        self.component_name = "verifier.second_stage"
+        self.confidence_threshold = confidence_threshold
+        self.audit_rate = audit_rate
+        # Same client and settings as the first stage, with another model
+        self.agreement_verifiers = []
+        for model_name in agreement_models or []:
+            verifier = copy.copy(self.first_stage)
+            verifier.agent = partial(self.first_stage.agent, model=model_name)
+            verifier._limiter = None
+            verifier._latency = None
+            verifier.completion_lengths = CompletionLengthModel()
+            verifier.component_name = "verifier.agreement"
+            self.agreement_verifiers.append(verifier)
+
+    def is_uncertain(self, verification: Dict[str, Any], second_opinions: List[Dict[str, Any]]) -> bool:
+        if any(o["score"] != verification["score"] for o in second_opinions):
+            return True
+        support_prob = verification.get("support_prob")
+        if support_prob is None:
+            # No confidence (e.g. the backend returned no logprobs for this claim): with agreement
+            # models, agreeing answers are confident; without them, the claim is escalated
+            return not second_opinions
+        return max(support_prob, 1 - support_prob) < self.confidence_threshold
+
+    async def averify(self, decompositions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        first = self.first_stage
+        with metrics.stage("verifier.evidence"):
+            verifier_input = await asyncio.to_thread(first.prepare_verification_input, decompositions)
+        messages = first.prepare_messages(verifier_input)
+
+        with metrics.stage("verifier.first_stage_requests"):
+            verifications, *opinions = await asyncio.gather(
+                first.request_verifications(messages, desc="Verify (first stage)"),
+                *[v.request_verifications(messages, desc=f"Verify (agreement {i})") for i, v in enumerate(self.agreement_verifiers)]
+            )
+        verifications = first.format_verifications(verifier_input, verifications)
+        opinions = [first.format_verifications(verifier_input, o) for o in opinions]
+
+        # Seeded, so that reruns audit the same claims
+        rng = random.Random(self.random_state)
+        escalated, audited = [], []
+        for idx, verification in enumerate(verifications):
+            if self.is_uncertain(verification, [o[idx] for o in opinions]):
+                escalated.append(idx)
+            elif rng.random() < self.audit_rate:
+                audited.append(idx)
+        second_idx = sorted(escalated + audited)
+
+        with metrics.stage("verifier.second_stage_requests"):
+            second_completions = await self.request_verifications([messages[i] for i in second_idx], desc="Verify (escalated)")
+        second = dict(zip(second_idx, self.format_verifications([verifier_input[i] for i in second_idx], second_completions)))
+
+        escalated = set(escalated)
+        output = []
+        for idx, verification in enumerate(verifications):
+            if idx in escalated:
+                record = second[idx]
+                record["cascade_stage"] = "second"
+                record["first_stage_score"] = verification["score"]
+                if "support_prob" in verification:
+                    record["first_stage_support_prob"] = verification["support_prob"]
+                # A free-text second stage has no logprobs. Its decision stands in for the probability,
+                # so the response-level mean covers the escalated (uncertain) claims too.
+                if record.get("support_prob") is None and record["score"] is not None:
+                    record["support_prob"] = float(record["score"])
+            else:
+                record = verification
+                record["cascade_stage"] = "first"
+                if idx in second:
+                    record["second_stage_score"] = second[idx]["score"]
+                    metrics.increment("verifier.audit_agreements", float(second[idx]["score"] == verification["score"]))
+            output.append(record)
+
+        metrics.increment("verifier.cascade_claims", len(verifications))
+        metrics.increment("verifier.escalated_claims", len(escalated))
+        metrics.increment("verifier.audited_claims", len(audited))
+        if verifications:
+            logger.info(f"Cascade escalated {len(escalated)} of {len(verifications)} claims "
+                        f"({len(escalated) / len(verifications):.1%}) to {self.model_name}")
+        return output